@@ -0,0 +1,168 @@
+""" Row and column alias positions kept across runs, keyed by the layout of the aliased sheet """
+
+import hashlib
+import json
+import os
+import re
+from threading import Lock
+from loguru import logger
+import config as cfg
+
+
+def get_layout_fingerprint(source):
+    """
+    Get a fingerprint of the layout of a sheet from its label column and header row
+    Parameters:
+        source {DataFrame} - Sheet with metadata row (ar) and column (ac)
+    Returns:
+        {String} - Hash of the shape, the first column and the first row of the sheet
+    """
+    columns = [column for column in source.columns if column != 'ac']
+    rows = [row for row in source.index if row != 'ar']
+    layout = hashlib.sha1('{}x{}'.format(len(rows), len(columns)).encode())
+    if rows and columns:
+        layout.update('|'.join(map(str, source.loc[rows, columns[0]])).encode())
+        layout.update(b'\n')
+        layout.update('|'.join(map(str, source.loc[rows[0], columns])).encode())
+    return layout.hexdigest()
+
+
+def is_first_at(source, prefix, keyword, start, index):
+    """
+    Check that the row or column at the index is still the first one from the start whose
+        metadata text matches the keyword, as get_row_index and get_col_index search. Only
+        the cached cell is matched, the metadata before it is searched at once for a match
+        inserted since.
+    Parameters:
+        source {DataFrame} - Sheet with metadata row (ar) and column (ac)
+        prefix {String} - 'r' for row aliases, 'c' for column aliases
+        keyword {String} - Keyword pattern of the alias
+        start {Integer} - Row or column index the search starts from
+        index {Integer} - Row or column index
+    Returns:
+        {Boolean} - True if the search would find the keyword at the index
+    """
+    if not keyword:
+        # The helper resolves a blank keyword to the first row or column
+        return index == 0
+    try:
+        texts = source['ac'] if prefix == 'r' else source.loc['ar']
+        position = texts.index.get_loc(index)
+    except KeyError:
+        return False
+    pattern = re.compile(str(keyword))
+    texts = texts.to_numpy()
+    try:
+        return bool(pattern.search(texts[position])) \
+            and not any(map(pattern.search, texts[start:position]))
+    except TypeError:
+        # Metadata which is not text is left to the full search
+        return False
+
+
+class AliasCache:
+    """
+    Resolved alias positions by alias file and sheet layout, shared by the countries whose
+        input files have the same layout
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self._positions = None
+        self._dirty = False
+        self._lock = Lock()
+
+    def _load(self):
+        """
+        Read the cached positions on first use
+        """
+        self._positions = {}
+        cache_file = self.cache_file or cfg.ALIAS_CACHE_FILE
+        if not cache_file or not os.path.isfile(cache_file):
+            return
+        try:
+            with open(cache_file) as content:
+                self._positions = json.load(content)
+        except (OSError, ValueError) as err_message:
+            logger.warning("Alias cache {} is not readable: {}".format(cache_file, err_message))
+
+    def get_layout(self, alias_file, source):
+        """
+        Get the cached positions of the aliases of a file for the layout of the sheet
+        Parameters:
+            alias_file {String} - Alias file
+            source {DataFrame} - Sheet the aliases are resolved against
+        Returns:
+            {Dictionary} - Alias name to keyword, start keyword, start index and index
+        """
+        fingerprint = get_layout_fingerprint(source)
+        with self._lock:
+            if self._positions is None:
+                self._load()
+            return self._positions.setdefault(alias_file, {}).setdefault(fingerprint, {})
+
+    def find(self, layout, row, source):
+        """
+        Get the cached position of a row or column alias, if its keyword and the keyword of
+            its start row or column are still first found there
+        Parameters:
+            layout {Dictionary} - Cached positions from get_layout
+            row {Dictionary} - Row of the alias file
+            source {DataFrame} - Sheet the aliases are resolved against
+        Returns:
+            {Integer} - Row or column index of the keyword, None if it must be searched
+        """
+        cached = layout.get(row['Alias'])
+        prefix = row['Alias'][0]
+        # A row or column matching the keyword may have been inserted before the cached one
+        if cached is not None and cached[:2] == [row['Keyword'], row['start row/col']] \
+                and cached[3] >= cached[2] \
+                and (not row['start row/col'] and cached[2] == 0
+                     or is_first_at(source, prefix, row['start row/col'], 0, cached[2])) \
+                and is_first_at(source, prefix, row['Keyword'], cached[2], cached[3]):
+            self.hits += 1
+            return cached[3]
+        self.misses += 1
+        return None
+
+    def store(self, layout, row, start, index):
+        """
+        Remember the position an alias was resolved to by a full search
+        Parameters:
+            layout {Dictionary} - Cached positions from get_layout
+            row {Dictionary} - Row of the alias file
+            start {Integer} - Index of the start row or column
+            index {Integer} - Index of the keyword
+        """
+        with self._lock:
+            layout[row['Alias']] = [row['Keyword'], row['start row/col'], int(start), int(index)]
+            self._dirty = True
+
+    def save(self):
+        """
+        Write the positions through a temporary file if any changed, once at the end of a
+            batch
+        """
+        cache_file = self.cache_file or cfg.ALIAS_CACHE_FILE
+        with self._lock:
+            if not cache_file or not self._dirty:
+                return
+            os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+            with open(cache_file + '.tmp', 'w') as content:
+                json.dump(self._positions, content)
+            os.replace(cache_file + '.tmp', cache_file)
+            self._dirty = False
+
+    def clear(self):
+        """
+        Drop the positions held in memory, they are read again on next use
+        """
+        with self._lock:
+            self._positions = None
+            self._dirty = False
+            self.hits = self.misses = 0
+
+
+ALIAS_CACHE = AliasCache()
@@ -0,0 +1,58 @@
+""" Regenerate the reports of a range of COB dates in one batch """
+
+from calendar import monthrange
+from datetime import datetime
+from loguru import logger
+from src.batch import run_batch
+
+
+def get_periods(start_date, end_date):
+    """
+    Get the monthly COB dates from the start date up to the end date, on the day of month
+        of the start date or the last day of shorter months
+    Parameters:
+        start_date {String/Date} - First COB date, as DD-Mon-YYYY if a string
+        end_date {String/Date} - Last COB date, as DD-Mon-YYYY if a string
+    Returns:
+        {List} - COB dates of the periods
+    """
+    if isinstance(start_date, str):
+        start_date = datetime.strptime(start_date, '%d-%b-%Y')
+    if isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, '%d-%b-%Y')
+
+    periods = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        periods.append(start_date.replace(
+            year=year, month=month, day=min(start_date.day, monthrange(year, month)[1])))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return periods
+
+
+def run_backfill(start_date, end_date, countries, resume=False):
+    """
+    Generate the reports of the countries for every month in the range as a single batch.
+        Every period is a separate job of the pipeline, so periods run in parallel, while
+        the parsed alias and mapping files and the compiled statements are shared by all of
+        them. The COB date travels with each job instead of being set in COUNTRY_DATE.
+    Parameters:
+        start_date {String/Date} - First COB date, as DD-Mon-YYYY if a string
+        end_date {String/Date} - Last COB date, as DD-Mon-YYYY if a string
+        countries {List} - Countries to generate reports for
+        resume {Boolean} - Continue from the checkpoints of a previous backfill
+    Returns:
+        {Dictionary} - (Country, COB date) to error of the failed reports
+    """
+    periods = get_periods(start_date, end_date)
+    if not periods:
+        logger.error("No COB dates between {} and {}".format(start_date, end_date))
+        return {}
+    logger.info("Backfilling {} reports for {} periods from {:%d-%b-%Y} to {:%d-%b-%Y}".format(
+        len(periods) * len(countries), len(periods), periods[0], periods[-1]))
+
+    failures = run_batch(periods, countries, resume=resume)
+    logger.info("Backfill generated {} of {} reports".format(
+        len(periods) * len(countries) - len(failures), len(periods) * len(countries)))
+    return failures
+
@@ -0,0 +1,438 @@
+""" Pipelined batch generation of Country Financials reports """
+
+from datetime import datetime
+from os import path
+from queue import Queue
+from threading import Thread, Lock
+from time import perf_counter
+from loguru import logger
+from src.helper import clear_formulae, get_prev_mth, save_stored, strip_metadata
+from src.memory import (MemoryMonitor, MB, current_rss, is_over_budget, spill_job,
+                        restore_job)
+from src.scheduler import (MemoryGate, load_history, save_history, record_run, plan_batch,
+                           log_plan)
+from src.xlsx_writer import get_changed_cells, write_report
+from src.checkpoint import Checkpoint
+from src.alias_cache import ALIAS_CACHE
+from src.rollup import (get_rollups, get_rollup_rows, rollup_mapping, get_alias_positions,
+                        get_unresolved_members, reads_other_sheets)
+from src.trend import roll_mapping
+from src.rules import reset_rules
+from src.expression import CACHE_STATS
+from src.metrics import REGISTRY, install_log_counter
+from src.report_generator import (load_country_report, prepare_exp_context, resolve_aliases,
+                                  evaluate_mapping, write_sheet, get_exp_mapping_file,
+                                  get_country_files, RULES_CACHE)
+import config as cfg
+
+# openpyxl and the optional export and formula modules are imported where they are used
+# pylint: disable=import-outside-toplevel
+
+# Marks the end of the jobs on a queue
+END_OF_JOBS = None
+
+
+def read_stage(job):
+    """
+    Read and parse the input workbook of the country
+    Parameters:
+        job {Dictionary} - Batch job of the country
+    Returns:
+        {Dictionary} - Batch job with the report data and workbook loaded
+    """
+    # In memory bounded mode the report workbook is only loaded when it is written to.
+    # Aggregates whose other rows only read the tab itself do not read their inputs.
+    job['report_data'], job['report'] = load_country_report(
+        job['country'], job['cob_date'],
+        with_workbook=cfg.OUTPUT_WRITER == 'openpyxl' and not cfg.MEMORY_BUDGET_MB,
+        mapping_files=[] if job.get('tab_only') else None)
+    if cfg.OUTPUT_WRITER == 'xml' or cfg.EVALUATE_FORMULAS:
+        # Keep the template values of the tab to find the cells changed by the mapping
+        job['template_data'] = {'Exp': job['report_data']['Exp'].copy()}
+    return job
+
+
+def resolve_stage(job):
+    """
+    Resolve the aliases of the country against its report data
+    Parameters:
+        job {Dictionary} - Batch job of the country
+    Returns:
+        {Dictionary} - Batch job with the statement context
+    """
+    alias_files, job['context'] = prepare_exp_context(
+        job['country'], job['report_data'], job['cob_date'],
+        mapping_files=[] if job.get('tab_only') else None)
+    if cfg.MEMORY_BUDGET_MB:
+        # The sheets are held by the context from now on
+        job['report_data'] = {}
+    resolve_aliases(alias_files, job['context'])
+    return job
+
+
+def evaluate_stage(job):
+    """
+    Evaluate the mapping of the country, the additive rows of an aggregate are summed from
+        the tabs of its members instead
+    Parameters:
+        job {Dictionary} - Batch job of the country
+    Returns:
+        {Dictionary} - Batch job with the evaluated tab
+    """
+    mapping_file = get_exp_mapping_file(job['country'])
+    skip_rows = set()
+    skip_cells = {}
+    if 'members' in job:
+        # Rows with the same additive statement for every member are summed from the members,
+        # the other rows are evaluated on the aggregate
+        skip_rows = get_rollup_rows(mapping_file, map(get_exp_mapping_file, job['members']))
+        rollup_mapping(mapping_file, job['context']['exp_source'], job['context'],
+                       job['suffix'], job.pop('members'), skip_rows)
+    elif job.get('trend'):
+        # Periods carried over are copied from the report of the previous month
+        skip_cells = roll_mapping(mapping_file, job['context']['exp_source'], job['context'],
+                                  job['suffix'], job['cob_date'], 'Exp', cfg.TREND_TABS['Exp'])
+    exp_source = evaluate_mapping(mapping_file, job['context']['exp_source'], job['context'],
+                                  job['suffix'], skip_rows=skip_rows, skip_cells=skip_cells)
+    job['report_data']['Exp'] = strip_metadata(exp_source)
+    if job.get('rollup_member'):
+        # Kept until the aggregates of the country are summed
+        job['rollup_data'] = (get_alias_positions(job['context']), job['report_data']['Exp'])
+    if cfg.EXPORT_FORMAT:
+        from src.export import export_tab
+        export_tab(get_country_files(job['country'], job['cob_date'])[1], 'Exp',
+                   job['report_data']['Exp'], job['context'], job['suffix'])
+    if 'template_data' in job:
+        changed_cells = get_changed_cells(job.pop('template_data')['Exp'],
+                                          job['report_data']['Exp'])
+        # Formulae of cells set by the mapping are not evaluated
+        job['mapped_cells'] = {'Exp': set(changed_cells)}
+    if cfg.OUTPUT_WRITER == 'xml':
+        job['changed_cells'] = {'Exp': changed_cells}
+    else:
+        job['exp_values'] = exp_source
+    # The context holds the metadata frames which are no longer needed
+    del job['context']
+    return job
+
+
+def calculate_formulas(job, workbook):
+    """
+    Evaluate the supported template formulae over the evaluated tab
+    Parameters:
+        job {Dictionary} - Batch job of the country
+        workbook {Workbook} - Template workbook loaded with formulae
+    Returns:
+        {Dictionary} - Sheet name to (row, column) to evaluated value
+    """
+    from src.formula import evaluate_workbook_formulas
+
+    return evaluate_workbook_formulas(workbook, {'Exp': job['report_data']['Exp']},
+                                      job.pop('mapped_cells', None))
+
+
+def save_stage(job):
+    """
+    Write the evaluated tab to the report workbook of the country and save it, clearing
+        formulae and restoring extLst elements
+    Parameters:
+        job {Dictionary} - Batch job of the country
+    Returns:
+        {Dictionary} - Batch job with the path of the saved report
+    """
+    from openpyxl import load_workbook
+
+    country_input_file, job['output_file'] = get_country_files(job['country'], job['cob_date'])
+    if cfg.OUTPUT_WRITER == 'xml':
+        sheet_cells = job.pop('changed_cells')
+        if cfg.EVALUATE_FORMULAS:
+            template = load_workbook(country_input_file, read_only=True)
+            for sheet, cells in calculate_formulas(job, template).items():
+                sheet_cells.setdefault(sheet, {}).update(cells)
+            template.close()
+        # Formulae are stripped and extLst elements kept while patching the template. The
+        # formula cells of the tab keep their value, as write_sheet does for openpyxl.
+        write_report(country_input_file, job['output_file'], sheet_cells,
+                     cfg.OUTPUT_COMPRESSION, sheet_values={'Exp': job['report_data']['Exp']})
+        return job
+    # The workbook is not loaded yet in memory bounded mode or after resuming a checkpoint
+    if job.get('report') is None:
+        job['report'] = load_workbook(country_input_file)
+    # Formulae are read from the template before the tab overwrites them
+    calculated = calculate_formulas(job, job['report']) if cfg.EVALUATE_FORMULAS else {}
+    write_sheet(job['report']['Exp'], job.pop('exp_values'))
+    for sheet, cells in calculated.items():
+        for (row, col), value in cells.items():
+            job['report'][sheet].cell(row=row, column=col, value=value)
+    # clear_formulae reads the report and saves it again, so it is not compressed here
+    save_stored(job['report'], job['output_file'])
+    del job['report']
+    clear_formulae(job['country'], job['cob_date'])
+    return job
+
+
+PIPELINE_STAGES = [
+    ('read', read_stage),
+    ('resolve', resolve_stage),
+    ('evaluate', evaluate_stage),
+    ('save', save_stage),
+]
+
+
+def finish_job(job, run, failed=False):
+    """
+    Release the memory reserved for a job leaving the pipeline, record its timings and
+        metrics and checkpoint the completed country
+    Parameters:
+        job {Dictionary} - Batch job which completed or failed
+        run {Dictionary} - State shared by the stages of the pipeline run
+        failed {Boolean} - True if a stage failed for the job
+    """
+    run['gate'].release(job['expected_mb'])
+    if failed:
+        REGISTRY.inc('reports_total', status='failed')
+        REGISTRY.write_due()
+        return
+    country_input_file, _ = get_country_files(job['country'], job['cob_date'])
+    with run['lock']:
+        if 'rollup_data' in job:
+            run['rollup_data'][(job['country'], job['cob_date'])] = job.pop('rollup_data')
+        record_run(run['history'], job['country'], 'Exp', job['timings'], job['memory_mb'])
+    if job['cob_date'] in run['checkpoints']:
+        run['checkpoints'][job['cob_date']].save_done(job, country_input_file)
+
+    for stage, duration in job['timings'].items():
+        REGISTRY.set('stage_duration_seconds', duration, country=job['country'], stage=stage)
+    REGISTRY.set('tab_duration_seconds', sum(job['timings'].values()),
+                 country=job['country'], tab='Exp')
+    REGISTRY.inc('bytes_read_total', path.getsize(country_input_file), country=job['country'])
+    REGISTRY.inc('bytes_written_total', path.getsize(job['output_file']),
+                 country=job['country'])
+    REGISTRY.inc('reports_total', status='generated')
+    REGISTRY.write_due()
+
+
+def run_stage(name, func, in_queue, out_queue, run):
+    """
+    Worker loop of a pipeline stage, moving jobs from the input queue to the output queue
+    Parameters:
+        name {String} - Name of the stage
+        func {Function} - Stage function applied to each job
+        in_queue {Queue} - Queue of jobs waiting for this stage
+        out_queue {Queue} - Queue of jobs waiting for the next stage, None for the last stage
+        run {Dictionary} - State shared by the stages of the pipeline run
+    """
+    while True:
+        job = in_queue.get()
+        if job is END_OF_JOBS:
+            # Pass the marker on so that the other workers of this stage stop as well
+            in_queue.put(END_OF_JOBS)
+            return
+        # Jobs resumed from a checkpoint pass through the stages they already completed
+        if name not in job['stages_done']:
+            started, rss_before = perf_counter(), current_rss()
+            try:
+                with run['monitor'].phase(name):
+                    job = func(restore_job(job))
+            except (Exception, SystemExit) as err_message:  # pylint: disable=broad-except
+                logger.error("Stage {} failed for {} for {:%d-%b-%Y}: {}".format(
+                    name, job['country'], job['cob_date'], err_message))
+                with run['lock']:
+                    run['failures'][(job['country'], job['cob_date'])] = err_message
+                finish_job(job, run, failed=True)
+                continue
+            job['timings'][name] = perf_counter() - started
+            job['memory_mb'] = max(job['memory_mb'], (current_rss() - rss_before) / MB)
+            job['stages_done'].append(name)
+            if job['cob_date'] in run['checkpoints'] and name in cfg.CHECKPOINT_STAGES:
+                run['checkpoints'][job['cob_date']].save_stage(
+                    job, name, get_country_files(job['country'], job['cob_date'])[0])
+
+        if out_queue is None:
+            finish_job(job, run)
+            continue
+        # Jobs waiting for the next stage are idle, spill them while over the budget
+        if is_over_budget():
+            job = spill_job(job)
+        out_queue.put(job)
+
+
+def new_job(country, cob_date, run):
+    """
+    Create the job of a country for a COB date, restored from its checkpoint when resuming
+    Parameters:
+        country {String} - Country name
+        cob_date {Date} - COB date of the report
+        run {Dictionary} - State shared by the stages of the pipeline run
+    Returns:
+        {Dictionary} - Batch job, None if the report of a previous run is reused
+    """
+    job = {'country': country, 'cob_date': cob_date, 'suffix': run['suffix'],
+           'expected_mb': run['costs'][country][1], 'timings': {}, 'memory_mb': 0.0,
+           'stages_done': []}
+    if run['resume'] and cob_date in run['checkpoints']:
+        stage, saved_job = run['checkpoints'][cob_date].restore(
+            country, get_country_files(country, cob_date)[0])
+        if stage == 'done':
+            logger.info("Report of {} for {:%d-%b-%Y} is complete, reusing it".format(
+                country, cob_date))
+            REGISTRY.inc('reports_total', status='reused')
+            return None
+        if saved_job is not None:
+            logger.info("Resuming {} for {:%d-%b-%Y} after stage {}".format(
+                country, cob_date, stage))
+            job = saved_job
+
+    if any(country in members for members in run['rollups'].values()):
+        job['rollup_member'] = True
+    # Jobs restored from a checkpoint of a rollup keep the tabs of the members
+    if country in run['rollups'] and 'members' not in job \
+            and 'evaluate' not in job['stages_done']:
+        members = {member: run['rollup_data'].get((member, cob_date))
+                   for member in run['rollups'][country]}
+        mapping_file = get_exp_mapping_file(country)
+        rows = get_rollup_rows(mapping_file, map(get_exp_mapping_file, members))
+        if not all(member is not None for member in members.values()):
+            logger.info("Not all members of {} were evaluated for {:%d-%b-%Y}, it is generated "
+                        "from its own inputs".format(country, cob_date))
+        elif get_unresolved_members(mapping_file, run['suffix'], members, rows):
+            logger.info("Aliases of {} are not found in all members for {:%d-%b-%Y}, it is "
+                        "generated from its own inputs".format(country, cob_date))
+        else:
+            job['members'] = members
+            job['tab_only'] = not reads_other_sheets(mapping_file, run['suffix'], rows)
+    # The report of the previous month must not be generated by the same batch
+    previous = get_prev_mth(cob_date)
+    if 'Exp' in cfg.TREND_TABS and (previous.year, previous.month) not in run['months']:
+        job['trend'] = True
+    return job
+
+
+def run_jobs(jobs, stages, concurrency, queue_depth, run):
+    """
+    Run the jobs through the stages of the pipeline until all of them are done
+    Parameters:
+        jobs {List} - (Country, COB date) of the jobs in the order they start
+        stages {List} - Pipeline stages as (name, function) pairs
+        concurrency {Dictionary} - Number of worker threads per stage
+        queue_depth {Integer} - Maximum number of jobs waiting between two stages
+        run {Dictionary} - State shared by the stages of the pipeline run
+    """
+    queues = [Queue(maxsize=queue_depth) for _ in stages]
+    workers = []
+    for stage_idx, (name, func) in enumerate(stages):
+        out_queue = queues[stage_idx + 1] if stage_idx + 1 < len(stages) else None
+        stage_workers = [Thread(target=run_stage, name='{}-{}'.format(name, worker_idx),
+                                args=(name, func, queues[stage_idx], out_queue, run),
+                                daemon=True)
+                         for worker_idx in range(max(1, concurrency.get(name, 1)))]
+        for worker in stage_workers:
+            worker.start()
+        workers.append(stage_workers)
+
+    for country, cob_date in jobs:
+        job = new_job(country, cob_date, run)
+        if job is None:
+            continue
+        run['gate'].acquire(job['expected_mb'])
+        queues[0].put(job)
+    queues[0].put(END_OF_JOBS)
+
+    # Close each stage once all of its workers are done, then signal the next stage
+    for stage_idx, stage_workers in enumerate(workers):
+        for worker in stage_workers:
+            worker.join()
+        if stage_idx + 1 < len(stages):
+            queues[stage_idx + 1].put(END_OF_JOBS)
+
+
+# pylint: disable=too-many-locals, too-many-arguments
+def run_batch(periods, countries, suffix='exp', stages=None, concurrency=None, queue_depth=None,
+              resume=False):
+    """
+    Generate the reports of the countries for each COB date with the stages running
+        concurrently, so that reading the next report and saving the previous one overlap
+        evaluation of the current. Reports start longest expected first and only while their
+        expected memory fits under BATCH_MEMORY_CEILING_MB. Aggregates of ROLLUP_COUNTRIES
+        whose members are all in the batch run after them and are summed from their tabs.
+    Parameters:
+        periods {List} - COB dates to generate reports for
+        countries {List} - Countries to generate reports for
+        suffix {String} - Alias suffix of the generated tab
+        stages {List} - Pipeline stages as (name, function) pairs
+        concurrency {Dictionary} - Number of worker threads per stage
+        queue_depth {Integer} - Maximum number of jobs waiting between two stages
+        resume {Boolean} - Continue from the checkpoints of a previous run of the COB dates
+    Returns:
+        {Dictionary} - (Country, COB date) to error of the failed jobs
+    """
+    stages = stages or PIPELINE_STAGES
+    concurrency = concurrency or cfg.PIPELINE_CONCURRENCY
+    queue_depth = queue_depth or cfg.PIPELINE_QUEUE_DEPTH
+
+    # Rule files changed since the last batch are read again
+    reset_rules()
+    history = load_history()
+    # Every period of a country is planned as a separate job with the cost of the country
+    order, makespan, costs = plan_batch(
+        countries * len(periods), [(name, concurrency.get(name, 1)) for name, _ in stages],
+        cfg.BATCH_MEMORY_CEILING_MB, history)
+    log_plan(order, makespan, costs)
+    install_log_counter()
+    REGISTRY.track_cache('statement', CACHE_STATS)
+    REGISTRY.track_cache('rules', RULES_CACHE)
+    REGISTRY.track_cache('alias', ALIAS_CACHE)
+
+    run = {
+        'failures': {},
+        'lock': Lock(),
+        'monitor': MemoryMonitor().start(),
+        'gate': MemoryGate(cfg.BATCH_MEMORY_CEILING_MB),
+        'history': history,
+        'checkpoints': {cob_date: Checkpoint(cob_date, resume) for cob_date in periods}
+                       if cfg.CHECKPOINT_ENABLED else {},
+        'suffix': suffix,
+        'costs': costs,
+        'resume': resume,
+        # Custom stages may not evaluate the mapping, only the default pipeline rolls up
+        'rollups': get_rollups(countries, get_exp_mapping_file)
+                   if stages is PIPELINE_STAGES else {},
+        'rollup_data': {},
+        'months': {(cob_date.year, cob_date.month) for cob_date in periods},
+    }
+    pending = {country: sorted(periods) for country in countries}
+    jobs = [(country, pending[country].pop(0)) for country in order]
+    run_jobs([job for job in jobs if job[0] not in run['rollups']],
+             stages, concurrency, queue_depth, run)
+    if run['rollups']:
+        run_jobs([job for job in jobs if job[0] in run['rollups']],
+                 stages, concurrency, queue_depth, run)
+        run['rollup_data'].clear()
+
+    run['monitor'].stop()
+    save_history(run['history'])
+    ALIAS_CACHE.save()
+    REGISTRY.write()
+    for (country, cob_date), err_message in run['failures'].items():
+        logger.error("Report for {} for {:%d-%b-%Y} was not generated: {}".format(
+            country, cob_date, err_message))
+    return run['failures']
+
+
+def run_pipeline(countries, suffix='exp', stages=None, concurrency=None, queue_depth=None,
+                 resume=False):
+    """
+    Generate the reports of the countries for the COB date of the run, see run_batch
+    Parameters:
+        countries {List} - Countries to generate reports for
+        suffix {String} - Alias suffix of the generated tab
+        stages {List} - Pipeline stages as (name, function) pairs
+        concurrency {Dictionary} - Number of worker threads per stage
+        queue_depth {Integer} - Maximum number of jobs waiting between two stages
+        resume {Boolean} - Continue from the checkpoints of a previous run of the COB date
+    Returns:
+        {Dictionary} - Country to error of the failed jobs
+    """
+    cob_date = datetime.strptime(cfg.COUNTRY_DATE, '%d-%b-%Y')
+    failures = run_batch([cob_date], countries, suffix, stages, concurrency, queue_depth, resume)
+    return {country: err_message for (country, _), err_message in failures.items()}
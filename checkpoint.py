@@ -0,0 +1,141 @@
+""" Checkpoints of batch runs, so that a failed run resumes where it stopped """
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from threading import Lock
+from loguru import logger
+from src.input_cache import get_file_key
+import config as cfg
+
+MANIFEST_FILE = 'manifest.json'
+# Job entries which are not checkpointed, the report workbook is reloaded on resume
+TRANSIENT_KEYS = ('report', 'spill_file')
+
+
+def file_hash(file_name):
+    """
+    Compute the SHA-256 hash of a file
+    Parameters:
+        file_name {String} - Path of the file
+    Returns:
+        {String} - Hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as content:
+        for block in iter(lambda: content.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_atomic(file_name, data):
+    """
+    Write the file through a temporary file, so that a crash never leaves it half written
+    Parameters:
+        file_name {String} - Path of the file
+        data {Bytes} - Content of the file
+    """
+    with open(file_name + '.tmp', 'wb') as content:
+        content.write(data)
+    os.replace(file_name + '.tmp', file_name)
+
+
+class Checkpoint:
+    """
+    Checkpoints of the countries of a batch run for one COB date
+    """
+
+    def __init__(self, cob_date, resume=False):
+        self.directory = os.path.join(cfg.CHECKPOINT_DIR, cob_date.strftime('%Y%m%d'))
+        if not resume and os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = Lock()
+        self.manifest = {}
+        manifest_file = os.path.join(self.directory, MANIFEST_FILE)
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as manifest:
+                self.manifest = json.load(manifest)
+
+    def _save_manifest(self):
+        write_atomic(os.path.join(self.directory, MANIFEST_FILE),
+                     json.dumps(self.manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+    def _stage_file(self, country, stage):
+        return os.path.join(self.directory, '{}.{}.pkl'.format(
+            hashlib.md5(country.encode('utf-8')).hexdigest(), stage))
+
+    def _remove_stages(self, country):
+        for stage in cfg.CHECKPOINT_STAGES:
+            if os.path.isfile(self._stage_file(country, stage)):
+                os.remove(self._stage_file(country, stage))
+
+    def save_stage(self, job, stage, input_file):
+        """
+        Checkpoint a job after a completed stage
+        Parameters:
+            job {Dictionary} - Batch job of the country
+            stage {String} - Name of the completed stage
+            input_file {String} - Input file the job was built from
+        """
+        state = {key: value for key, value in job.items() if key not in TRANSIENT_KEYS}
+        write_atomic(self._stage_file(job['country'], stage),
+                     pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            entry = self.manifest.setdefault(job['country'], {})
+            entry['input_key'] = list(get_file_key(input_file))
+            entry['stage'] = stage
+            entry.pop('output_file', None)
+            self._save_manifest()
+
+    def save_done(self, job, input_file):
+        """
+        Record a completed country with the hash of its report and drop its stage checkpoints
+        Parameters:
+            job {Dictionary} - Batch job of the country with the saved report
+            input_file {String} - Input file the job was built from
+        """
+        with self._lock:
+            self.manifest[job['country']] = {
+                'stage': 'done',
+                'input_key': list(get_file_key(input_file)),
+                'output_file': job['output_file'],
+                'output_hash': file_hash(job['output_file']),
+            }
+            self._save_manifest()
+        self._remove_stages(job['country'])
+
+    def restore(self, country, input_file):
+        """
+        Get the checkpointed state of a country, if it is still valid
+        Parameters:
+            country {String} - Country name
+            input_file {String} - Input file of the country
+        Returns:
+            {Tuple} - 'done' and None for a verified completed report, the last completed
+                stage and the checkpointed job, or None and None to start from scratch
+        """
+        entry = self.manifest.get(country)
+        if not entry:
+            return None, None
+        try:
+            if list(get_file_key(input_file)) != entry.get('input_key'):
+                logger.info("Input of {} changed since the checkpoint".format(country))
+                return None, None
+        except FileNotFoundError:
+            return None, None
+
+        if entry['stage'] == 'done':
+            output_file = entry['output_file']
+            if os.path.isfile(output_file) and file_hash(output_file) == entry['output_hash']:
+                return 'done', None
+            logger.info("Report of {} does not match its checkpoint".format(country))
+            return None, None
+
+        stage_file = self._stage_file(country, entry['stage'])
+        if not os.path.isfile(stage_file):
+            return None, None
+        with open(stage_file, 'rb') as state:
+            return entry['stage'], pickle.load(state)
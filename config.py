@@ -10,6 +10,7 @@ TEMPLATE_DIR = 'template/'
 OUTPUT_DIR = 'output/'
 
 MISSING_FILE_MESSAGE = '{} is not found in the input directory'
+PARSING_FILE_MESSAGE = '{} is still being parsed'
 EXISTENT_FILE_MESSAGE = '{} is found in the input directory'
 MISSING_OUTPUT_FILE_MESSAGE = '{} is not found in the output directory. Run inputReport.py'
 EXISTENT_OUTPUT_FILE_MESSAGE = '{} is found in the output directory'
@@ -61,6 +62,19 @@ MAPPING_APO_TAB = 'mapping/rules/mapping_apo_tab.csv'
 MAPPING_WMCO_TAB = 'mapping/rules/mapping_wmco_tab.csv'
 MAPPING_EXP_TAB = 'mapping/rules/mapping_exp_{}_tab.csv'
 
+# Alias file and the report sheet its aliases are resolved against, for the Exp tab
+EXP_ALIAS_SOURCES = {
+    ALIAS_FILE_INPUT: 'Input',
+    ALIAS_FILE_EXP: 'Exp',
+    ALIAS_FILE_PB: 'PB',
+    ALIAS_FILE_AFG: 'AFG',
+    ALIAS_FILE_IBCM: 'IBCM',
+    ALIAS_FILE_MKTS: 'Mkts',
+}
+
+# Suffixes used in statements to refer to a data frame (e.g. pb_source)
+FRAME_SUFFIXES = ('_source', '_dest', '_tab1', '_tab2')
+
 # For Grouping column exists
 AFG_GROUP_EXISTED_COUNTRIES = [
     'India, and Market Group, Indian Sub-Continent',
@@ -213,3 +227,114 @@ PB_MARKET_DESC = {'Australia' : 'CS Australia & EAM AU (TF) (69911)',
                   'Japan' : 'CS Japan (TF) (63690)',
                   'Korea' : '0'
                  }
+
+# Pipelined batch mode: worker threads per stage and depth of the queues between stages
+PIPELINE_CONCURRENCY = {
+    'read': 2,
+    'resolve': 1,
+    'evaluate': 1,
+    'save': 1,
+}
+PIPELINE_QUEUE_DEPTH = 2
+
+# Watch mode: seconds between scans of the input directory and worker threads
+WATCH_POLL_INTERVAL = 30
+WATCH_PARSE_WORKERS = 2
+WATCH_GENERATE_WORKERS = 1
+# Date formats used in the names of the capital and weekly input files
+CAPITAL_FILE_DATE_FORMAT = "%b'%y"
+WEEKLY_FILE_DATE_FORMAT = '%d-%b-%Y'
+
+# Input reader: 'fast' streams the values of read-only sheets from the XML into arrays,
+# 'openpyxl' loads every workbook through openpyxl, as is always done for formulas
+READER_BACKEND = 'fast'
+
+# Trend mode: tabs whose periods roll by one column each month, as (alias of the first period
+# column, number of periods oldest first, input sheet to the alias of its first period column).
+# The cells of the periods carried over are copied from the previous month's report, unless
+# their inputs were restated or they read another period or the report date, the other cells
+# are evaluated.
+# e.g. {'Exp': ('c_p1', 21, {'Input': 'c_p1'})}
+TREND_TABS = {}
+
+# Output writer: 'openpyxl' saves through openpyxl, 'xml' patches the changed sheet parts
+OUTPUT_WRITER = 'openpyxl'
+
+# Deflate level of output workbooks: fast for working files, maximum for distributed reports
+OUTPUT_COMPRESSION_LEVEL = {
+    'working': 1,
+    'final': 9,
+}
+# Profile the reports are written with
+OUTPUT_COMPRESSION = 'final'
+OUTPUT_COMPRESSION_THREADS = 4
+# Compress reports saved through openpyxl in parallel at OUTPUT_COMPRESSION, openpyxl then
+# saves them uncompressed before the extLst elements are restored
+RECOMPRESS_OUTPUT = False
+
+# Statement engine: 'vm' compiles statements to the restricted expression language,
+# 'eval' runs them with Python eval. 'eval' stays the default until both engines give the
+# same reports on the production mapping files.
+STATEMENT_ENGINE = 'eval'
+
+# Memory bounded mode: resident set size budget in MB (None to disable), directory for idle
+# parsed data spilled to disk and seconds between memory samples
+MEMORY_BUDGET_MB = None
+SPILL_DIR = 'spill/'
+MEMORY_SAMPLE_INTERVAL = 0.1
+
+# Cost model of batch runs: timings of previous runs, number of runs kept per country,
+# relative cost of countries without history and memory available to a batch in MB
+TIMINGS_FILE = './logs/timings.json'
+TIMINGS_HISTORY = 5
+DEFAULT_COST_WEIGHT = {
+    'group1': 2,
+    'group2': 4,
+    'other': 1,
+}
+BATCH_MEMORY_CEILING_MB = None
+
+# Checkpoints of batch runs, written after the listed stages and after each country
+CHECKPOINT_ENABLED = True
+CHECKPOINT_DIR = 'checkpoint/'
+CHECKPOINT_STAGES = ('resolve', 'evaluate')
+
+# Run metrics in the Prometheus textfile format, None to disable
+METRICS_FILE = './metrics/country_financials.prom'
+# Seconds between metric writes during a batch
+METRICS_INTERVAL = 60
+
+# Mapping diagnostics, summarised once per tab with the full list optionally written to CSV
+DIAGNOSTICS_SUMMARY_MESSAGE = '{} {} in tab {} of {} from file {}, check rows {}{}'
+DIAGNOSTICS_KINDS = {'MISSING_VALUE_ERROR': 'missing values',
+                     'MAPPING_ERROR_MESSAGE': 'failed statements'}
+DIAGNOSTICS_SUMMARY_ROWS = 10
+DIAGNOSTICS_DETAIL = False
+DIAGNOSTICS_DIR = './logs/diagnostics/'
+
+# Progress bar of the mapping evaluation, refreshed at most every PROGRESS_INTERVAL seconds
+PROGRESS_INTERVAL = 1.0
+PROGRESS_MIN_ROWS = 10
+
+# Columnar export of the computed tabs, 'parquet', 'csv' or None to disable.
+# Parquet needs pyarrow and falls back to CSV without it
+EXPORT_FORMAT = None
+EXPORT_DIR = 'export/'
+
+# Evaluate the template formulae (SUM, arithmetic, IF, IFERROR and sheet references) into
+# values before they are stripped from the output, other formulae are stripped as before
+EVALUATE_FORMULAS = False
+
+# Alias and mapping files pre-parsed into one bundle, compiled again when any of them changes
+RULES_BUNDLE_FILE = './mapping/rules_bundle.pkl'
+
+# Row and column alias positions kept across runs by sheet layout, None to search every run
+ALIAS_CACHE_FILE = './mapping/alias_positions.json'
+
+# Aggregates summed from the evaluated tabs of their members when all of them are in a batch.
+# Mapping rows with the same additive statement in the mapping of every member are summed,
+# the other rows are evaluated from the aggregate's own sheets
+ROLLUP_COUNTRIES = {
+    'SEA&FM': ['Indonesia', 'Malaysia', 'Philippines', 'Thailand', 'Vietnam', 'Singapore',
+               'Frontier Markets'],
+}
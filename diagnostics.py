@@ -0,0 +1,91 @@
+""" Diagnostics of mapping evaluation, collected in the loop and summarised once per tab """
+
+import csv
+import os
+from datetime import datetime
+from loguru import logger
+from src.metrics import REGISTRY
+import config as cfg
+
+# openpyxl is imported where the details are written, as it is slow to import
+# pylint: disable=import-outside-toplevel
+
+# Kinds of issues, named after the message template describing them
+MISSING_VALUE = 'MISSING_VALUE_ERROR'
+FAILED_STATEMENT = 'MAPPING_ERROR_MESSAGE'
+
+DETAIL_COLUMNS = ['mapping file', 'row', 'cell', 'kind', 'statement', 'details']
+
+
+class Diagnostics:
+    """
+    Issues found while evaluating the mapping of a tab, recorded as tuples so that the
+        evaluation loop does no formatting or logging
+    """
+
+    def __init__(self, mapping_file, country, tab):
+        self.mapping_file = mapping_file
+        self.country = country
+        self.tab = tab
+        self.issues = []
+        # Bound once, the loop appends (mapping row, row index, column index, kind,
+        # statement, details) tuples
+        self.record = self.issues.append
+
+    def count(self, kind):
+        """
+        Count the issues of a kind
+        Parameters:
+            kind {String} - Kind of issue
+        Returns:
+            {Integer} - Number of issues of the kind
+        """
+        return sum(1 for issue in self.issues if issue[3] == kind)
+
+    def summarize(self):
+        """
+        Log one summary of the issues of the tab, write the detail file if enabled and
+            count the issues in the run metrics
+        """
+        if not self.issues:
+            return
+        for kind in (MISSING_VALUE, FAILED_STATEMENT):
+            count = self.count(kind)
+            if not count:
+                continue
+            REGISTRY.inc('log_messages_total', count,
+                         level='warning' if kind == MISSING_VALUE else 'error', type=kind)
+            rows = sorted({issue[0] for issue in self.issues if issue[3] == kind})
+            message = cfg.DIAGNOSTICS_SUMMARY_MESSAGE.format(
+                count, cfg.DIAGNOSTICS_KINDS[kind], self.tab, self.country, self.mapping_file,
+                ', '.join(str(row) for row in rows[:cfg.DIAGNOSTICS_SUMMARY_ROWS]),
+                '...' if len(rows) > cfg.DIAGNOSTICS_SUMMARY_ROWS else '')
+            if kind == MISSING_VALUE:
+                logger.warning(message)
+            else:
+                logger.error(message)
+        if cfg.DIAGNOSTICS_DETAIL:
+            logger.info("Diagnostics details written to {}".format(self.write_details()))
+
+    def write_details(self, file_name=None):
+        """
+        Write every recorded issue to a CSV file
+        Parameters:
+            file_name {String} - Path of the detail file, named after the tab by default
+        Returns:
+            {String} - Path of the detail file
+        """
+        from openpyxl.utils.cell import get_column_letter
+
+        if file_name is None:
+            os.makedirs(cfg.DIAGNOSTICS_DIR, exist_ok=True)
+            file_name = os.path.join(cfg.DIAGNOSTICS_DIR, '{}_{}_{}.csv'.format(
+                self.country, self.tab, datetime.now().strftime('%Y%m%d%H%M%S')))
+        with open(file_name, 'w', newline='') as detail_file:
+            writer = csv.writer(detail_file)
+            writer.writerow(DETAIL_COLUMNS)
+            for mapping_row, row_idx, col_idx, kind, statement, details in self.issues:
+                writer.writerow([self.mapping_file, mapping_row,
+                                 '{}{}'.format(get_column_letter(col_idx + 1), row_idx + 1),
+                                 kind, statement, '' if details is None else details])
+        return file_name
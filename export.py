@@ -0,0 +1,99 @@
+""" Columnar export of the computed tab values for downstream consumers """
+
+import os
+from functools import lru_cache
+from importlib.util import find_spec
+from loguru import logger
+import numpy as np
+import pandas as pd
+import config as cfg
+
+EXPORT_COLUMNS = ['row', 'column', 'row_alias', 'column_alias', 'value', 'text']
+
+
+def get_alias_labels(context, prefix, suffix):
+    """
+    Get the row or column aliases of a tab resolved in the statement context
+    Parameters:
+        context {Dictionary} - Statement context with resolved aliases
+        prefix {String} - 'r' for row aliases, 'c' for column aliases
+        suffix {String} - Alias suffix of the tab
+    Returns:
+        {Dictionary} - Frame index to alias name, the first alias in name order if several
+            aliases point to the same index
+    """
+    labels = {}
+    for name in sorted(context):
+        value = context[name]
+        if name[0] == prefix and name.endswith(suffix) and len(name) > len(suffix) \
+                and isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+            labels.setdefault(int(value), name[:-len(suffix)])
+    return labels
+
+
+def tab_to_records(data_frame, context, suffix):
+    """
+    Convert the values of a tab to one record per non-blank cell, numbers and text kept
+        in separate typed columns
+    Parameters:
+        data_frame {DataFrame} - Tab values without metadata
+        context {Dictionary} - Statement context with resolved aliases
+        suffix {String} - Alias suffix of the tab
+    Returns:
+        {DataFrame} - Records with the 1-based cell position, aliases, value and text
+    """
+    cells = data_frame.stack()
+    rows = pd.Series(cells.index.get_level_values(0), dtype='int64')
+    cols = pd.Series(cells.index.get_level_values(1), dtype='int64')
+    values = pd.to_numeric(pd.Series(cells.to_numpy(), dtype=object), errors='coerce')
+    texts = pd.Series(cells.to_numpy(), dtype=object).where(values.isna()).map(
+        lambda value: value if pd.isna(value) else str(value))
+    return pd.DataFrame({
+        'row': rows + 1,
+        'column': cols + 1,
+        'row_alias': rows.map(get_alias_labels(context, 'r', suffix)).fillna(''),
+        'column_alias': cols.map(get_alias_labels(context, 'c', suffix)).fillna(''),
+        'value': values.astype('float64'),
+        'text': texts.astype('string'),
+    }, columns=EXPORT_COLUMNS)
+
+
+@lru_cache(maxsize=None)
+def has_parquet_engine():
+    """
+    Check whether a Parquet engine is installed, warning once if it is not
+    Returns:
+        {Boolean} - True if pyarrow is installed
+    """
+    if find_spec('pyarrow') is None:
+        logger.warning("pyarrow is not installed, exporting tabs as CSV")
+        return False
+    return True
+
+
+def export_tab(output_file, tab, data_frame, context, suffix):
+    """
+    Write the computed values of a tab to the export directory
+    Parameters:
+        output_file {String} - Path of the report workbook, the export is named after it
+        tab {String} - Tab name
+        data_frame {DataFrame} - Tab values without metadata
+        context {Dictionary} - Statement context with resolved aliases
+        suffix {String} - Alias suffix of the tab
+    Returns:
+        {String} - Path of the export file, None if exports are disabled
+    """
+    if not cfg.EXPORT_FORMAT:
+        return None
+    export_format = cfg.EXPORT_FORMAT
+    if export_format == 'parquet' and not has_parquet_engine():
+        export_format = 'csv'
+    os.makedirs(cfg.EXPORT_DIR, exist_ok=True)
+    export_file = os.path.join(cfg.EXPORT_DIR, '{}_{}.{}'.format(
+        os.path.splitext(os.path.basename(output_file))[0], tab, export_format))
+    records = tab_to_records(data_frame, context, suffix)
+    if export_format == 'parquet':
+        records.to_parquet(export_file, index=False)
+    else:
+        records.to_csv(export_file, index=False)
+    return export_file
@@ -0,0 +1,347 @@
+""" Restricted expression language for mapping and alias statements """
+
+import ast
+import operator
+from datetime import date
+from decimal import Decimal
+from math import floor
+from threading import Lock
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import src.helper as helper
+import config as cfg
+
+
+class StatementError(Exception):
+    """
+    Custom exception for statements using syntax outside of the expression language
+    """
+
+
+# Functions which can be called from statements
+FUNCTIONS = {name: getattr(helper, name) for name in [
+    'cell_sum', 'cell_diff', 'cell_div', 'calcPercentage', 'lookup', 'rows_to_sum',
+    'check_grouping', 'float_val', 'negative_value', 'div_check', 'ci_ratio',
+    'calculate_row_sum', 'get_row_index', 'get_col_index', 'get_quarter', 'get_prev_mth',
+    'month_name', 'month_long_name', 'month_number', 'calc_month_table',
+]}
+FUNCTIONS.update({'abs': abs, 'min': min, 'max': max, 'sum': sum, 'round': round, 'len': len,
+                  'float': float, 'int': int, 'str': str, 'floor': floor, 'Decimal': Decimal})
+
+# Data frame accessors which can be used on frames in statements
+ATTRIBUTES = {'at', 'iat', 'loc', 'iloc'}
+
+# Attributes and methods which can be used on dates, e.g. cob_date.month
+DATE_ATTRIBUTES = {'year', 'month', 'day', 'strftime', 'weekday', 'isoweekday', 'date'}
+
+# Modules whose names can be read in statements, e.g. cfg.NON_PB_CODE, with the names which are
+# available, None for all public names. numpy and pandas are limited to computations, as they
+# also read and write files.
+MODULES = {'cfg': cfg, 'np': np, 'pd': pd}
+MODULE_NAMES = {
+    'cfg': None,
+    'np': {'nan', 'inf', 'isnan', 'isinf', 'isfinite', 'abs', 'absolute', 'sign', 'round',
+           'floor', 'ceil', 'trunc', 'sqrt', 'sum', 'nansum', 'mean', 'nanmean', 'min', 'max',
+           'nanmin', 'nanmax', 'minimum', 'maximum', 'where', 'divide', 'float64', 'int64'},
+    'pd': {'isna', 'isnull', 'notna', 'notnull', 'NA', 'NaT', 'to_numeric'},
+}
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+UNARY_OPERATORS = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_}
+COMPARE_OPERATORS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge, ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b, ast.Is: operator.is_, ast.IsNot: operator.is_not,
+}
+
+
+class CompiledStatement:
+    """
+    Statement compiled to a tree of closures, with names resolved to slots at compile time
+    """
+    __slots__ = ('text', 'names', 'func')
+
+    def __init__(self, text, names, func):
+        self.text = text
+        self.names = names
+        self.func = func
+
+    def __call__(self, context):
+        try:
+            values = [context[name] for name in self.names]
+        except KeyError as err:
+            raise NameError("name '{}' is not defined".format(err.args[0])) from None
+        return self.func(values)
+
+
+def unsupported(node, text):
+    """
+    Build the error for a part of the statement outside of the expression language
+    Parameters:
+        node {AST} - Unsupported node
+        text {String} - Statement
+    Returns:
+        {StatementError} - Error pointing at the unsupported part of the statement
+    """
+    return StatementError('Unsupported {} "{}" at column {} of statement "{}"'.format(
+        type(node).__name__, ast.get_source_segment(text, node), node.col_offset + 1, text))
+
+
+# pylint: disable=too-many-return-statements, too-many-branches, too-many-locals
+def compile_node(node, slots, text):
+    """
+    Compile an AST node of a statement into a closure evaluated over the slot values
+    Parameters:
+        node {AST} - Node to compile
+        slots {Dictionary} - Name to slot index, updated with the names found
+        text {String} - Statement, used in error messages
+    Returns:
+        {Function} - Closure taking the list of slot values
+    """
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return lambda values: value
+
+    if isinstance(node, ast.Name):
+        if node.id in FUNCTIONS:
+            function = FUNCTIONS[node.id]
+            return lambda values: function
+        return operator.itemgetter(slots.setdefault(node.id, len(slots)))
+
+    if hasattr(ast, 'Index') and isinstance(node, ast.Index):  # Python 3.8 index wrapper
+        return compile_node(node.value, slots, text)
+
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Subscript):
+        return compile_cell(node, slots, text)
+
+    if isinstance(node, ast.Subscript):
+        value = compile_node(node.value, slots, text)
+        index = compile_node(node.slice, slots, text)
+        return lambda values: value(values)[index(values)]
+
+    if isinstance(node, ast.Slice):
+        parts = [compile_node(part, slots, text) if part is not None else None
+                 for part in (node.lower, node.upper, node.step)]
+        return lambda values: slice(*[part(values) if part else None for part in parts])
+
+    if isinstance(node, ast.Attribute):
+        return compile_attribute(node, slots, text)
+
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        bin_op = BINARY_OPERATORS[type(node.op)]
+        left = compile_node(node.left, slots, text)
+        right = compile_node(node.right, slots, text)
+        return lambda values: bin_op(left(values), right(values))
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        unary_op = UNARY_OPERATORS[type(node.op)]
+        operand = compile_node(node.operand, slots, text)
+        return lambda values: unary_op(operand(values))
+
+    if isinstance(node, ast.Compare) and \
+            all(type(compare_op) in COMPARE_OPERATORS for compare_op in node.ops):
+        operands = [compile_node(operand, slots, text)
+                    for operand in [node.left] + node.comparators]
+        compare_ops = [COMPARE_OPERATORS[type(compare_op)] for compare_op in node.ops]
+
+        def compare(values):
+            left = operands[0](values)
+            for compare_op, operand in zip(compare_ops, operands[1:]):
+                right = operand(values)
+                if not compare_op(left, right):
+                    return False
+                left = right
+            return True
+        return compare
+
+    if isinstance(node, ast.BoolOp):
+        operands = [compile_node(operand, slots, text) for operand in node.values]
+        if isinstance(node.op, ast.And):
+            def bool_and(values):
+                result = True
+                for operand in operands:
+                    result = operand(values)
+                    if not result:
+                        return result
+                return result
+            return bool_and
+
+        def bool_or(values):
+            result = False
+            for operand in operands:
+                result = operand(values)
+                if result:
+                    return result
+            return result
+        return bool_or
+
+    if isinstance(node, ast.IfExp):
+        test = compile_node(node.test, slots, text)
+        body = compile_node(node.body, slots, text)
+        orelse = compile_node(node.orelse, slots, text)
+        return lambda values: body(values) if test(values) else orelse(values)
+
+    if isinstance(node, ast.List):
+        items = [compile_node(item, slots, text) for item in node.elts]
+        return lambda values: [item(values) for item in items]
+
+    if isinstance(node, ast.Tuple):
+        items = [compile_node(item, slots, text) for item in node.elts]
+        return lambda values: tuple(item(values) for item in items)
+
+    if isinstance(node, ast.Call):
+        return compile_call(node, slots, text)
+
+    raise unsupported(node, text)
+
+
+def compile_attribute(node, slots, text):
+    """
+    Compile an attribute read: available names of MODULES, data frame accessors and date
+        attributes and methods
+    Parameters:
+        node {AST} - Attribute node
+        slots {Dictionary} - Name to slot index, updated with the names found
+        text {String} - Statement, used in error messages
+    Returns:
+        {Function} - Closure taking the list of slot values
+    """
+    attr = node.attr
+    if isinstance(node.value, ast.Name) and node.value.id in MODULES:
+        names = MODULE_NAMES[node.value.id]
+        if attr.startswith('_') or names is not None and attr not in names:
+            raise unsupported(node, text)
+        # Read when evaluated, as configuration values may be overridden between runs
+        module = MODULES[node.value.id]
+        return lambda values: getattr(module, attr)
+
+    value = compile_node(node.value, slots, text)
+    if attr in ATTRIBUTES:
+        getter = operator.attrgetter(attr)
+        return lambda values: getter(value(values))
+    if attr in DATE_ATTRIBUTES:
+        def date_attribute(values):
+            obj = value(values)
+            if not isinstance(obj, date):
+                raise unsupported(node, text)
+            return getattr(obj, attr)
+        return date_attribute
+    raise unsupported(node, text)
+
+
+def compile_call(node, slots, text):
+    """
+    Compile a call of FUNCTIONS, of a function of MODULES or of a date method
+    Parameters:
+        node {AST} - Call node
+        slots {Dictionary} - Name to slot index, updated with the names found
+        text {String} - Statement, used in error messages
+    Returns:
+        {Function} - Closure taking the list of slot values
+    """
+    if not (isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS
+            or isinstance(node.func, ast.Attribute)):
+        raise unsupported(node.func, text)
+    func = compile_node(node.func, slots, text)
+    if any(isinstance(arg, ast.Starred) for arg in node.args) \
+            or any(keyword.arg is None for keyword in node.keywords):
+        raise unsupported(node, text)
+    args = [compile_node(arg, slots, text) for arg in node.args]
+    kwargs = {keyword.arg: compile_node(keyword.value, slots, text)
+              for keyword in node.keywords}
+    # Most calls have one or two positional arguments, avoid building lists for them
+    if not kwargs and len(args) == 1:
+        first = args[0]
+        return lambda values: func(values)(first(values))
+    if not kwargs and len(args) == 2:
+        first, second = args
+        return lambda values: func(values)(first(values), second(values))
+    return lambda values: func(values)(*[arg(values) for arg in args],
+                                       **{name: arg(values) for name, arg in kwargs.items()})
+
+
+def compile_cell(node, slots, text):
+    """
+    Compile a frame[column][row] lookup, reading the cell directly instead of through
+        the column series when the indices are scalars
+    Parameters:
+        node {AST} - Outer subscript node
+        slots {Dictionary} - Name to slot index, updated with the names found
+        text {String} - Statement, used in error messages
+    Returns:
+        {Function} - Closure taking the list of slot values
+    """
+    frame = compile_node(node.value.value, slots, text)
+    column = compile_node(node.value.slice, slots, text)
+    row = compile_node(node.slice, slots, text)
+
+    def cell(values):
+        data_frame = frame(values)
+        col_idx = column(values)
+        row_idx = row(values)
+        if isinstance(data_frame, DataFrame) and not isinstance(col_idx, (list, slice)) \
+                and not isinstance(row_idx, (list, slice)):
+            try:
+                return data_frame.at[row_idx, col_idx]
+            except (KeyError, TypeError, ValueError):
+                pass
+        return data_frame[col_idx][row_idx]
+    return cell
+
+
+def compile_statement(text):
+    """
+    Compile a statement of the expression language
+    Parameters:
+        text {String} - Statement
+    Returns:
+        {CompiledStatement} - Compiled statement, called with the statement context
+    """
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as err:
+        raise StatementError('Invalid syntax at column {} of statement "{}"'.format(
+            err.offset, text)) from None
+    slots = {}
+    func = compile_node(tree.body, slots, text.strip())
+    return CompiledStatement(text, tuple(sorted(slots, key=slots.get)), func)
+
+
+_COMPILED = {}
+_COMPILED_LOCK = Lock()
+# Lookups of the compiled statements, exported with the run metrics
+CACHE_STATS = SimpleNamespace(hits=0, misses=0)
+
+
+def evaluate(text, context):
+    """
+    Evaluate a statement over the context, compiling it on first use
+    Parameters:
+        text {String} - Statement
+        context {Dictionary} - Values of the names used in the statement
+    Returns:
+        Value of the statement
+    """
+    statement = _COMPILED.get(text)
+    if statement is None:
+        CACHE_STATS.misses += 1
+        statement = compile_statement(text)
+        with _COMPILED_LOCK:
+            _COMPILED[text] = statement
+    else:
+        CACHE_STATS.hits += 1
+    return statement(context)
+
+
+def clear_compiled():
+    """
+    Drop the compiled statements, so that the next evaluations compile them again
+    """
+    with _COMPILED_LOCK:
+        _COMPILED.clear()
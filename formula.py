@@ -0,0 +1,538 @@
+""" Evaluate the template formulae supported by the reports before they are stripped """
+
+import operator
+import re
+from decimal import Decimal
+from numbers import Number
+from loguru import logger
+from openpyxl.formula.tokenizer import Tokenizer, Token, TokenizerError
+from openpyxl.utils.cell import column_index_from_string, get_column_letter
+from src.xlsx_writer import is_blank
+
+ERRORS = {'#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#N/A', '#NUM!', '#NULL!'}
+CELL_REF_RE = re.compile(r'^\$?([A-Za-z]{1,3})\$?(\d+)$')
+
+# Infix operators by precedence, comparisons bind the loosest
+PRECEDENCE = {'=': 1, '<>': 1, '<': 1, '>': 1, '<=': 1, '>=': 1, '&': 2, '+': 3, '-': 3,
+              '*': 4, '/': 4, '^': 5}
+
+
+class FormulaError(Exception):
+    """
+    Custom exception for formulae outside of the supported subset
+    """
+
+
+class ExcelError(Exception):
+    """
+    Excel error value raised while evaluating a formula, e.g. #DIV/0!
+    """
+
+
+class RangeValues(list):
+    """
+    Values of a cell range, told apart from single values by the functions
+    """
+
+
+def check_error(value):
+    """
+    Raise the Excel error held by a cell, so that it propagates like in Excel
+    Parameters:
+        value - Cell value
+    Returns:
+        Cell value
+    """
+    if isinstance(value, str) and value in ERRORS:
+        raise ExcelError(value)
+    return value
+
+
+def to_number(value):
+    """
+    Convert a value to a number as Excel arithmetic does
+    Parameters:
+        value - Value of an operand
+    Returns:
+        {Number} - Numeric value, blanks count as zero
+    """
+    check_error(value)
+    if is_blank(value):
+        return 0
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, Number):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ExcelError('#VALUE!') from None
+
+
+def to_text(value):
+    """
+    Convert a value to text as the Excel & operator does
+    Parameters:
+        value - Value of an operand
+    Returns:
+        {String} - Text of the value
+    """
+    check_error(value)
+    if is_blank(value):
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def to_bool(value):
+    """
+    Convert a value to a condition as the Excel IF function does
+    Parameters:
+        value - Value of the condition
+    Returns:
+        {Boolean} - Truth of the condition
+    """
+    check_error(value)
+    if isinstance(value, str) and value.strip():
+        if value.upper() in ('TRUE', 'FALSE'):
+            return value.upper() == 'TRUE'
+        raise ExcelError('#VALUE!')
+    return bool(to_number(value))
+
+
+def compare(compare_op, left, right):
+    """
+    Compare two values as Excel does, numbers sort before text and text before logicals
+    Parameters:
+        compare_op {Function} - Comparison operator
+        left - Left operand
+        right - Right operand
+    Returns:
+        {Boolean} - Result of the comparison
+    """
+    def normalize(value, other):
+        check_error(value)
+        if is_blank(value):
+            if isinstance(other, str) and not is_blank(other):
+                return 1, ''
+            return (2, False) if isinstance(other, bool) else (0, 0)
+        if isinstance(value, bool):
+            return 2, value
+        if isinstance(value, str):
+            return 1, value.lower()
+        return 0, to_number(value)
+    left, right = normalize(left, right), normalize(right, left)
+    if left[0] != right[0]:
+        return compare_op(left[0], right[0])
+    return compare_op(left[1], right[1])
+
+
+def divide(left, right):
+    """
+    Divide as Excel does
+    Parameters:
+        left {Number} - Dividend
+        right {Number} - Divisor
+    Returns:
+        {Number} - Quotient
+    """
+    if right == 0:
+        raise ExcelError('#DIV/0!')
+    return left / right
+
+
+ARITHMETIC = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': divide,
+              '^': operator.pow}
+COMPARISONS = {'=': operator.eq, '<>': operator.ne, '<': operator.lt, '>': operator.gt,
+               '<=': operator.le, '>=': operator.ge}
+
+
+def as_range(value):
+    """
+    Pass the value of a reference as range values
+    Parameters:
+        value - Value of a cell or of a range
+    Returns:
+        {RangeValues} - Values of the range, the value alone for a cell
+    """
+    return value if isinstance(value, RangeValues) else RangeValues([value])
+
+
+def excel_sum(*values):
+    """
+    Excel SUM, text and logicals inside ranges and references are ignored, literals are
+        converted
+    Parameters:
+        values - Arguments of the function, references as RangeValues
+    Returns:
+        {Number} - Sum of the arguments
+    """
+    total = 0
+    for value in values:
+        if isinstance(value, RangeValues):
+            for item in value:
+                check_error(item)
+                if isinstance(item, Number) and not isinstance(item, bool) \
+                        and not is_blank(item):
+                    total += to_number(item)
+        else:
+            total += to_number(value)
+    return total
+
+
+def parse_reference(text, sheet, sheet_names):
+    """
+    Parse a cell or range reference
+    Parameters:
+        text {String} - Reference, optionally prefixed by a sheet name
+        sheet {String} - Sheet of the formula, used when the reference has no sheet
+        sheet_names {Dictionary} - Lower case sheet name to sheet name
+    Returns:
+        {Tuple} - Sheet name, first (row, column) and last (row, column), 1-based
+    """
+    if '!' in text:
+        sheet, text = text.rsplit('!', 1)
+        if sheet.startswith("'"):
+            sheet = sheet[1:-1].replace("''", "'")
+        if sheet.lower() not in sheet_names:
+            raise FormulaError('Unknown sheet in reference {}'.format(text))
+        sheet = sheet_names[sheet.lower()]
+    corners = []
+    for corner in text.split(':'):
+        match = CELL_REF_RE.match(corner)
+        if match is None:
+            raise FormulaError('Unsupported reference {}'.format(text))
+        corners.append((int(match.group(2)), column_index_from_string(match.group(1).upper())))
+    if len(corners) > 2:
+        raise FormulaError('Unsupported reference {}'.format(text))
+    first, last = corners[0], corners[-1]
+    return sheet, (min(first[0], last[0]), min(first[1], last[1])), \
+        (max(first[0], last[0]), max(first[1], last[1]))
+
+
+# pylint: disable=too-few-public-methods
+class FormulaParser:
+    """
+    Compile the tokens of a formula into a closure over a cell getter, collecting the
+        cells the formula depends on
+    """
+
+    def __init__(self, formula, sheet, sheet_names):
+        self.tokens = [token for token in Tokenizer(formula).items
+                       if token.type != Token.WSPACE]
+        self.position = 0
+        self.sheet = sheet
+        self.sheet_names = sheet_names
+        self.references = []
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise FormulaError('Unexpected end of formula')
+        self.position += 1
+        return token
+
+    def compile(self):
+        """
+        Compile the formula
+        Returns:
+            {Function} - Closure taking the cell getter and returning the formula value
+        """
+        func = self._expression(1)
+        if self._peek() is not None:
+            raise FormulaError('Unexpected {}'.format(self._peek().value))
+        return func
+
+    def _expression(self, min_precedence):
+        left = self._unary()
+        token = self._peek()
+        while token is not None and token.type == Token.OP_IN \
+                and PRECEDENCE.get(token.value, 0) >= min_precedence:
+            self._next()
+            right = self._expression(PRECEDENCE[token.value] + 1)
+            left = self._infix(token.value, left, right)
+            token = self._peek()
+        return left
+
+    @staticmethod
+    def _infix(symbol, left, right):
+        if symbol in ARITHMETIC:
+            arithmetic_op = ARITHMETIC[symbol]
+            return lambda get: arithmetic_op(to_number(left(get)), to_number(right(get)))
+        if symbol in COMPARISONS:
+            compare_op = COMPARISONS[symbol]
+            return lambda get: compare(compare_op, left(get), right(get))
+        if symbol == '&':
+            return lambda get: to_text(left(get)) + to_text(right(get))
+        raise FormulaError('Unsupported operator {}'.format(symbol))
+
+    def _unary(self):
+        token = self._peek()
+        if token is not None and token.type == Token.OP_PRE:
+            self._next()
+            operand = self._unary()
+            if token.value == '-':
+                return lambda get: -to_number(operand(get))
+            return lambda get: to_number(operand(get))
+        operand = self._primary()
+        while self._peek() is not None and self._peek().type == Token.OP_POST:
+            self._next()
+            operand = (lambda value: lambda get: to_number(value(get)) / 100)(operand)
+        return operand
+
+    def _primary(self):
+        token = self._next()
+        if token.type == Token.OPERAND:
+            return self._operand(token)
+        if token.type == Token.PAREN and token.subtype == Token.OPEN:
+            func = self._expression(1)
+            if self._next().type != Token.PAREN:
+                raise FormulaError('Unbalanced parentheses')
+            return func
+        if token.type == Token.FUNC and token.subtype == Token.OPEN:
+            return self._function(token.value[:-1].upper())
+        raise FormulaError('Unexpected {}'.format(token.value))
+
+    def _operand(self, token):
+        if token.subtype == Token.NUMBER:
+            value = float(token.value)
+            value = int(value) if value.is_integer() and '.' not in token.value else value
+            return lambda get: value
+        if token.subtype == Token.TEXT:
+            text = token.value[1:-1].replace('""', '"')
+            return lambda get: text
+        if token.subtype == Token.LOGICAL:
+            logical = token.value.upper() == 'TRUE'
+            return lambda get: logical
+        if token.subtype == Token.ERROR:
+            error = token.value
+
+            def raise_error(get):
+                raise ExcelError(error)
+            return raise_error
+        sheet, first, last = parse_reference(token.value, self.sheet, self.sheet_names)
+        if first == last:
+            self.references.append((sheet, first))
+            return lambda get: get(sheet, first)
+        cells = [(row, col) for row in range(first[0], last[0] + 1)
+                 for col in range(first[1], last[1] + 1)]
+        self.references.extend((sheet, cell) for cell in cells)
+        return lambda get: RangeValues(get(sheet, cell) for cell in cells)
+
+    def _function(self, name):
+        args = []
+        if self._peek() is not None and self._peek().type == Token.FUNC \
+                and self._peek().subtype == Token.CLOSE:
+            self._next()
+        else:
+            while True:
+                start = self.position
+                arg = self._expression(1)
+                if name == 'SUM' and self.position == start + 1 \
+                        and self.tokens[start].subtype == Token.RANGE:
+                    # A cell reference is summed as a range, ignoring text and logicals
+                    arg = (lambda value: lambda get: as_range(value(get)))(arg)
+                args.append(arg)
+                token = self._next()
+                if token.type == Token.FUNC and token.subtype == Token.CLOSE:
+                    break
+                if token.type != Token.SEP or token.subtype != Token.ARG:
+                    raise FormulaError('Unexpected {}'.format(token.value))
+
+        if name == 'SUM':
+            return lambda get: excel_sum(*[arg(get) for arg in args])
+        if name == 'IF' and len(args) in (2, 3):
+            test, body = args[0], args[1]
+            orelse = args[2] if len(args) == 3 else (lambda get: False)
+            return lambda get: body(get) if to_bool(test(get)) else orelse(get)
+        if name == 'IFERROR' and len(args) == 2:
+            value, fallback = args
+
+            def iferror(get):
+                try:
+                    result = value(get)
+                except ExcelError:
+                    return fallback(get)
+                if isinstance(result, str) and result in ERRORS:
+                    return fallback(get)
+                return result
+            return iferror
+        raise FormulaError('Unsupported function {}'.format(name))
+
+
+def compile_formula(formula, sheet, sheet_names):
+    """
+    Compile a formula of the supported subset
+    Parameters:
+        formula {String} - Formula starting with =
+        sheet {String} - Sheet holding the formula
+        sheet_names {Dictionary} - Lower case sheet name to sheet name
+    Returns:
+        {Tuple} - Closure taking the cell getter and the list of referenced (sheet, cell)
+    """
+    try:
+        parser = FormulaParser(formula, sheet, sheet_names)
+    except TokenizerError as err_message:
+        raise FormulaError(str(err_message)) from None
+    return parser.compile(), parser.references
+
+
+def order_formulae(dependencies):
+    """
+    Order the formula cells so that every cell comes after the formula cells it depends on
+    Parameters:
+        dependencies {Dictionary} - Formula cell to the formula cells it references, None for
+            formulae which could not be compiled
+    Returns:
+        {Tuple} - Ordered cells which can be evaluated and the set of cells which can not,
+            because they are part of a cycle or depend on an unsupported formula
+    """
+    blocked = {cell for cell, cells in dependencies.items() if cells is None}
+    order = []
+    state = {}
+    for start in dependencies:
+        if start in state or start in blocked:
+            continue
+        state[start] = 'visiting'
+        stack = [(start, iter(dependencies[start]))]
+        while stack:
+            cell, children = stack[-1]
+            for child in children:
+                if child in blocked:
+                    continue
+                if child not in state:
+                    state[child] = 'visiting'
+                    stack.append((child, iter(dependencies[child])))
+                    break
+                if state[child] == 'visiting':
+                    blocked.add(cell)
+            else:
+                stack.pop()
+                state[cell] = 'done'
+                if any(child in blocked for child in dependencies[cell]):
+                    blocked.add(cell)
+                if cell not in blocked:
+                    order.append(cell)
+    return [cell for cell in order if cell not in blocked], blocked
+
+
+# pylint: disable=too-many-locals
+def calculate(formulas, values, fixed_cells=None):
+    """
+    Evaluate the supported formulae in dependency order
+    Parameters:
+        formulas {Dictionary} - Sheet name to (row, column) to formula, 1-based
+        values {Dictionary} - Sheet name to (row, column) to constant value, 1-based
+        fixed_cells {Dictionary} - Sheet name to set of (row, column) whose value was set by
+            the mapping, their formulae are not evaluated
+    Returns:
+        {Dictionary} - Sheet name to (row, column) to evaluated value
+    """
+    fixed_cells = fixed_cells or {}
+    sheet_names = {sheet.lower(): sheet for sheet in set(formulas) | set(values)}
+    compiled = {}
+    dependencies = {}
+    for sheet, sheet_formulas in formulas.items():
+        for cell, formula in sheet_formulas.items():
+            if cell not in fixed_cells.get(sheet, ()):
+                dependencies[(sheet, cell)] = None
+    for (sheet, cell) in list(dependencies):
+        try:
+            compiled[(sheet, cell)], references = compile_formula(
+                formulas[sheet][cell], sheet, sheet_names)
+        except FormulaError as err_message:
+            logger.debug("Formula {} in {}!{}{} is not evaluated: {}".format(
+                formulas[sheet][cell], sheet, get_column_letter(cell[1]), cell[0], err_message))
+            continue
+        dependencies[(sheet, cell)] = [reference for reference in references
+                                       if reference in dependencies]
+
+    order, blocked = order_formulae(dependencies)
+    results = {}
+
+    def get(sheet, cell):
+        if (sheet, cell) in results:
+            return results[(sheet, cell)]
+        return values.get(sheet, {}).get(cell)
+
+    for key in order:
+        try:
+            value = compiled[key](get)
+            if isinstance(value, RangeValues):
+                raise ExcelError('#VALUE!')
+        except ExcelError as err:
+            value = err.args[0]
+        except (ArithmeticError, TypeError):
+            value = '#NUM!'
+        results[key] = 0 if value is None else value
+
+    if dependencies:
+        logger.info("Evaluated {} of {} formulae, {} left to be stripped".format(
+            len(results), len(dependencies), len(blocked)))
+    calculated = {}
+    for (sheet, cell), value in results.items():
+        calculated.setdefault(sheet, {})[cell] = value
+    return calculated
+
+
+def get_workbook_cells(workbook):
+    """
+    Split the cells of a workbook loaded with formulae into formulae and constant values
+    Parameters:
+        workbook {Workbook} - Workbook loaded without data_only
+    Returns:
+        {Tuple} - Formulae and values, each sheet name to (row, column) to content
+    """
+    formulas = {}
+    values = {}
+    for sheet in workbook.worksheets:
+        sheet_formulas = formulas.setdefault(sheet.title, {})
+        sheet_values = values.setdefault(sheet.title, {})
+        for row in sheet.iter_rows():
+            for cell in row:
+                value = cell.value
+                if value is None:
+                    continue
+                if isinstance(value, str) and value.startswith('='):
+                    sheet_formulas[(cell.row, cell.column)] = value
+                elif isinstance(value, (str, Number, bool)):
+                    sheet_values[(cell.row, cell.column)] = value
+    return formulas, values
+
+
+def get_frame_cells(data_frame):
+    """
+    Get the non-blank values of a sheet data frame
+    Parameters:
+        data_frame {DataFrame} - Values of the sheet without metadata
+    Returns:
+        {Dictionary} - (row, column) to value, 1-based
+    """
+    return {(r_idx + 1, c_idx + 1): value
+            for r_idx, row in enumerate(data_frame.itertuples(index=False))
+            for c_idx, value in enumerate(row) if not is_blank(value)}
+
+
+def evaluate_workbook_formulas(workbook, sheet_frames=None, fixed_cells=None):
+    """
+    Evaluate the supported formulae of a workbook, with the values of the generated sheets
+        taken from their data frames
+    Parameters:
+        workbook {Workbook} - Template workbook loaded without data_only
+        sheet_frames {Dictionary} - Sheet name to generated values without metadata
+        fixed_cells {Dictionary} - Sheet name to set of (row, column) set by the mapping
+    Returns:
+        {Dictionary} - Sheet name to (row, column) to evaluated value, 1-based
+    """
+    formulas, values = get_workbook_cells(workbook)
+    for sheet, data_frame in (sheet_frames or {}).items():
+        values[sheet] = get_frame_cells(data_frame)
+    return calculate(formulas, values, fixed_cells)
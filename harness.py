@@ -0,0 +1,393 @@
+""" Differential harness running the batch under two engine configurations on the same inputs """
+
+import csv
+import os
+import random
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal
+from itertools import zip_longest
+from math import isclose
+from numbers import Number
+from tempfile import mkdtemp
+from time import perf_counter
+from zipfile import ZipFile, ZIP_DEFLATED
+from loguru import logger
+from openpyxl import Workbook, load_workbook
+from openpyxl.utils.cell import get_column_letter
+from src.alias_cache import ALIAS_CACHE
+from src.batch import run_pipeline
+from src.expression import clear_compiled
+from src.helper import get_prev_mth
+from src.memory import MemoryMonitor, MB, current_rss
+from src.report_generator import RULES_CACHE, get_country_files, get_exp_mapping_file
+from src.xlsx_writer import get_sheet_parts, is_blank
+import config as cfg
+
+# Configuration overrides of the engine modes which can be compared
+ENGINE_MODES = {
+    'eval': {'STATEMENT_ENGINE': 'eval'},
+    'vm': {'STATEMENT_ENGINE': 'vm'},
+    'openpyxl': {'OUTPUT_WRITER': 'openpyxl'},
+    'xml': {'OUTPUT_WRITER': 'xml'},
+    'formulas': {'EVALUATE_FORMULAS': True},
+    'reader_openpyxl': {'READER_BACKEND': 'openpyxl'},
+    'reader_fast': {'READER_BACKEND': 'fast'},
+    # Countries after the first reuse the alias positions of the countries before them
+    'alias_cache': {'ALIAS_CACHE_FILE': './logs/harness_alias_positions.json'},
+    # Run with the aggregates and all their members, e.g. SEA&FM and its seven countries
+    'rollup': {'ROLLUP_COUNTRIES': cfg.ROLLUP_COUNTRIES},
+    # The report of the previous month is generated first, the number of periods is the one of
+    # the synthetic inputs
+    'trend': {'TREND_TABS': {'Exp': ('c_p1', 12, {'Input': 'c_p1'})}},
+}
+
+# Runs of the harness do not touch checkpoints, timings or metrics of production runs, and
+# the alias cache, rollups and trends are compared by their own modes
+HARNESS_CONFIG = {'CHECKPOINT_ENABLED': False, 'METRICS_FILE': None,
+                  'TIMINGS_FILE': './logs/harness_timings.json', 'EXPORT_FORMAT': None,
+                  'ALIAS_CACHE_FILE': None, 'ROLLUP_COUNTRIES': {}, 'TREND_TABS': {}}
+
+
+@contextmanager
+def override_config(overrides):
+    """
+    Set configuration values for the duration of the block
+    Parameters:
+        overrides {Dictionary} - Configuration name to value
+    """
+    saved = {name: getattr(cfg, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(cfg, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(cfg, name, value)
+
+
+@contextmanager
+def working_directory(directory):
+    """
+    Run the block from the directory, the mapping paths of the configuration are relative
+    Parameters:
+        directory {String} - Working directory of the block
+    """
+    previous = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def write_rules(file_name, header, rows):
+    """
+    Write an alias or mapping file
+    Parameters:
+        file_name {String} - Path of the file
+        header {List} - Column names
+        rows {List} - Rows of the file
+    """
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w', newline='') as rules_file:
+        writer = csv.writer(rules_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def add_values(values):
+    """
+    Add the values of the same cell of several inputs, as the input of an aggregate holds the
+        sums of its members
+    Parameters:
+        values {List} - Cell values, numbers, numbers stored as text or None
+    Returns:
+        {Float} - Sum of the values, None if all are missing
+    """
+    numbers = [float(value) for value in values if value is not None]
+    return round(sum(numbers), 2) if numbers else None
+
+
+def add_cached_values(file_name, sheet_name, value):
+    """
+    Store a value for the formulas of a sheet as Excel caches it, openpyxl saves formulas
+        without their values
+    Parameters:
+        file_name {String} - Path of the workbook
+        sheet_name {String} - Sheet with the formulas
+        value {Number} - Cached value of the formulas
+    """
+    with ZipFile(file_name) as zip_file:
+        part_name = get_sheet_parts(zip_file)[sheet_name]
+        parts = [(info, zip_file.read(info)) for info in zip_file.infolist()]
+    with ZipFile(file_name, 'w', ZIP_DEFLATED) as zip_file:
+        for info, data in parts:
+            if info.filename == part_name:
+                data = re.sub(rb'(<f>[^<]*</f>)(?:<v\s*/>|<v>[^<]*</v>)?',
+                              rb'\1<v>' + str(value).encode() + rb'</v>', data)
+            zip_file.writestr(info, data)
+
+
+# pylint: disable=too-many-locals, too-many-arguments, too-many-branches, too-many-statements
+def make_synthetic_inputs(directory, countries, rows=200, periods=12, seed=0, rollups=None,
+                          months=1, duplicates=False):
+    """
+    Write synthetic country input files with matching alias and mapping files, so that the
+        harness runs without production inputs. The mapping reads the inputs, the tab itself,
+        a statement alias, the COB dates and the configuration, and the Exp sheet has a formula
+        with a cached value.
+    Parameters:
+        directory {String} - Directory the inputs are written to
+        countries {List} - Countries to write input files for
+        rows {Integer} - Number of line items of the sheets
+        periods {Integer} - Number of period columns of the sheets
+        seed {Integer} - Seed of the generated values
+        rollups {Dictionary} - Aggregate to its members, the inputs of an aggregate whose
+            members are all in the countries are the sums of their inputs
+        months {Integer} - Number of months of inputs up to the COB date, each month rolls the
+            periods by one and the last one restates a value of an old period
+        duplicates {Boolean} - Note the keyword of the third line on the first line of all but
+            the first country not in a rollup, so that the alias positions differ between
+            sheets of the same layout
+    Returns:
+        {Dictionary} - Configuration overrides pointing at the synthetic inputs
+    """
+    rand = random.Random(seed)
+    cob_dates = [datetime(2021, 3, 15)]
+    for _ in range(months - 1):
+        cob_dates.insert(0, get_prev_mth(cob_dates[0]))
+    labels = ['P{:02}'.format(period) for period in range(1, periods + 1)]
+    items = ['Line {}'.format(item) for item in range(1, rows + 1)]
+    rollups = {country: members for country, members in (rollups or {}).items()
+               if country in countries and set(members) <= set(countries)}
+    os.makedirs(os.path.join(directory, cfg.INPUT_DIR), exist_ok=True)
+    os.makedirs(os.path.join(directory, cfg.OUTPUT_DIR), exist_ok=True)
+
+    alias_rows = [['r_l{}'.format(item), r'\|Line {}\|'.format(item), '', 0, '']
+                  for item in range(1, rows + 1)]
+    alias_rows += [['c_p{}'.format(period), r'\|{}\|'.format(label), '', 0, '']
+                   for period, label in enumerate(labels, 1)]
+    header = ['Alias', 'Keyword', 'start row/col', 'offset', 'statement']
+    write_rules(os.path.join(directory, cfg.ALIAS_FILE_INPUT), header, alias_rows)
+    write_rules(os.path.join(directory, cfg.ALIAS_FILE_EXP), header, alias_rows + [
+        ['r_tot', r'\|Total\|', '', 0, ''], ['r_ratio', r'\|Ratio\|', '', 0, ''],
+        ['r_top', r'\|Top\|', '', 0, ''], ['r_latest', r'\|Latest\|', '', 0, ''],
+        ['r_month', r'\|Month\|', '', 0, ''], ['r_name', r'\|Name\|', '', 0, ''],
+        ['s_top', '', '', '', 'cell_sum([input_source[c_p1][r_l1], input_source[c_p1][r_l2]])']])
+
+    mapping_rows = [['r_l1', 'c_p1', 'input_source[c_p1][r_l1]', rows, periods]]
+    for period in range(1, periods + 1):
+        column = 'c_p{}'.format(period)
+        cells = ', '.join('input_source[{}][r_l{}]'.format(column, item)
+                          for item in range(1, rows + 1))
+        mapping_rows.append(['r_tot', column, 'cell_sum([{}])'.format(cells), 1, 1])
+        mapping_rows.append(['r_ratio', column, 'cell_div(exp_source[{0}][r_l1], '
+                             'exp_source[{0}][r_l2])'.format(column), 1, 1])
+        mapping_rows.append(['r_latest', column,
+                             'input_source[c_p{}][r_l1]'.format(periods), 1, 1])
+    mapping_rows += [['r_top', 'c_p1', 's_top', 1, 1],
+                     ['r_month', 'c_p1', 'cob_date.month', 1, periods],
+                     ['r_name', 'c_p1', 'cfg.COUNTRY_NAMES[country]', 1, 1],
+                     ['r_name', 'c_p{}'.format(periods), "prev_month.strftime('%b-%y')", 1, 1]]
+    for country in countries:
+        write_rules(os.path.join(directory, get_exp_mapping_file(country)),
+                    ['row_id', 'col_id', 'statement', 'affected_rows', 'affected_cols'],
+                    mapping_rows)
+
+    # Values of each country and month, the months are windows on one series of periods
+    values = {}
+    for country in countries:
+        if country in rollups:
+            continue
+        # Some values are missing or stored as text, as in the production inputs
+        series = [[None if rand.random() < 0.05 else
+                   str(rand.randint(0, 999)) if rand.random() < 0.05 else
+                   round(rand.uniform(-1e6, 1e6), 2) for _ in range(periods + months - 1)]
+                  for _ in items]
+        values[country] = [[line[month:month + periods] for line in series]
+                           for month in range(months)]
+        if months > 1 and periods > 2:
+            values[country][-1][0][1] = round(rand.uniform(-1e6, 1e6), 2)
+    for country, members in rollups.items():
+        values[country] = [[[add_values(cells) for cells in zip(*lines)]
+                            for lines in zip(*[values[member][month] for member in members])]
+                           for month in range(months)]
+    members = {member for rollup in rollups.values() for member in rollup}
+    noted = [country for country in countries
+             if country not in rollups and country not in members][1:] if duplicates else []
+
+    for country in countries:
+        for month, cob_date in enumerate(cob_dates):
+            workbook = Workbook()
+            input_sheet = workbook.active
+            input_sheet.title = 'Input'
+            input_sheet.append(['Item'] + labels + (['Note'] if duplicates else []))
+            for idx, item in enumerate(items):
+                note = [items[2] if idx == 0 and country in noted and rows > 2 else None]
+                input_sheet.append([item] + values[country][month][idx]
+                                   + (note if duplicates else []))
+            exp_sheet = workbook.create_sheet('Exp')
+            exp_sheet.append(['Item'] + labels)
+            for item in items + ['Total', 'Ratio', 'Top', 'Latest', 'Month', 'Name']:
+                exp_sheet.append([item])
+            exp_sheet.append(['Check'] + ['=B{0}-SUM(B2:B{1})'.format(rows + 2, rows + 1)])
+            input_file = os.path.join(directory, get_country_files(country, cob_date)[0])
+            workbook.save(input_file)
+            # The tab of the input file is empty, so the check is 0
+            add_cached_values(input_file, 'Exp', 0)
+
+    return {
+        'COUNTRY_DATE': cob_dates[-1].strftime('%d-%b-%Y'),
+        'EXP_ALIAS_SOURCES': {cfg.ALIAS_FILE_INPUT: 'Input', cfg.ALIAS_FILE_EXP: 'Exp'},
+    }
+
+
+def is_equal(left, right, rel_tol, abs_tol):
+    """
+    Compare two cell values, numbers of any type within the tolerances
+    Parameters:
+        left - Value of the baseline cell
+        right - Value of the candidate cell
+        rel_tol {Float} - Relative tolerance of numbers
+        abs_tol {Float} - Absolute tolerance of numbers
+    Returns:
+        {Boolean} - True if the values match
+    """
+    if is_blank(left) or is_blank(right):
+        return is_blank(left) and is_blank(right)
+    if isinstance(left, (Number, Decimal)) and isinstance(right, (Number, Decimal)) \
+            and not isinstance(left, bool) and not isinstance(right, bool):
+        return isclose(float(left), float(right), rel_tol=rel_tol, abs_tol=abs_tol)
+    return type(left) is type(right) and left == right
+
+
+def compare_workbooks(baseline_file, candidate_file, rel_tol=1e-9, abs_tol=1e-9):
+    """
+    Compare two workbooks cell by cell, streaming the rows of both
+    Parameters:
+        baseline_file {String} - Path of the baseline workbook
+        candidate_file {String} - Path of the candidate workbook
+        rel_tol {Float} - Relative tolerance of numbers
+        abs_tol {Float} - Absolute tolerance of numbers
+    Returns:
+        {Generator} - Differences as (sheet, cell reference, baseline value, candidate value)
+    """
+    baseline = load_workbook(baseline_file, read_only=True, data_only=True)
+    candidate = load_workbook(candidate_file, read_only=True, data_only=True)
+    try:
+        for sheet in sorted(set(baseline.sheetnames) | set(candidate.sheetnames)):
+            if sheet not in baseline.sheetnames or sheet not in candidate.sheetnames:
+                yield sheet, None, sheet in baseline.sheetnames, sheet in candidate.sheetnames
+                continue
+            for r_idx, (left_row, right_row) in enumerate(zip_longest(
+                    baseline[sheet].iter_rows(values_only=True),
+                    candidate[sheet].iter_rows(values_only=True), fillvalue=()), 1):
+                for c_idx, (left, right) in enumerate(zip_longest(left_row, right_row), 1):
+                    if not is_equal(left, right, rel_tol, abs_tol):
+                        yield sheet, '{}{}'.format(get_column_letter(c_idx), r_idx), left, right
+    finally:
+        baseline.close()
+        candidate.close()
+
+
+def run_mode(name, overrides, countries):
+    """
+    Generate the reports of the countries under an engine configuration
+    Parameters:
+        name {String} - Name of the mode, used as output directory
+        overrides {Dictionary} - Configuration overrides of the mode
+        countries {List} - Countries to generate reports for
+    Returns:
+        {Dictionary} - Duration, memory, failures and output files of the run
+    """
+    output_dir = os.path.join(cfg.OUTPUT_DIR, name) + '/'
+    os.makedirs(output_dir, exist_ok=True)
+    with override_config(dict(overrides, OUTPUT_DIR=output_dir)):
+        if cfg.TREND_TABS:
+            # Trends roll the report of the previous month, which is not timed
+            previous = get_prev_mth(datetime.strptime(cfg.COUNTRY_DATE, '%d-%b-%Y'))
+            with override_config({'COUNTRY_DATE': previous.strftime('%d-%b-%Y')}):
+                run_pipeline(countries)
+        # Each mode starts cold, so that the timings compare like for like
+        clear_compiled()
+        RULES_CACHE.clear()
+        ALIAS_CACHE.clear()
+        monitor = MemoryMonitor().start()
+        rss_before = current_rss()
+        started = perf_counter()
+        with monitor.phase(name):
+            failures = run_pipeline(countries)
+        duration = perf_counter() - started
+        monitor.stop()
+        cob_date = datetime.strptime(cfg.COUNTRY_DATE, '%d-%b-%Y')
+        outputs = {country: get_country_files(country, cob_date)[1] for country in countries}
+    return {'duration': duration, 'memory_mb': (monitor.peaks.get(name, 0) - rss_before) / MB,
+            'failures': failures, 'outputs': outputs}
+
+
+# pylint: disable=too-many-arguments
+def run_harness(countries, baseline='eval', candidate='vm', directory=None, rows=200,
+                periods=12, max_differences=20):
+    """
+    Generate the reports of the countries under the baseline and the candidate engine modes
+        and compare the workbooks. Without a directory synthetic inputs are generated for
+        what the modes turn on, with one its input and mapping files are used.
+    Parameters:
+        countries {List} - Countries to generate reports for
+        baseline {String/Dictionary} - Name in ENGINE_MODES or configuration overrides
+        candidate {String/Dictionary} - Name in ENGINE_MODES or configuration overrides
+        directory {String} - Directory with the inputs and mappings, None for synthetic inputs
+        rows {Integer} - Number of line items of the synthetic inputs
+        periods {Integer} - Number of period columns of the synthetic inputs
+        max_differences {Integer} - Number of differences logged per country
+    Returns:
+        {Dictionary} - Results of both modes and the differences per country
+    """
+    modes = {name: dict(ENGINE_MODES[mode] if isinstance(mode, str) else mode)
+             for name, mode in (('baseline', baseline), ('candidate', candidate))}
+    overrides = dict(HARNESS_CONFIG)
+    if directory is None:
+        directory = mkdtemp(prefix='harness_')
+        rollups = {}
+        for mode in modes.values():
+            rollups.update(mode.get('ROLLUP_COUNTRIES') or {})
+            if mode.get('TREND_TABS'):
+                mode['TREND_TABS'] = {'Exp': ('c_p1', periods, {'Input': 'c_p1'})}
+        overrides.update(make_synthetic_inputs(
+            directory, countries, rows, periods, rollups=rollups,
+            months=2 if any(mode.get('TREND_TABS') for mode in modes.values()) else 1,
+            duplicates=any(mode.get('ALIAS_CACHE_FILE') for mode in modes.values())))
+
+    results = {}
+    with working_directory(directory), override_config(overrides):
+        for name, mode in modes.items():
+            results[name] = run_mode(name, mode, countries)
+
+        differences = {}
+        for country in countries:
+            files = [results[name]['outputs'][country] for name in modes]
+            if not all(os.path.isfile(file_name) for file_name in files):
+                differences[country] = None
+                continue
+            differences[country] = []
+            for difference in compare_workbooks(*files):
+                differences[country].append(difference)
+                if len(differences[country]) >= max_differences:
+                    break
+
+    for name in modes:
+        logger.info("{}: {:.2f}s, {:.1f} MB, {} failed".format(
+            name, results[name]['duration'], results[name]['memory_mb'],
+            len(results[name]['failures'])))
+    for country, country_differences in differences.items():
+        if country_differences is None:
+            logger.error("{}: report missing in one of the modes".format(country))
+        elif country_differences:
+            logger.error("{}: workbooks differ".format(country))
+            for sheet, cell, left, right in country_differences:
+                logger.error("  {} {}: {!r} != {!r}".format(sheet, cell, left, right))
+        else:
+            logger.info("{}: workbooks match".format(country))
+    return {'results': results, 'differences': differences, 'directory': directory}
@@ -6,13 +6,17 @@ from datetime import datetime
 from decimal import Decimal
 
 from pandas import DataFrame, Series
-from openpyxl import load_workbook
-from openpyxl.utils.dataframe import dataframe_to_rows  # pylint:disable=unused-import
 from loguru import logger
 import numpy as np
 
 import config as cfg
 import src.excel_helper as excel_helper
+from src.rules import get_rules
+from src.zip_writer import recompress
+
+# openpyxl and the readers built on it are imported by the functions reading and writing
+# workbooks, as openpyxl is slow to import
+# pylint: disable=import-outside-toplevel
 
 
 class MissingValueError(Exception):
@@ -21,7 +25,8 @@ class MissingValueError(Exception):
     """
 
 
-def read_sheet(file_name, sheet_names, is_header_present=False, is_read_only=False, is_data_only=True):
+def read_sheet(file_name, sheet_names, is_header_present=False, is_read_only=False,
+               is_data_only=True, trim_sheets=()):
     """
     Function to read the excel sheet
     Parameters:
@@ -29,35 +34,186 @@ def read_sheet(file_name, sheet_names, is_header_present=False, is_read_only=Fal
         sheet_names - One sheet or a list of sheets which need to be read from excel file
         is_header_present - Is the first row column of the data
         is_read_only - Should the file be opened in read only mode
+        trim_sheets - Sheets whose trailing empty rows and columns are dropped
     Returns:
         Data frame with values read from sheet
     """
+    from src.xlsx_reader import open_reader
+
     data_dict = {}
-    workbook = load_workbook(file_name, read_only=is_read_only, data_only=is_data_only)
+    reader = open_reader(file_name, is_read_only, is_data_only)
 
     if isinstance(sheet_names, str):
         if sheet_names.lower() == 'all':
-            sheet_names = workbook.sheetnames
+            sheet_names = reader.sheetnames
         else:
             sheet_names = [sheet_names]
 
     for sheet_name in sheet_names:
-        if sheet_name not in workbook.sheetnames:
+        if sheet_name not in reader.sheetnames:
             logger.error("Sheet {} not found in {}".format(sheet_name, file_name))
             exit(-1)
-        data = DataFrame(workbook[sheet_name].values)
+        data = DataFrame(reader.values(sheet_name, trim=sheet_name in trim_sheets))
         if is_header_present:
             headers = data.iloc[0]
             data = data[1:]
             data.rename(columns=headers, inplace=True)
         data_dict[sheet_name] = data
 
+    reader.close()
+
     if len(sheet_names) == 1:
         return data_dict[sheet_names[0]]
 
     return data_dict
 
 
+def trim_rows(rows):
+    """
+    Drop the trailing empty rows and columns from the rows of a sheet
+    Parameters:
+        rows - Iterable of row value tuples
+    Returns:
+        List of row value tuples covering the used band of the sheet
+    """
+    band = []
+    last_row = 0
+    last_col = 0
+    for row in rows:
+        band.append(row)
+        used_cols = [idx for idx, value in enumerate(row) if value not in (None, '')]
+        if used_cols:
+            last_row = len(band)
+            last_col = max(last_col, used_cols[-1] + 1)
+    return [row[:last_col] for row in band[:last_row]]
+
+
+def get_alias_suffix(alias_file):
+    """
+    Get the suffix added to alias names read from the given alias file
+    Parameters:
+        alias_file (String) - Path of the alias file
+    Returns:
+        Alias suffix, which is also the prefix of the frame in statements (e.g. pb)
+    """
+    return alias_file[20:-4]
+
+
+def get_statement_frames(statement):
+    """
+    Find the frame prefixes referenced in the given statement
+    Parameters:
+        statement (String)
+    Returns:
+        Set of frame prefixes (e.g. {'input', 'pb'} for input_source and pb_source)
+    """
+    return {match[0] for match in re.findall(
+        r"([a-z_]+?)({})\b".format('|'.join(cfg.FRAME_SUFFIXES)), str(statement))}
+
+
+def get_alias_sheets(alias_sources):
+    """
+    Map the alias names of the alias files to the sheets their aliases are resolved against
+    Parameters:
+        alias_sources - Dictionary of alias file to the sheet its aliases are resolved against
+    Returns:
+        Tuple of the alias name as used in statements (row and column aliases with the suffix
+            of their file) to its sheets, and of the row and column alias name without suffix
+            to its sheets, as row_id and col_id get the suffix of the mapped tab
+    """
+    sheets_by_name = {}
+    sheets_by_base = {}
+    for alias_file, sheet in alias_sources.items():
+        suffix = get_alias_suffix(alias_file)
+        for _, row in get_rules(alias_file):
+            alias = row['Alias']
+            if not alias or alias[0] == '#':
+                continue
+            if alias[0] in 'rc':
+                sheets_by_name.setdefault(alias + suffix, set()).add(sheet)
+                sheets_by_base.setdefault(alias, set()).add(sheet)
+            else:
+                sheets_by_name.setdefault(alias, set()).add(sheet)
+    return sheets_by_name, sheets_by_base
+
+
+def get_statement_sheets(statement, sheet_by_prefix, sheets_by_name):
+    """
+    Find the sheets a statement reads, through its frames and the aliases it names
+    Parameters:
+        statement (String)
+        sheet_by_prefix - Dictionary of frame prefix to sheet
+        sheets_by_name - Dictionary of alias name as used in statements to its sheets
+    Returns:
+        Set of sheet names
+    """
+    sheets = {sheet_by_prefix[prefix] for prefix in get_statement_frames(statement)
+              if prefix in sheet_by_prefix}
+    for name in re.findall(r'[A-Za-z_]\w*', str(statement)):
+        sheets |= sheets_by_name.get(name, set())
+    return sheets
+
+
+def get_referenced_sheets(mapping_files, alias_sources, required_sheets=()):
+    """
+    Statically analyse mapping and alias files to find the sheets they reference, through
+        frames and through the aliases named in statements, row_id and col_id
+    Parameters:
+        mapping_files - List of mapping files
+        alias_sources - Dictionary of alias file to the sheet its aliases are resolved against
+        required_sheets - Sheets which are always needed (e.g. the destination tab)
+    Returns:
+        Set of sheet names which need to be loaded
+    """
+    sheet_by_prefix = {get_alias_suffix(alias_file): sheet
+                       for alias_file, sheet in alias_sources.items()}
+    sheets_by_name, sheets_by_base = get_alias_sheets(alias_sources)
+    sheets = set(required_sheets)
+    for mapping_file in mapping_files:
+        for _, row in get_rules(mapping_file):
+            if row['statement']:
+                sheets |= get_statement_sheets(row['statement'], sheet_by_prefix, sheets_by_name)
+            for alias in (row['row_id'], row['col_id']):
+                alias = re.split(r'[+-]', str(alias))[0].strip()
+                sheets |= sheets_by_name.get(alias, set()) | sheets_by_base.get(alias, set())
+
+    # Statements in the alias files of referenced sheets may pull in further sheets
+    pending = set(sheets)
+    while pending:
+        sheet = pending.pop()
+        for alias_file, alias_sheet in alias_sources.items():
+            if alias_sheet != sheet:
+                continue
+            for _, row in get_rules(alias_file):
+                if not row['statement']:
+                    continue
+                found = get_statement_sheets(row['statement'], sheet_by_prefix, sheets_by_name)
+                pending |= found - sheets
+                sheets |= found
+
+    return sheets
+
+
+def load_referenced_sheets(file_name, mapping_files, alias_sources, required_sheets=()):
+    """
+    Load only the sheets referenced by the mapping and alias files, streaming them in
+        read only mode. Sheets which are only read from are trimmed to their used band.
+    Parameters:
+        file_name - Excel file name
+        mapping_files - List of mapping files
+        alias_sources - Dictionary of alias file to the sheet its aliases are resolved against
+        required_sheets - Sheets which are always needed and kept at full size
+    Returns:
+        Dictionary of sheet name to data frame
+    """
+    sheets = sorted(get_referenced_sheets(mapping_files, alias_sources, required_sheets))
+    data = read_sheet(file_name, sheets, is_read_only=True,
+                      trim_sheets=set(sheets) - set(required_sheets))
+    if len(sheets) == 1:
+        return {sheets[0]: data}
+    return data
+
+
 def add_metadata(data_frame):
     """
     Add metadata rows and columns in the given data frame
@@ -294,12 +450,72 @@ def get_next_statement(statement, apply_to, cell_num):
     return statement
 
 
-# pylint: disable=too-many-locals, too-many-statements
+# Month tables by (year, month) of the report month, read only as they are shared
+MONTH_TABLES = {}
+
+
 def calc_month_table(report_month):
+    """
+    Get the month table of Input Tab, rolled from the table of the previous month when it
+        was built already
+    Parameters:
+        Report Month {Date}
+    Returns:
+        Numpy array of month table values
+    """
+    key = (report_month.year, report_month.month)
+    if key not in MONTH_TABLES:
+        prev_month = get_prev_mth(report_month)
+        prev_table = MONTH_TABLES.get((prev_month.year, prev_month.month))
+        table = build_month_table(report_month) if prev_table is None \
+            else roll_month_table(prev_table)
+        table.flags.writeable = False
+        MONTH_TABLES[key] = table
+    return MONTH_TABLES[key]
+
+
+def roll_month_table(prev_table):
+    """
+    Roll the month table of the previous month by one month: every month moves down one
+        row and the month after the first row is added on top
+    Parameters:
+        prev_table {Array} - Month table of the previous month
+    Returns:
+        Numpy array of month table values
+    """
+    ret_table = np.empty_like(prev_table)
+    ret_table[1:] = prev_table[:-1]
+
+    tbl_mth = 1 if prev_table[0][0] == 12 else prev_table[0][0] + 1
+    rpt_yr = prev_table[0][4] + 1 if prev_table[0][0] == 12 else prev_table[0][4]
+    ret_table[0][0] = tbl_mth
+    ret_table[0][1] = month_name(tbl_mth)
+    ret_table[0][2] = month_long_name(tbl_mth)
+    ret_table[0][3] = "Q"+str(ceil(tbl_mth/3))
+    ret_table[0][4] = rpt_yr
+    ret_table[0][5] = "Y"+str(rpt_yr)
+    ret_table[0][7] = str((ret_table[0][3]))[1:]+"Q"+str((ret_table[0][4]))[2:]
+    ret_table[0][9] = ret_table[0][1]
+
+    # The quarter count starts again from the quarter of the first row
+    qtr_row = ceil(ret_table[0][0]/3)
+    for k in range(len(ret_table)):
+        ret_table[k][6] = qtr_row
+        ret_table[k][8] = str(ret_table[k][7]) + str(ret_table[k][6])
+        if qtr_row == 1:
+            qtr_row = 3
+        else:
+            qtr_row -= 1
+
+    return ret_table
+
+
+# pylint: disable=too-many-locals, too-many-statements
+def build_month_table(report_month):
     """
     Routine to populate the month table of Input Tab
     Parameters:
-        Report Month {Integer}
+        Report Month {Date}
     Returns:
         Numpy array of month table values
     """
@@ -771,21 +987,37 @@ def calculate_row_sum(data_frame, start_row_id, end_row_id, col_id):
         return sum(vals)
 
 
-def clear_formulae(country):
+def save_stored(workbook, file_name):
+    """
+    Save a workbook through openpyxl without compressing its parts, for reports which are
+        read or compressed again right after
+    Parameters:
+        workbook {Workbook} - Workbook to save
+        file_name {String} - Path of the workbook
+    """
+    from zipfile import ZipFile, ZIP_STORED
+    from openpyxl.writer.excel import ExcelWriter
+
+    ExcelWriter(workbook, ZipFile(file_name, 'w', ZIP_STORED, allowZip64=True)).save()
+
+
+def clear_formulae(country, cob_date=None):
     """
     Function to clear formulae in output file
     Arguments:
         country {String} -- Country
+        cob_date {Date} -- COB date of the report, the COB date of the run by default
     Returns:
         Nil
     """
-    cob_date = datetime.strptime(cfg.COUNTRY_DATE, '%d-%b-%Y')
+    cob_date = cob_date or datetime.strptime(cfg.COUNTRY_DATE, '%d-%b-%Y')
     prev_month = get_prev_mth(cob_date)
     country_input_file = cfg.INPUT_DIR + \
                             cfg.INPUT_COUNTRY_FILE.format(prev_month.strftime("%b'%y"), country)
     country_report_file = cfg.OUTPUT_DIR + cfg.OUTPUT_FILE_FORMAT.format(prev_month.strftime("%b'%y"), country)
     EXT_DIC = excel_helper.extract_worksheet_extlst(country_input_file)
 
+    from openpyxl import load_workbook
     country_report = load_workbook(country_report_file)
     for report_ws in country_report.sheetnames:
         output_sheet = country_report[report_ws]
@@ -798,5 +1030,11 @@ def clear_formulae(country):
                     elif str(cell)[0] == '=':
                         output_sheet.cell(row=i, column=j).value = None
 
-    country_report.save(country_report_file)
-    excel_helper.add_extlst_element(country_report_file, EXT_DIC)
+    if cfg.RECOMPRESS_OUTPUT:
+        # The parts are deflated once, after the extLst elements are restored
+        save_stored(country_report, country_report_file)
+        excel_helper.add_extlst_element(country_report_file, EXT_DIC)
+        recompress(country_report_file, cfg.OUTPUT_COMPRESSION)
+    else:
+        country_report.save(country_report_file)
+        excel_helper.add_extlst_element(country_report_file, EXT_DIC)
@@ -0,0 +1,86 @@
+""" Cache of parsed input files, shared by the batch modes """
+
+from os import stat
+from threading import Lock
+
+
+def get_file_key(path):
+    """
+    Get the key identifying the current version of a file on disk
+    Parameters:
+        path {String} - Path of the file
+    Returns:
+        {Tuple} - Modification time and size of the file
+    """
+    file_stat = stat(path)
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+class InputCache:
+    """
+    Parsed input files keyed by path, re-parsed when the file changes on disk
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path_lock(self, path):
+        with self._lock:
+            return self._locks.setdefault(path, Lock())
+
+    def get(self, path, loader):
+        """
+        Get the parsed content of the file, parsing it with the loader when missing or stale
+        Parameters:
+            path {String} - Path of the file
+            loader {Function} - Function parsing the file, called with the path
+        Returns:
+            Parsed content of the file
+        """
+        # Parse each file once even when several threads ask for it at the same time
+        with self._path_lock(path):
+            key = get_file_key(path)
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            content = loader(path)
+            self._entries[path] = (key, content)
+            return content
+
+    def is_current(self, path):
+        """
+        Check whether the cached content of the file matches the file on disk
+        Parameters:
+            path {String} - Path of the file
+        Returns:
+            {Boolean} - True if the file is cached and unchanged
+        """
+        entry = self._entries.get(path)
+        try:
+            return entry is not None and entry[0] == get_file_key(path)
+        except FileNotFoundError:
+            return False
+
+    def pop(self, path):
+        """
+        Remove the file from the cache
+        Parameters:
+            path {String} - Path of the file
+        Returns:
+            Parsed content of the file, None if it was not cached
+        """
+        entry = self._entries.pop(path, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        """
+        Remove every file from the cache
+        """
+        with self._lock:
+            self._entries.clear()
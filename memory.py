@@ -0,0 +1,163 @@
+""" Memory accounting and bounding for batch runs """
+
+import gc
+import os
+import pickle
+import resource
+from contextlib import contextmanager
+from tempfile import mkstemp
+from threading import Thread, Lock, Event
+from loguru import logger
+import config as cfg
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+MB = 1024 * 1024
+
+# Job entries holding parsed data which can be spilled to disk between stages
+SPILLABLE_KEYS = ('report_data', 'context', 'template_data')
+
+
+def current_rss():
+    """
+    Get the current resident set size of the process
+    Returns:
+        {Integer} - Resident set size in bytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss():
+    """
+    Get the peak resident set size of the process since it started
+    Returns:
+        {Integer} - Peak resident set size in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def is_over_budget():
+    """
+    Check whether the process uses more memory than the configured budget
+    Returns:
+        {Boolean} - True if a budget is set and the resident set size exceeds it
+    """
+    return bool(cfg.MEMORY_BUDGET_MB) and current_rss() > cfg.MEMORY_BUDGET_MB * MB
+
+
+class MemoryMonitor:
+    """
+    Samples the resident set size in the background and keeps the peak of each active phase
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or cfg.MEMORY_SAMPLE_INTERVAL
+        self.peaks = {}
+        self._active = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._sample, name='memory-monitor', daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._record(current_rss())
+
+    def _record(self, rss):
+        with self._lock:
+            for phase in self._active:
+                self.peaks[phase] = max(self.peaks.get(phase, 0), rss)
+
+    def start(self):
+        """
+        Start sampling
+        """
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop sampling and log the peak memory of each phase
+        """
+        self._stop.set()
+        self._thread.join()
+        for phase, peak in sorted(self.peaks.items()):
+            logger.info("Peak memory of {}: {:.1f} MB".format(phase, peak / MB))
+        logger.info("Peak memory of the run: {:.1f} MB".format(peak_rss() / MB))
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Track the peak memory while the phase runs, phases of the same name may overlap
+        Parameters:
+            name {String} - Name of the phase
+        """
+        with self._lock:
+            self._active[name] = self._active.get(name, 0) + 1
+        self._record(current_rss())
+        try:
+            yield
+        finally:
+            self._record(current_rss())
+            with self._lock:
+                self._active[name] -= 1
+                if not self._active[name]:
+                    del self._active[name]
+
+
+def compact_frame(data_frame):
+    """
+    Store the repetitive object columns of a frame which is only read from as categoricals
+    Parameters:
+        data_frame {DataFrame} - Frame to compact in place
+    Returns:
+        {DataFrame} - Compacted frame
+    """
+    for column in data_frame.columns:
+        if column == 'ac' or data_frame[column].dtype != object:
+            continue
+        # Categoricals only pay off when values repeat, e.g. blanks and labels
+        if data_frame[column].nunique(dropna=False) * 2 < len(data_frame.index):
+            data_frame[column] = data_frame[column].astype('category')
+    return data_frame
+
+
+def spill_job(job):
+    """
+    Write the parsed data of an idle job to disk and release it from memory
+    Parameters:
+        job {Dictionary} - Batch job waiting for its next stage
+    Returns:
+        {Dictionary} - Batch job with the parsed data replaced by the spill file
+    """
+    spilled = {key: job.pop(key) for key in SPILLABLE_KEYS if key in job}
+    if not spilled:
+        return job
+    os.makedirs(cfg.SPILL_DIR, exist_ok=True)
+    handle, job['spill_file'] = mkstemp(suffix='.pkl', dir=cfg.SPILL_DIR)
+    with os.fdopen(handle, 'wb') as spill_file:
+        pickle.dump(spilled, spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+    del spilled
+    gc.collect()
+    logger.info("Spilled parsed data of {} to {}".format(job['country'], job['spill_file']))
+    return job
+
+
+def restore_job(job):
+    """
+    Load the spilled parsed data of a job back into memory
+    Parameters:
+        job {Dictionary} - Batch job, possibly spilled
+    Returns:
+        {Dictionary} - Batch job with its parsed data in memory
+    """
+    spill_file = job.pop('spill_file', None)
+    if spill_file is None:
+        return job
+    with open(spill_file, 'rb') as spilled:
+        job.update(pickle.load(spilled))
+    os.remove(spill_file)
+    return job
@@ -0,0 +1,185 @@
+""" Run metrics exported in the Prometheus textfile format """
+
+import os
+import re
+from threading import Lock
+from time import monotonic, time
+from loguru import logger
+from src.memory import peak_rss
+import config as cfg
+
+METRIC_PREFIX = 'country_financials_'
+
+# Name to type and help of the exported metrics
+METRICS = {
+    'stage_duration_seconds': ('gauge', 'Duration of a pipeline stage of the last country run'),
+    'tab_duration_seconds': ('gauge', 'Duration of a generated tab of the last country run'),
+    'mapping_rows_total': ('counter', 'Mapping rows evaluated'),
+    'cells_evaluated_total': ('counter', 'Mapping cells evaluated'),
+    'mapping_cells_reused_total': ('counter', 'Mapping cells copied from the previous report'),
+    'aliases_resolved_total': ('counter', 'Row, column and statement aliases resolved'),
+    'cache_hit_ratio': ('gauge', 'Share of cache lookups served from the cache'),
+    'peak_rss_bytes': ('gauge', 'Peak resident set size of the process'),
+    'bytes_read_total': ('counter', 'Bytes of input files read'),
+    'bytes_written_total': ('counter', 'Bytes of report files written'),
+    'log_messages_total': ('counter', 'Warnings and errors logged, by message type'),
+    'reports_total': ('counter', 'Country reports generated, by status'),
+    'last_write_timestamp_seconds': ('gauge', 'Time the metrics were written'),
+}
+
+# Message templates of the configuration file, matched against logged warnings and errors.
+# Diagnostics summaries are left out, their issues are counted by Diagnostics.summarize.
+MESSAGE_TYPES = [(name, re.compile(re.escape(getattr(cfg, name)).replace(r'\{\}', '.*')))
+                 for name in dir(cfg) if name.endswith(('_MESSAGE', '_ERROR'))
+                 and isinstance(getattr(cfg, name), str)]
+SUMMARY_TYPE = 'DIAGNOSTICS_SUMMARY_MESSAGE'
+
+
+def get_message_type(message):
+    """
+    Get the configuration template a log message was formatted from
+    Parameters:
+        message {String} - Logged message
+    Returns:
+        {String} - Name of the template in the configuration file, 'other' if none matches
+    """
+    for name, pattern in MESSAGE_TYPES:
+        if pattern.fullmatch(message):
+            return name
+    return 'other'
+
+
+def format_labels(labels):
+    """
+    Format metric labels in the exposition format
+    Parameters:
+        labels {Tuple} - Sorted (name, value) pairs
+    Returns:
+        {String} - Labels in braces, empty if there are none
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace(
+        '"', r'\"').replace('\n', r'\n')) for name, value in labels) + '}'
+
+
+class MetricsRegistry:
+    """
+    Metric values of the process, written to the textfile read by the node exporter
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._caches = {}
+        self._lock = Lock()
+        self._written = None
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter
+        Parameters:
+            name {String} - Metric name in METRICS
+            value {Float} - Increment
+            labels {Dictionary} - Label values of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge
+        Parameters:
+            name {String} - Metric name in METRICS
+            value {Float} - Value of the gauge
+            labels {Dictionary} - Label values of the series
+        """
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def track_cache(self, name, cache):
+        """
+        Export the hit ratio of a cache counting its hits and misses
+        Parameters:
+            name {String} - Cache name used as label
+            cache {Object} - Cache with hits and misses attributes
+        """
+        self._caches[name] = cache
+
+    def render(self):
+        """
+        Render the metrics in the Prometheus text exposition format
+        Returns:
+            {String} - Metrics text
+        """
+        for name, cache in self._caches.items():
+            lookups = cache.hits + cache.misses
+            if lookups:
+                self.set('cache_hit_ratio', cache.hits / lookups, cache=name)
+        self.set('peak_rss_bytes', peak_rss())
+        self.set('last_write_timestamp_seconds', time())
+
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = []
+        for metric, (metric_type, metric_help) in METRICS.items():
+            series = [(labels, value) for (name, labels), value in values if name == metric]
+            if not series:
+                continue
+            lines.append('# HELP {}{} {}'.format(METRIC_PREFIX, metric, metric_help))
+            lines.append('# TYPE {}{} {}'.format(METRIC_PREFIX, metric, metric_type))
+            lines.extend('{}{}{} {}'.format(METRIC_PREFIX, metric, format_labels(labels),
+                                            repr(float(value))) for labels, value in series)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_name=None):
+        """
+        Write the metrics through a temporary file, so that the exporter never reads
+            a half written file
+        Parameters:
+            file_name {String} - Path of the metrics file
+        """
+        file_name = file_name or cfg.METRICS_FILE
+        if not file_name:
+            return
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        with open(file_name + '.tmp', 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(file_name + '.tmp', file_name)
+        self._written = monotonic()
+
+    def write_due(self):
+        """
+        Write the metrics if METRICS_INTERVAL has passed since they were last written,
+            so that long batches report progress
+        """
+        if self._written is None or monotonic() - self._written > cfg.METRICS_INTERVAL:
+            self.write()
+
+
+REGISTRY = MetricsRegistry()
+
+
+def count_log_messages(message):
+    """
+    Log sink counting warnings and errors by the configuration template they come from
+    Parameters:
+        message {Message} - Message passed by the logger
+    """
+    record = message.record
+    message_type = get_message_type(record['message'])
+    if message_type != SUMMARY_TYPE:
+        REGISTRY.inc('log_messages_total', level=record['level'].name.lower(), type=message_type)
+
+
+_SINK_LOCK = Lock()
+_SINK_ID = []
+
+
+def install_log_counter():
+    """
+    Add the sink counting warnings and errors to the logger, once per process
+    """
+    with _SINK_LOCK:
+        if not _SINK_ID:
+            _SINK_ID.append(logger.add(count_log_messages, level='WARNING'))
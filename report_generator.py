@@ -3,97 +3,234 @@
 from datetime import datetime
 from math import floor # pylint: disable=unused-import
 from os import listdir
-from openpyxl import load_workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
 from loguru import logger
-from tqdm.auto import tqdm
-import pandas as pd
+import pandas as pd  # pylint: disable=unused-import
 import numpy as np
 from src.helper import *  # pylint: disable=wildcard-import, unused-wildcard-import
+from src.expression import evaluate
+from src.memory import compact_frame
+from src.metrics import REGISTRY
+from src.input_cache import InputCache
+from src.diagnostics import Diagnostics, MISSING_VALUE, FAILED_STATEMENT
+from src.rules import get_rules, is_valid_mapping_row
+from src.alias_cache import ALIAS_CACHE
 import config as cfg
 
+# openpyxl and tqdm are imported by the functions using them, as they are slow to import
+# pylint: disable=import-outside-toplevel
 
-# pylint: disable=too-many-locals, eval-used, too-many-statements, too-many-nested-blocks, too-many-branches
-def generate_country_exp_report(country, country_input_data, country_report_data,
-                                country_report, suffix):
+# Parsed alias and mapping files, shared by the reports of a batch and re-read when changed
+RULES_CACHE = InputCache()
+
+
+def get_exp_mapping_file(country):
     """
-    Function to generate EXP report from given input files
+    Get the EXP mapping file of the group the country belongs to
+    Parameters:
+        country {String} - Country name
+    Returns:
+        {String} - Path of the mapping file
     """
-    cob_date = datetime.strptime(cfg.COUNTRY_DATE, '%d-%b-%Y')
-    prev_month = get_prev_mth(cob_date)
+    if country in cfg.GROUP1_COUNTRIES:
+        return cfg.MAPPING_EXP_TAB.format('group1')
+    if country in cfg.GROUP2_COUNTRIES:
+        return cfg.MAPPING_EXP_TAB.format('group2')
+    return cfg.MAPPING_EXP_TAB.format('other')
 
-    # Load the worksheets into memory
-    exp_sheet = country_report["Exp"]
-    input_source = add_metadata(country_report_data['Input'])
-    exp_source = add_metadata(country_report_data['Exp'])
-    pb_source = add_metadata(country_report_data['PB'])
-    ibcm_source = add_metadata(country_report_data['IBCM'])
-    mkts_source = add_metadata(country_report_data['Mkts'])
-    afg_source = add_metadata(country_report_data['AFG'])
 
-    if country in cfg.GROUP1_COUNTRIES:
-        input_mapping_file = cfg.MAPPING_EXP_TAB.format('group1')
-        input_mapping = pd.read_csv(input_mapping_file)
-    elif country in cfg.GROUP2_COUNTRIES:
-        input_mapping_file = cfg.MAPPING_EXP_TAB.format('group2')
-        input_mapping = pd.read_csv(input_mapping_file)
-    else:
-        input_mapping_file = cfg.MAPPING_EXP_TAB.format('other')
-        input_mapping = pd.read_csv(input_mapping_file)
-
-    alias_files = [cfg.ALIAS_FILE_INPUT, cfg.ALIAS_FILE_EXP, cfg.ALIAS_FILE_PB, cfg.ALIAS_FILE_AFG,
-                   cfg.ALIAS_FILE_IBCM, cfg.ALIAS_FILE_MKTS]
-    source_files = [input_source, exp_source, pb_source, afg_source, ibcm_source, mkts_source]
-    for alias_file, source_file in zip(alias_files, source_files):
-        alias = pd.read_csv(alias_file)
-        alias.dropna(how='all', axis=0, inplace=True)
-        alias = alias.fillna('')
-        if 'start row/col' not in list(alias):
-            alias['start row/col'] = ''
-
-        alias_suffix = alias_file[20:-4]
-        for idx, row in alias.iterrows():
-            if row['Alias'][0] == '#' or row['Alias'] == '':
+# pylint: disable=eval-used
+def run_statement(statement, context):
+    """
+    Evaluate a mapping or alias statement with the configured statement engine
+    Parameters:
+        statement {String} - Statement
+        context {Dictionary} - Statement context with frames and resolved aliases
+    Returns:
+        Value of the statement
+    """
+    if cfg.STATEMENT_ENGINE == 'eval':
+        # The aliases are globals of the statement, comprehensions and lambdas do not see the
+        # locals of eval
+        return eval(statement, {**globals(), **context})
+    return evaluate(statement, context)
+
+
+def get_country_files(country, cob_date):
+    """
+    Get the input and output report files of the country for the COB date
+    Parameters:
+        country {String} - Country name
+        cob_date {Date} - COB date of the run
+    Returns:
+        {Tuple} - Path of the country input file and of the country report file
+    """
+    prev_month = get_prev_mth(cob_date).strftime("%b'%y")
+    return (cfg.INPUT_DIR + cfg.INPUT_COUNTRY_FILE.format(prev_month, country),
+            cfg.OUTPUT_DIR + cfg.OUTPUT_FILE_FORMAT.format(prev_month, country))
+
+
+def load_country_report(country, cob_date, with_workbook=True, mapping_files=None):
+    """
+    Load the country input file as the report workbook and read the sheets referenced
+        by the EXP mapping of the country
+    Parameters:
+        country {String} - Country name
+        cob_date {Date} - COB date of the run
+        with_workbook {Boolean} - Load the report workbook, not needed by the XML writer
+        mapping_files {List} - Mapping files whose sheets are read, the EXP mapping of the
+            country by default
+    Returns:
+        {Tuple} - Dictionary of report sheet data frames and the report workbook
+    """
+    from openpyxl import load_workbook
+
+    country_input_file, _ = get_country_files(country, cob_date)
+    if mapping_files is None:
+        mapping_files = [get_exp_mapping_file(country)]
+    country_report_data = load_referenced_sheets(
+        country_input_file, mapping_files, cfg.EXP_ALIAS_SOURCES, ['Exp'])
+    country_report = load_workbook(country_input_file) if with_workbook else None
+    return country_report_data, country_report
+
+
+def prepare_exp_context(country, country_report_data, cob_date=None, mapping_files=None):
+    """
+    Build the statement context of the EXP tab with the referenced sheets and run details
+    Parameters:
+        country {String} - Country name
+        country_report_data {Dictionary} - Report sheet data frames
+        cob_date {Date} - COB date of the report, the COB date of the run by default
+        mapping_files {List} - Mapping files whose sheets are used, the EXP mapping of the
+            country by default
+    Returns:
+        {Tuple} - List of alias files to resolve and the statement context
+    """
+    cob_date = cob_date or datetime.strptime(cfg.COUNTRY_DATE, '%d-%b-%Y')
+    if mapping_files is None:
+        mapping_files = [get_exp_mapping_file(country)]
+    referenced_sheets = get_referenced_sheets(mapping_files, cfg.EXP_ALIAS_SOURCES, ['Exp'])
+
+    alias_files = []
+    context = {'country': country, 'cob_date': cob_date, 'prev_month': get_prev_mth(cob_date)}
+    for alias_file, sheet_name in cfg.EXP_ALIAS_SOURCES.items():
+        if sheet_name in referenced_sheets:
+            alias_files.append(alias_file)
+            source = add_metadata(country_report_data[sheet_name])
+            # Sheets which are only read from can be stored compactly
+            if cfg.MEMORY_BUDGET_MB and sheet_name != 'Exp':
+                source = compact_frame(source)
+            context[get_alias_suffix(alias_file) + '_source'] = source
+    return alias_files, context
+
+
+def resolve_aliases(alias_files, context):
+    """
+    Resolve the row, column and statement aliases of the alias files into the context
+    Parameters:
+        alias_files {List} - Alias files, each resolved against its <suffix>_source frame
+        context {Dictionary} - Statement context, updated with the resolved aliases
+    Returns:
+        {Dictionary} - Statement context
+    """
+    resolved = 0
+    for alias_file in alias_files:
+        alias_suffix = get_alias_suffix(alias_file)
+        source_file = context[alias_suffix + '_source']
+        alias = RULES_CACHE.get(alias_file, get_rules)
+        layout = ALIAS_CACHE.get_layout(alias_file, source_file) if cfg.ALIAS_CACHE_FILE \
+            else None
+
+        for idx, row in alias:
+            if row['Alias'] == '' or row['Alias'][0] == '#':
+                continue
+            if row['Alias'][0] in 'rc' and row['offset'] is None:
+                logger.error(cfg.INVALID_ALIAS_MESSAGE.format(row['Alias'], idx + 2, alias_file))
                 continue
 
+            # Positions found in a previous run are used if the keyword is still there
+            if layout is not None and row['Alias'][0] in 'rc':
+                keyword_index = ALIAS_CACHE.find(layout, row, source_file)
+                if keyword_index is not None:
+                    context[row['Alias'] + alias_suffix] = keyword_index + row['offset']
+                    resolved += 1
+                    continue
+
             # Check if the alias row is valid
             if row['Alias'][0] in 'rc':
-                row['offset'] = 0 if not row['offset'] else row['offset']
                 check_alias_row(row, idx, alias_file, source_file)
 
             if row['Alias'][0] == 'r':
-                keyword_row = get_row_index(source_file, row['Keyword'], get_row_index(
-                    source_file, row['start row/col']))
+                start_row = get_row_index(source_file, row['start row/col'])
+                keyword_row = get_row_index(source_file, row['Keyword'], start_row)
                 if keyword_row is not None and keyword_row != 'ar':
-                    globals()[row['Alias'] + alias_suffix] = keyword_row + int(row['offset'])
+                    context[row['Alias'] + alias_suffix] = keyword_row + int(row['offset'])
+                    resolved += 1
+                    if layout is not None and start_row is not None:
+                        ALIAS_CACHE.store(layout, row, start_row, keyword_row)
             elif row['Alias'][0] == 'c':
-                keyword_col = get_col_index(source_file, row['Keyword'], get_col_index(
-                    source_file, row['start row/col']))
+                start_col = get_col_index(source_file, row['start row/col'])
+                keyword_col = get_col_index(source_file, row['Keyword'], start_col)
                 if keyword_col is not None and keyword_col != 'ac':
-                    globals()[row['Alias'] + alias_suffix] = keyword_col + int(row['offset'])
+                    context[row['Alias'] + alias_suffix] = keyword_col + int(row['offset'])
+                    resolved += 1
+                    if layout is not None and start_col is not None:
+                        ALIAS_CACHE.store(layout, row, start_col, keyword_col)
             elif row['Alias'][0] == 's':
                 eval_statement = apply_statement(row['statement'])
                 try:
-                    globals()[row['Alias']] = eval(str(eval_statement[0][0]))
-                except:  # pylint: disable=bare-except
+                    context[row['Alias']] = run_statement(str(eval_statement[0][0]), context)
+                    resolved += 1
+                except Exception as err_message:  # pylint: disable=broad-except
                     logger.error(cfg.MAPPING_ERROR_MESSAGE.format(
                         row['statement'], (idx + 2), alias_file))
+                    logger.error("Error details: {}".format(err_message))
                     exit(-1)
+    REGISTRY.inc('aliases_resolved_total', resolved, country=context['country'])
+    return context
+
+
+# pylint: disable=too-many-locals, too-many-nested-blocks, too-many-branches
+def evaluate_mapping(input_mapping_file, dest_source, context, suffix, skip_rows=(),
+                     skip_cells=None):
+    """
+    Evaluate the statements of the mapping file and populate the destination frame
+    Parameters:
+        input_mapping_file {String} - Mapping file
+        dest_source {DataFrame} - Destination frame with metadata
+        context {Dictionary} - Statement context with resolved aliases
+        suffix {String} - Alias suffix of the destination tab
+        skip_rows {Set} - Indexes of mapping rows populated otherwise, e.g. by a rollup
+        skip_cells {Dictionary} - Index of mapping rows to the row and column offsets of the
+            cells of their block populated otherwise, e.g. carried over by the trend mode
+    Returns:
+        {DataFrame} - Populated destination frame
+    """
+    from tqdm.auto import tqdm
+
+    input_mapping = RULES_CACHE.get(input_mapping_file, get_rules)
+    mapping_rows = cells = 0
+    diagnostics = Diagnostics(input_mapping_file, context['country'], suffix)
+    record = diagnostics.record
 
     # Process through each mapping and populate values
-    for index, row in tqdm(input_mapping.iterrows(), total=input_mapping.shape[0]):
-        if row['row_id'][0] == '#':
+    for index, row in tqdm(input_mapping, total=len(input_mapping),
+                           mininterval=cfg.PROGRESS_INTERVAL, miniters=cfg.PROGRESS_MIN_ROWS):
+        if row['row_id'][:1] == '#' or index in skip_rows:
             continue
+        if not is_valid_mapping_row(row):
+            logger.error(cfg.INVALID_MAPPING_MESSAGE.format(index + 2))
+            exit(-1)
+        mapping_rows += 1
 
         # Check that the aliases are valid
         try:
-            row_index = eval(append_suffix(row['row_id'], suffix))
+            row_index = run_statement(append_suffix(row['row_id'], suffix), context)
         except NameError:
             logger.error(cfg.INVALID_ALIAS_MESSAGE.format(
                 row['row_id'], index + 2, input_mapping_file))
             exit(-1)
         try:
-            col_index = eval(append_suffix(row['col_id'], suffix))
+            col_index = run_statement(append_suffix(row['col_id'], suffix), context)
         except NameError:
             logger.error(cfg.INVALID_ALIAS_MESSAGE.format(
                 row['col_id'], index + 2, input_mapping_file))
@@ -112,45 +249,80 @@ def generate_country_exp_report(country, country_input_data, country_report_data
                 row['statement'], index + 2, input_mapping_file))
             exit(-1)
 
+        skipped = skip_cells.get(index, ()) if skip_cells else ()
         for row_num in range(eval_statement.shape[0]):
             for col_num in range(eval_statement.shape[1]):
+                if (row_num, col_num) in skipped:
+                    continue
+                cells += 1
                 try:
-                    evaluated_value = eval(str(eval_statement[row_num][col_num]))
+                    evaluated_value = run_statement(str(eval_statement[row_num][col_num]),
+                                                    context)
                 except MissingValueError:
-                    logger.warning(cfg.MISSING_VALUE_ERROR.format(
-                        str(eval_statement[row_num][col_num]), index + 2, input_mapping_file))
+                    record((index + 2, row_index + row_num, col_index + col_num, MISSING_VALUE,
+                            eval_statement[row_num][col_num], None))
                     continue
                 except ValueError:
+                    diagnostics.summarize()
                     logger.error(cfg.INCORRECT_VALUE_ERROR.format(
                         str(eval_statement[row_num][col_num]), index + 2, input_mapping_file))
                     exit(-1)
                 except Exception as err_message:  # pylint: disable=broad-except
-                    exp_source.at[row_index + row_num, col_index + col_num] = "#VALUE!"
-                    logger.error(cfg.MAPPING_ERROR_MESSAGE.format(
-                        row['statement'], (index + 2), input_mapping_file))
-                    logger.error("Error details: {}".format(err_message))
+                    dest_source.at[row_index + row_num, col_index + col_num] = "#VALUE!"
+                    record((index + 2, row_index + row_num, col_index + col_num,
+                            FAILED_STATEMENT, row['statement'], err_message))
                     continue
 
                 if evaluated_value == '':
-                    logger.warning(cfg.MISSING_VALUE_ERROR.format(
-                        str(eval_statement[row_num][col_num]), index + 2, input_mapping_file))
+                    record((index + 2, row_index + row_num, col_index + col_num, MISSING_VALUE,
+                            eval_statement[row_num][col_num], None))
                     continue
 
                 if isinstance(evaluated_value, np.ndarray):
                     for i in range(0, len(evaluated_value)):
                         for j in range(0, len(evaluated_value[0])):
-                            exp_source.at[row_index + row_num + i, col_index + col_num + j] =\
+                            dest_source.at[row_index + row_num + i, col_index + col_num + j] =\
                                 evaluated_value.item((i, j))
                 else:
-                    exp_source.at[row_index + row_num, col_index + col_num] = evaluated_value
+                    dest_source.at[row_index + row_num, col_index + col_num] = evaluated_value
+
+    diagnostics.summarize()
+    REGISTRY.inc('mapping_rows_total', mapping_rows, country=context['country'], tab=suffix)
+    REGISTRY.inc('cells_evaluated_total', cells, country=context['country'], tab=suffix)
+    return dest_source
+
+
+def write_sheet(sheet, data_frame):
+    """
+    Write the values of the data frame back to the worksheet
+    Parameters:
+        sheet {Worksheet} - Output worksheet
+        data_frame {DataFrame} - Values to be written
+    """
+    from openpyxl.utils.dataframe import dataframe_to_rows
 
-    country_report_data['Exp'] = strip_metadata(exp_source)
     # Data frame need to be reshaped before writing to sheet
-    rows = dataframe_to_rows(exp_source, index=False, header=False)
+    rows = dataframe_to_rows(data_frame, index=False, header=False)
 
     # Write the information back to sheet
     for r_idx, row in enumerate(rows, 1):
         for c_idx, value in enumerate(row, 1):
-            cell = exp_sheet.cell(row=r_idx, column=c_idx)
+            cell = sheet.cell(row=r_idx, column=c_idx)
             if type(cell).__name__ != 'MergedCell':
-                exp_sheet.cell(row=r_idx, column=c_idx, value=value)
\ No newline at end of file
+                sheet.cell(row=r_idx, column=c_idx, value=value)
+
+
+# pylint: disable=unused-argument
+def generate_country_exp_report(country, country_input_data, country_report_data,
+                                country_report, suffix):
+    """
+    Function to generate EXP report from given input files
+    """
+    alias_files, context = prepare_exp_context(country, country_report_data)
+    resolve_aliases(alias_files, context)
+    ALIAS_CACHE.save()
+    exp_source = evaluate_mapping(
+        get_exp_mapping_file(country), context['exp_source'], context, suffix)
+
+    country_report_data['Exp'] = strip_metadata(exp_source)
+    write_sheet(country_report["Exp"], exp_source)
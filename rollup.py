@@ -0,0 +1,350 @@
+""" Aggregate country tabs summed from the evaluated tabs of their member countries """
+
+import ast
+import re
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+from loguru import logger
+from src.helper import apply_statement, append_suffix, cell_sum, get_statement_frames
+from src.diagnostics import Diagnostics, MISSING_VALUE, FAILED_STATEMENT
+from src.metrics import REGISTRY
+from src.report_generator import run_statement
+from src.rules import get_rules
+import config as cfg
+
+# Functions of the mapping statements whose result for an aggregate is the sum of the results
+# for its members
+ADDITIVE_FUNCTIONS = ('cell_sum', 'cell_diff')
+
+
+def get_alias_statements():
+    """
+    Get the statements of the statement aliases of the EXP alias files
+    Returns:
+        {Dictionary} - Alias name to statement
+    """
+    statements = {}
+    for alias_file in cfg.EXP_ALIAS_SOURCES:
+        for _, row in get_rules(alias_file):
+            if row['Alias'][:1] == 's':
+                statements[row['Alias']] = row['statement']
+    return statements
+
+
+def is_additive(statement, alias_statements, seen=()):
+    """
+    Check whether a statement only adds and subtracts cells, so that its value for an
+        aggregate is the sum of its values for the members
+    Parameters:
+        statement {String} - Mapping or alias statement
+        alias_statements {Dictionary} - Alias name to statement of the statement aliases
+        seen {Tuple} - Statement aliases being checked, to stop on circular references
+    Returns:
+        {Boolean} - True if the statement is additive
+    """
+    try:
+        parts = apply_statement(statement)[0]
+        trees = [ast.parse(str(part).strip(), mode='eval').body for part in parts]
+    except (SyntaxError, IndexError):
+        return False
+
+    pending = list(trees)
+    while pending:
+        node = pending.pop()
+        if isinstance(node, ast.Subscript):
+            # Frame references, the aliases inside the brackets are positions
+            while isinstance(node, ast.Subscript):
+                node = node.value
+            if not (isinstance(node, ast.Name) and node.id.endswith(cfg.FRAME_SUFFIXES)):
+                return False
+        elif isinstance(node, ast.Name):
+            if node.id not in alias_statements or node.id in seen or not is_additive(
+                    alias_statements[node.id], alias_statements, seen + (node.id,)):
+                return False
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+            pending.extend((node.left, node.right))
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            pending.append(node.operand)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id in ADDITIVE_FUNCTIONS and not node.keywords:
+            pending.extend(node.args)
+        elif isinstance(node, (ast.List, ast.Tuple)):
+            pending.extend(node.elts)
+        else:
+            return False
+    return True
+
+
+def get_member_statements(member_files):
+    """
+    Get the statements of the mapping files of the members by the region they populate
+    Parameters:
+        member_files {Iterable} - Mapping files of the members
+    Returns:
+        {List} - Per mapping file, row and column alias with the number of affected rows and
+            columns to the statement without spaces
+    """
+    member_statements = []
+    for member_file in set(member_files):
+        statements = {}
+        for _, row in get_rules(member_file):
+            if row['row_id'][:1] != '#':
+                statements[row['row_id'], row['col_id'], row['affected_rows'],
+                           row['affected_cols']] = re.sub(r'\s+', '', row['statement'])
+        member_statements.append(statements)
+    return member_statements
+
+
+def get_rollup_rows(mapping_file, member_files):
+    """
+    Get the mapping rows of an aggregate which are summed from its members. A row is summed
+        if it is additive and every member mapping file populates the same region with the
+        same statement, otherwise the sum would add up other values. The other rows are
+        evaluated from the aggregate's own sheets.
+    Parameters:
+        mapping_file {String} - Mapping file of the aggregate
+        member_files {Iterable} - Mapping files of the members
+    Returns:
+        {Set} - Indexes of the mapping rows summed from the members
+    """
+    alias_statements = get_alias_statements()
+    member_statements = get_member_statements(member_files)
+    rows = set()
+    for idx, row in get_rules(mapping_file):
+        if row['row_id'][:1] == '#' or not is_additive(row['statement'], alias_statements):
+            continue
+        key = (row['row_id'], row['col_id'], row['affected_rows'], row['affected_cols'])
+        statement = re.sub(r'\s+', '', row['statement'])
+        if all(statements.get(key) == statement for statements in member_statements):
+            rows.add(idx)
+    return rows
+
+
+def reads_other_sheets(mapping_file, suffix, rows):
+    """
+    Check whether the mapping rows of an aggregate which are not summed read other sheets
+        than the tab, so that its input sheets must be read
+    Parameters:
+        mapping_file {String} - Mapping file of the aggregate
+        suffix {String} - Alias suffix of the tab
+        rows {Set} - Indexes of the mapping rows summed from the members
+    Returns:
+        {Boolean} - True if a row evaluated on the aggregate reads another sheet
+    """
+    alias_statements = get_alias_statements()
+    for idx, row in get_rules(mapping_file):
+        if idx in rows or row['row_id'][:1] == '#':
+            continue
+        # Statement aliases may read any sheet
+        if get_statement_frames(row['statement']) - {suffix} \
+                or set(re.findall(r'\w+', row['statement'])) & set(alias_statements):
+            return True
+    return False
+
+
+def get_rollups(countries, mapping_file_of):
+    """
+    Get the aggregates of ROLLUP_COUNTRIES which can be summed from members in the batch
+    Parameters:
+        countries {List} - Countries of the batch
+        mapping_file_of {Function} - Mapping file of a country
+    Returns:
+        {Dictionary} - Aggregate to its members
+    """
+    rollups = {}
+    for country, members in cfg.ROLLUP_COUNTRIES.items():
+        if country not in countries or not set(members) <= set(countries):
+            continue
+        if not get_rollup_rows(mapping_file_of(country),
+                               [mapping_file_of(member) for member in members]):
+            logger.info("No statement of {} is additive in the mapping of all its members, it "
+                        "is generated from its own inputs".format(country))
+            continue
+        rollups[country] = list(members)
+    return rollups
+
+
+def get_alias_positions(context):
+    """
+    Get the row and column alias positions of a resolved statement context
+    Parameters:
+        context {Dictionary} - Statement context with resolved aliases
+    Returns:
+        {Dictionary} - Alias name with suffix to row or column index
+    """
+    return {name: value for name, value in context.items()
+            if name[:1] in 'rc' and isinstance(value, (int, np.integer))
+            and not isinstance(value, bool)}
+
+
+def sum_cells(blocks):
+    """
+    Sum the cells of the members as cell_sum does: blanks count as 0, '#DIV/0!' or another
+        error in any member makes the sum '#DIV/0!' or '#VALUE!'
+    Parameters:
+        blocks {Array} - Cell values of shape (members, rows, columns)
+    Returns:
+        {Tuple} - Sums of shape (rows, columns), None where all members are blank, and the
+            mask of the blank cells
+    """
+    cells = pd.Series(blocks.ravel(), dtype=object)
+    numbers = pd.to_numeric(cells, errors='coerce').to_numpy(dtype=float)
+    finite = np.isfinite(numbers)
+    blank = cells.isna().to_numpy() | (cells == '').to_numpy()
+    values = np.where(finite, numbers, 0.0)
+    div_zero = np.zeros(len(cells), dtype=bool)
+    error = np.zeros(len(cells), dtype=bool)
+    # Text which is not a number is rare, it is read by cell_sum itself
+    for idx in np.flatnonzero(~finite & ~blank):
+        value = cell_sum([cells.iat[idx]])
+        if value == '#DIV/0!':
+            div_zero[idx] = True
+        elif value == '#VALUE!':
+            error[idx] = True
+        else:
+            values[idx] = float(value)
+
+    shape = blocks.shape
+    totals = values.reshape(shape).sum(axis=0)
+    sums = np.empty(shape[1:], dtype=object)
+    sums[...] = [[Decimal(total) for total in row] for row in totals]
+    sums[error.reshape(shape).any(axis=0)] = '#VALUE!'
+    sums[div_zero.reshape(shape).any(axis=0)] = '#DIV/0!'
+    all_blank = blank.reshape(shape).all(axis=0)
+    sums[all_blank] = None
+    return sums, all_blank
+
+
+def get_member_position(positions, row_id, col_id, suffix):
+    """
+    Get the position of a mapping region in the evaluated tab of a member
+    Parameters:
+        positions {Dictionary} - Alias positions of the member
+        row_id {String} - Row alias of the region
+        col_id {String} - Column alias of the region
+        suffix {String} - Alias suffix of the tab
+    Returns:
+        {Tuple} - Row and column index, None if an alias is not resolved for the member
+    """
+    try:
+        row_index = run_statement(append_suffix(row_id, suffix), positions)
+        col_index = run_statement(append_suffix(col_id, suffix), positions)
+    except Exception:  # pylint: disable=broad-except
+        return None
+    if row_index is None or col_index is None:
+        return None
+    return row_index, col_index
+
+
+def get_unresolved_members(mapping_file, suffix, members, rows):
+    """
+    Get the members whose tabs lack an alias of an additive row of the aggregate, its sums
+        would leave them out
+    Parameters:
+        mapping_file {String} - Mapping file of the aggregate
+        suffix {String} - Alias suffix of the tab
+        members {Dictionary} - Member country to its alias positions and evaluated tab
+        rows {Set} - Indexes of the mapping rows summed from the members
+    Returns:
+        {List} - Members with an unresolved alias
+    """
+    unresolved = []
+    for country, (positions, _) in members.items():
+        for idx, row in get_rules(mapping_file):
+            if idx in rows and get_member_position(positions, row['row_id'], row['col_id'],
+                                                   suffix) is None:
+                logger.warning(cfg.ALIAS_NOT_FOUND_MESSAGE.format(
+                    row['row_id'] + ', ' + row['col_id'], country))
+                unresolved.append(country)
+                break
+    return unresolved
+
+
+def get_member_block(member, row_id, col_id, shape, suffix):
+    """
+    Get the cells of a mapping region from the evaluated tab of a member
+    Parameters:
+        member {Tuple} - Alias positions and evaluated tab of the member
+        row_id {String} - Row alias of the region
+        col_id {String} - Column alias of the region
+        shape {Tuple} - Rows and columns of the region
+        suffix {String} - Alias suffix of the tab
+    Returns:
+        {Array} - Cells of the region, None if an alias is not resolved for the member
+    """
+    positions, data_frame = member
+    position = get_member_position(positions, row_id, col_id, suffix)
+    if position is None:
+        return None
+    row_index, col_index = position
+    block = np.full(shape, None, dtype=object)
+    values = data_frame.iloc[row_index:row_index + shape[0],
+                             col_index:col_index + shape[1]].to_numpy(dtype=object)
+    block[:values.shape[0], :values.shape[1]] = values
+    return block
+
+
+# pylint: disable=too-many-locals, too-many-arguments
+def rollup_mapping(mapping_file, dest_source, context, suffix, members, rows):
+    """
+    Populate the additive mapping rows of an aggregate with the sums of its members
+    Parameters:
+        mapping_file {String} - Mapping file of the aggregate
+        dest_source {DataFrame} - Destination frame with metadata
+        context {Dictionary} - Statement context of the aggregate with resolved aliases
+        suffix {String} - Alias suffix of the tab
+        members {Dictionary} - Member country to its alias positions and evaluated tab
+        rows {Set} - Indexes of the additive mapping rows
+    Returns:
+        {DataFrame} - Destination frame with the additive rows populated
+    """
+    diagnostics = Diagnostics(mapping_file, context['country'], suffix)
+    cells = 0
+    for idx, row in get_rules(mapping_file):
+        if idx not in rows:
+            continue
+        try:
+            row_index = run_statement(append_suffix(row['row_id'], suffix), context)
+            col_index = run_statement(append_suffix(row['col_id'], suffix), context)
+        except NameError:
+            logger.error(cfg.INVALID_ALIAS_MESSAGE.format(
+                row['row_id'] + ', ' + row['col_id'], idx + 2, mapping_file))
+            exit(-1)
+        if row_index is None or col_index is None:
+            logger.error(cfg.INVALID_MAPPING_MESSAGE.format(idx + 2))
+            exit(-1)
+        shape = apply_statement(row['statement'], row['affected_rows'],
+                                row['affected_cols']).shape
+
+        blocks = []
+        for country, member in members.items():
+            block = get_member_block(member, row['row_id'], row['col_id'], shape, suffix)
+            if block is None:
+                logger.warning(cfg.ALIAS_NOT_FOUND_MESSAGE.format(
+                    row['row_id'] + ', ' + row['col_id'], country))
+                break
+            blocks.append(block)
+        if len(blocks) < len(members):
+            # A sum without every member is not the total, the row fails as a statement does
+            message = cfg.ALIAS_NOT_FOUND_MESSAGE.format(
+                row['row_id'] + ', ' + row['col_id'], country)
+            for row_num in range(shape[0]):
+                for col_num in range(shape[1]):
+                    dest_source.at[row_index + row_num, col_index + col_num] = "#VALUE!"
+                    diagnostics.record((idx + 2, row_index + row_num, col_index + col_num,
+                                        FAILED_STATEMENT, row['statement'], message))
+            continue
+
+        sums, all_blank = sum_cells(np.stack(blocks))
+        cells += sums.size
+        for row_num, col_num in zip(*np.nonzero(~all_blank)):
+            dest_source.at[row_index + row_num, col_index + col_num] = sums[row_num, col_num]
+        for row_num, col_num in zip(*np.nonzero(all_blank)):
+            diagnostics.record((idx + 2, row_index + row_num, col_index + col_num,
+                                MISSING_VALUE, row['statement'], None))
+
+    diagnostics.summarize()
+    REGISTRY.inc('cells_evaluated_total', cells, country=context['country'], tab=suffix)
+    return dest_source
+
@@ -0,0 +1,384 @@
+""" Alias and mapping rules compiled into one validated bundle, rebuilt when a CSV changes """
+
+import ast
+import csv
+import os
+import pickle
+from glob import glob
+from threading import Lock
+from loguru import logger
+from src.input_cache import get_file_key
+import config as cfg
+
+BUNDLE_VERSION = 1
+ALIAS_COLUMNS = ['Alias', 'Keyword', 'start row/col', 'offset', 'statement']
+MAPPING_COLUMNS = ['row_id', 'col_id', 'statement', 'affected_rows', 'affected_cols']
+# Alias columns searched for as read by pandas, numbers when the whole column is numeric
+KEYWORD_COLUMNS = ['Keyword', 'start row/col']
+MISSING_COLUMNS_MESSAGE = 'Columns {} are missing in file {}'
+RULES_ERROR_MESSAGE = '{} errors in file {}, run the rules validation for details'
+
+
+class RulesError(Exception):
+    """
+    Custom exception for alias and mapping files which fail validation
+    """
+
+
+def get_rule_files():
+    """
+    Get the alias and mapping files configured, file name templates are expanded with
+        the files present
+    Returns:
+        {Dictionary} - Path of the file to 'alias' or 'mapping'
+    """
+    rule_files = {}
+    for name in dir(cfg):
+        value = getattr(cfg, name)
+        if not isinstance(value, str) or not value.endswith('.csv'):
+            continue
+        kind = 'alias' if name.startswith('ALIAS_FILE') else \
+            'mapping' if name.startswith('MAPPING_') else None
+        if kind is None:
+            continue
+        for file_name in sorted(glob(value.replace('{}', '*'))) if '{}' in value else [value]:
+            if os.path.isfile(file_name):
+                rule_files[file_name] = kind
+    return rule_files
+
+
+def is_valid_statement(statement):
+    """
+    Check that a statement or alias expression parses
+    Parameters:
+        statement {String} - Statement
+    Returns:
+        {Boolean} - True if the statement is a valid expression
+    """
+    try:
+        ast.parse(statement.strip(), mode='eval')
+    except SyntaxError:
+        return False
+    return True
+
+
+def to_number(value):
+    """
+    Convert a number read from a rules file as pandas does
+    Parameters:
+        value {String} - Value of the cell
+    Returns:
+        {Number} - Integer or float
+    Raises:
+        ValueError - The value is not a number
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def to_column_type(values):
+    """
+    Convert the values of a column to the type pandas reads it as: integers if every value is
+        an integer, floats if every value is a number or blank, text otherwise
+    Parameters:
+        values {List} - Values of the column
+    Returns:
+        {List} - Converted values, blanks stay empty strings
+    """
+    try:
+        numbers = [to_number(value) if value != '' else None for value in values]
+    except (ValueError, OverflowError):
+        return values
+    if None not in numbers and all(isinstance(number, int) for number in numbers):
+        return numbers
+    return ['' if number is None else float(number) for number in numbers]
+
+
+def read_rows(file_name, typed_columns=()):
+    """
+    Read the non-empty rows of a rules file as pandas.read_csv does, with blanks as empty
+        strings. Blank lines are not rows, lines of empty cells are rows which are left out.
+    Parameters:
+        file_name {String} - Path of the CSV file
+        typed_columns {List} - Columns converted to numbers when all their values are numbers
+    Returns:
+        {Tuple} - Column names and list of (row index, row) pairs, the index counting
+            data rows from 0 as in the error messages
+    """
+    with open(file_name, newline='', encoding='utf-8-sig') as rules_file:
+        reader = csv.reader(rules_file)
+        columns = [column.strip() for column in next(reader, [])]
+        records = [values + [''] * (len(columns) - len(values)) for values in reader
+                   if len(values) > 1 or values and values[0].strip()]
+    for column in typed_columns:
+        if column in columns:
+            position = columns.index(column)
+            for values, value in zip(records, to_column_type(
+                    [values[position] for values in records])):
+                values[position] = value
+    rows = [(idx, dict(zip(columns, values))) for idx, values in enumerate(records)
+            if any(str(value).strip() for value in values)]
+    return columns, rows
+
+
+def to_integer(value):
+    """
+    Convert a number read from a rules file, written as 1 or 1.0
+    Parameters:
+        value {String} - Value of the cell
+    Returns:
+        {Integer} - Number, None if the value is not an integer
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else None
+
+
+def to_offset(value):
+    """
+    Convert the offset of an alias, blank is 0 and decimals are truncated as int() does
+    Parameters:
+        value {String} - Value of the cell
+    Returns:
+        {Integer} - Offset, None if the value is not a number
+    """
+    if not value.strip():
+        return 0
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_alias_file(file_name, errors, warnings):
+    """
+    Parse and validate an alias file
+    Parameters:
+        file_name {String} - Path of the alias file
+        errors {List} - Errors which stop the file from being used, appended to
+        warnings {List} - Invalid rows and statements which do not parse, appended to. The
+            rows are kept and reported again when they are resolved.
+    Returns:
+        {List} - (row index, row) pairs with integer offsets, None if not a number
+    """
+    columns, rows = read_rows(file_name, KEYWORD_COLUMNS)
+    missing = [column for column in ALIAS_COLUMNS
+               if column not in columns and column != 'start row/col']
+    if missing:
+        errors.append(MISSING_COLUMNS_MESSAGE.format(', '.join(missing), file_name))
+        return []
+    for idx, row in rows:
+        row.setdefault('start row/col', '')
+        row['Alias'] = row['Alias'].strip()
+        alias = row['Alias']
+        if not alias or alias[0] == '#':
+            continue
+        if alias[0] in 'rc':
+            row['offset'] = to_offset(row['offset'])
+            if row['offset'] is None or row['Keyword'] == '':
+                warnings.append(cfg.INVALID_ALIAS_MESSAGE.format(alias, idx + 2, file_name))
+        elif alias[0] == 's' and not is_valid_statement(row['statement']):
+            warnings.append(cfg.MAPPING_ERROR_MESSAGE.format(row['statement'], idx + 2,
+                                                             file_name))
+    return rows
+
+
+def is_valid_mapping_row(row):
+    """
+    Check that a mapping row has its aliases, statement and affected rows and columns
+    Parameters:
+        row {Dictionary} - Parsed row of a mapping file
+    Returns:
+        {Boolean} - True if the row can be evaluated
+    """
+    return bool(row['row_id'] and row['col_id'] and row['statement']) \
+        and row['affected_rows'] is not None and row['affected_cols'] is not None
+
+
+def parse_mapping_file(file_name, errors, warnings):
+    """
+    Parse and validate a mapping file
+    Parameters:
+        file_name {String} - Path of the mapping file
+        errors {List} - Errors which stop the file from being used, appended to
+        warnings {List} - Invalid rows and statements which do not parse, appended to. The
+            rows are kept and reported again when they are evaluated.
+    Returns:
+        {List} - (row index, row) pairs with integer affected rows and columns, None if
+            not an integer
+    """
+    columns, rows = read_rows(file_name)
+    missing = [column for column in MAPPING_COLUMNS if column not in columns]
+    if missing:
+        errors.append(MISSING_COLUMNS_MESSAGE.format(', '.join(missing), file_name))
+        return []
+    for idx, row in rows:
+        if row['row_id'][:1] == '#':
+            continue
+        for column in ('affected_rows', 'affected_cols'):
+            row[column] = to_integer(row[column])
+        if not is_valid_mapping_row(row):
+            warnings.append('{} ({})'.format(cfg.INVALID_MAPPING_MESSAGE.format(idx + 2),
+                                             file_name))
+        elif row['statement'][0] != '[' and not is_valid_statement(row['statement']):
+            warnings.append(cfg.MAPPING_ERROR_MESSAGE.format(row['statement'], idx + 2,
+                                                             file_name))
+    return rows
+
+
+def compile_rules(rule_files=None):
+    """
+    Parse and validate the alias and mapping files into a bundle
+    Parameters:
+        rule_files {Dictionary} - Path of the file to 'alias' or 'mapping', the configured
+            files by default
+    Returns:
+        {Dictionary} - Bundle with the file keys, parsed rows, errors and warnings of every file
+    """
+    rule_files = get_rule_files() if rule_files is None else rule_files
+    bundle = {'version': BUNDLE_VERSION, 'sources': {}, 'rules': {}, 'errors': {},
+              'warnings': {}}
+    for file_name, kind in rule_files.items():
+        errors, warnings = [], []
+        bundle['sources'][file_name] = get_file_key(file_name)
+        parse = parse_alias_file if kind == 'alias' else parse_mapping_file
+        bundle['rules'][file_name] = parse(file_name, errors, warnings)
+        if errors:
+            bundle['errors'][file_name] = errors
+        if warnings:
+            bundle['warnings'][file_name] = warnings
+    return bundle
+
+
+def save_bundle(bundle, bundle_file=None):
+    """
+    Write the bundle through a temporary file
+    Parameters:
+        bundle {Dictionary} - Compiled rules
+        bundle_file {String} - Path of the bundle file
+    """
+    bundle_file = bundle_file or cfg.RULES_BUNDLE_FILE
+    os.makedirs(os.path.dirname(bundle_file) or '.', exist_ok=True)
+    with open(bundle_file + '.tmp', 'wb') as content:
+        pickle.dump(bundle, content, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(bundle_file + '.tmp', bundle_file)
+
+
+def is_current(bundle, rule_files):
+    """
+    Check whether the bundle was compiled from the current version of the rule files
+    Parameters:
+        bundle {Dictionary} - Compiled rules
+        rule_files {Iterable} - Paths of the rule files
+    Returns:
+        {Boolean} - True if no file was added, removed or changed since the bundle was built
+    """
+    if bundle.get('version') != BUNDLE_VERSION or set(bundle['sources']) != set(rule_files):
+        return False
+    try:
+        return all(get_file_key(file_name) == key for file_name, key in bundle['sources'].items())
+    except FileNotFoundError:
+        return False
+
+
+# Bundles loaded in this process, keyed by the absolute path of the bundle file
+_BUNDLES = {}
+_BUNDLE_LOCK = Lock()
+# Rows of the rule files looked up since the start of the batch, keyed by file name
+_LOOKUPS = {}
+
+
+def load_rules(bundle_file=None):
+    """
+    Load the rules bundle, compiling it again when any rule file was added, removed or changed
+    Parameters:
+        bundle_file {String} - Path of the bundle file
+    Returns:
+        {Dictionary} - Compiled rules
+    """
+    bundle_file = bundle_file or cfg.RULES_BUNDLE_FILE
+    rule_files = get_rule_files()
+    with _BUNDLE_LOCK:
+        bundle = _BUNDLES.get(os.path.abspath(bundle_file))
+        if (bundle is None or not is_current(bundle, rule_files)) \
+                and os.path.isfile(bundle_file):
+            try:
+                with open(bundle_file, 'rb') as content:
+                    bundle = pickle.load(content)
+            except (pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+                logger.warning("Rules bundle {} is not readable".format(bundle_file))
+                bundle = None
+        if bundle is None or not is_current(bundle, rule_files):
+            logger.info("Compiling {} alias and mapping files into {}".format(
+                len(rule_files), bundle_file))
+            bundle = compile_rules(rule_files)
+            for messages in bundle['warnings'].values():
+                for message in messages:
+                    logger.warning(message)
+            save_bundle(bundle, bundle_file)
+        _BUNDLES[os.path.abspath(bundle_file)] = bundle
+    return bundle
+
+
+def get_rules(file_name):
+    """
+    Get the parsed rows of an alias or mapping file from the bundle. Whether the file changed
+        is checked once per batch, see reset_rules.
+    Parameters:
+        file_name {String} - Path of the alias or mapping file
+    Returns:
+        {List} - (row index, row) pairs of the file
+    """
+    rows = _LOOKUPS.get(file_name)
+    if rows is not None:
+        return rows
+    bundle = _BUNDLES.get(os.path.abspath(cfg.RULES_BUNDLE_FILE))
+    if bundle is None or file_name not in bundle['sources'] \
+            or get_file_key(file_name) != bundle['sources'][file_name]:
+        bundle = load_rules()
+    if file_name not in bundle['rules']:
+        # Files outside of the configuration are parsed on their own
+        kind = 'mapping' if os.path.basename(file_name).lower().startswith('mapping') \
+            else 'alias'
+        bundle = compile_rules({file_name: kind})
+    if file_name in bundle['errors']:
+        for message in bundle['errors'][file_name]:
+            logger.error(message)
+        raise RulesError(RULES_ERROR_MESSAGE.format(len(bundle['errors'][file_name]),
+                                                    file_name))
+    _LOOKUPS[file_name] = bundle['rules'][file_name]
+    return bundle['rules'][file_name]
+
+
+def reset_rules():
+    """
+    Forget the rule files looked up, so that the next lookup of each file checks again
+        whether it changed. Called at the start of every batch.
+    """
+    _LOOKUPS.clear()
+
+
+def validate_rules():
+    """
+    Compile the alias and mapping files into the bundle and log every error and warning
+        found, without reading any input workbook
+    Returns:
+        {Dictionary} - Path of the file to its errors, empty if all files are valid
+    """
+    bundle = compile_rules()
+    save_bundle(bundle)
+    with _BUNDLE_LOCK:
+        _BUNDLES[os.path.abspath(cfg.RULES_BUNDLE_FILE)] = bundle
+    reset_rules()
+    for file_name in bundle['sources']:
+        for message in bundle['warnings'].get(file_name, []):
+            logger.warning(message)
+        for message in bundle['errors'].get(file_name, []):
+            logger.error(message)
+    logger.info("Validated {} alias and mapping files, {} with errors".format(
+        len(bundle['sources']), len(bundle['errors'])))
+    return bundle['errors']
@@ -0,0 +1,199 @@
+""" Cost model of batch runs built from the timings of previous runs """
+
+import json
+import os
+from heapq import heappush, heappop
+from statistics import mean
+from threading import Condition
+from loguru import logger
+import config as cfg
+
+
+def load_history(history_file=None):
+    """
+    Load the timings recorded by previous runs
+    Parameters:
+        history_file {String} - Path of the timings file
+    Returns:
+        {Dictionary} - Country to list of recorded runs
+    """
+    history_file = history_file or cfg.TIMINGS_FILE
+    if not os.path.isfile(history_file):
+        return {}
+    with open(history_file) as timings:
+        return json.load(timings)
+
+
+def save_history(history, history_file=None):
+    """
+    Save the recorded timings, keeping the latest runs of each country
+    Parameters:
+        history {Dictionary} - Country to list of recorded runs
+        history_file {String} - Path of the timings file
+    """
+    history_file = history_file or cfg.TIMINGS_FILE
+    os.makedirs(os.path.dirname(history_file) or '.', exist_ok=True)
+    history = {country: runs[-cfg.TIMINGS_HISTORY:] for country, runs in history.items()}
+    with open(history_file + '.tmp', 'w') as timings:
+        json.dump(history, timings, indent=2, sort_keys=True)
+    os.replace(history_file + '.tmp', history_file)
+
+
+def record_run(history, country, tab, stages, peak_mb):
+    """
+    Add the timings of a country run to the history
+    Parameters:
+        history {Dictionary} - Country to list of recorded runs
+        country {String} - Country name
+        tab {String} - Generated tab
+        stages {Dictionary} - Pipeline stage to duration in seconds
+        peak_mb {Float} - Memory used by the country run in MB
+    """
+    history.setdefault(country, []).append({
+        'duration': sum(stages.values()),
+        'tabs': {tab: sum(stages.values())},
+        'stages': stages,
+        'peak_mb': peak_mb,
+    })
+
+
+def estimate_stages(history, runs, duration, stage_names):
+    """
+    Split the expected duration of a country run over the pipeline stages
+    Parameters:
+        history {Dictionary} - Country to list of recorded runs
+        runs {List} - Recorded runs of the country, empty if there are none
+        duration {Float} - Expected duration of the country run in seconds
+        stage_names {List} - Names of the pipeline stages
+    Returns:
+        {Dictionary} - Stage to expected duration in seconds
+    """
+    if runs:
+        return {stage: mean(run['stages'].get(stage, 0) for run in runs) for stage in stage_names}
+    # Other countries give the share of each stage, without any history split evenly
+    totals = {stage: sum(run['stages'].get(stage, 0) for country_runs in history.values()
+                         for run in country_runs) for stage in stage_names}
+    total = sum(totals.values())
+    if not total:
+        return {stage: duration / len(stage_names) for stage in stage_names}
+    return {stage: duration * totals[stage] / total for stage in stage_names}
+
+
+def estimate_cost(history, country, stage_names):
+    """
+    Estimate the duration and memory of a country run from its recent runs
+    Parameters:
+        history {Dictionary} - Country to list of recorded runs
+        country {String} - Country name
+        stage_names {List} - Names of the pipeline stages
+    Returns:
+        {Tuple} - Expected duration in seconds, memory in MB and stage durations
+    """
+    runs = history.get(country, [])
+    if runs:
+        duration = mean(run['duration'] for run in runs)
+        return duration, max(run['peak_mb'] for run in runs), \
+            estimate_stages(history, runs, duration, stage_names)
+
+    # Without history the group of the country gives the relative cost
+    if country in cfg.GROUP2_COUNTRIES:
+        weight = cfg.DEFAULT_COST_WEIGHT['group2']
+    elif country in cfg.GROUP1_COUNTRIES:
+        weight = cfg.DEFAULT_COST_WEIGHT['group1']
+    else:
+        weight = cfg.DEFAULT_COST_WEIGHT['other']
+    memory = 0
+    if history:
+        duration = weight * mean(mean(run['duration'] for run in country_runs)
+                                 for country_runs in history.values())
+        memory = max(run['peak_mb'] for country_runs in history.values() for run in country_runs)
+    else:
+        duration = weight
+    return duration, memory, estimate_stages(history, runs, duration, stage_names)
+
+
+# pylint: disable=too-many-locals
+def plan_batch(countries, stages, memory_ceiling_mb=None, history=None):
+    """
+    Order the countries longest expected first and simulate them flowing through the
+        pipeline stages, starting a country only once its memory fits under the ceiling
+    Parameters:
+        countries {List} - Countries of the batch
+        stages {List} - Pipeline stages as (name, number of workers) pairs
+        memory_ceiling_mb {Float} - Memory available to the batch in MB, None for no limit
+        history {Dictionary} - Country to list of recorded runs
+    Returns:
+        {Tuple} - Countries in start order, predicted batch duration in seconds and
+            country to expected (duration, memory)
+    """
+    history = load_history() if history is None else history
+    stage_names = [name for name, _ in stages]
+    costs = {country: estimate_cost(history, country, stage_names) for country in countries}
+    order = sorted(countries, key=lambda country: costs[country][0], reverse=True)
+
+    free_at = {name: [0.0] * max(1, workers) for name, workers in stages}
+    running = []
+    memory_used = 0.0
+    makespan = 0.0
+    for country in order:
+        _, memory, stage_costs = costs[country]
+        ready = 0.0
+        # A country larger than the ceiling still runs, once everything else is done
+        while running and memory_ceiling_mb and memory_used + memory > memory_ceiling_mb:
+            finished, finished_memory = heappop(running)
+            memory_used -= finished_memory
+            ready = max(ready, finished)
+        for name in stage_names:
+            worker = min(range(len(free_at[name])), key=free_at[name].__getitem__)
+            ready = max(ready, free_at[name][worker]) + stage_costs[name]
+            free_at[name][worker] = ready
+        heappush(running, (ready, memory))
+        memory_used += memory
+        makespan = max(makespan, ready)
+    return order, makespan, {country: cost[:2] for country, cost in costs.items()}
+
+
+class MemoryGate:
+    """
+    Admits jobs only while their expected memory fits under the ceiling
+    """
+
+    def __init__(self, ceiling_mb=None):
+        self.ceiling_mb = ceiling_mb
+        self.used_mb = 0.0
+        self._condition = Condition()
+
+    def acquire(self, memory_mb):
+        """
+        Wait until the memory of the job fits, a job larger than the ceiling runs alone
+        Parameters:
+            memory_mb {Float} - Expected memory of the job in MB
+        """
+        with self._condition:
+            while self.ceiling_mb and self.used_mb > 0 \
+                    and self.used_mb + memory_mb > self.ceiling_mb:
+                self._condition.wait()
+            self.used_mb += memory_mb
+
+    def release(self, memory_mb):
+        """
+        Return the memory of a finished job
+        Parameters:
+            memory_mb {Float} - Expected memory of the job in MB
+        """
+        with self._condition:
+            self.used_mb -= memory_mb
+            self._condition.notify_all()
+
+
+def log_plan(order, makespan, costs):
+    """
+    Log the planned order and the predicted duration of the batch
+    Parameters:
+        order {List} - Countries in start order
+        makespan {Float} - Predicted batch duration in seconds
+        costs {Dictionary} - Country to expected (duration, memory)
+    """
+    for country in order:
+        logger.info("Expected cost of {}: {:.1f}s, {:.0f} MB".format(country, *costs[country]))
+    logger.info("Predicted batch duration: {:.1f}s".format(makespan))
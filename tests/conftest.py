@@ -0,0 +1,17 @@
+""" Test setup: the modules of the repository are imported as the src package """
+
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# config is imported as a top level module
+sys.path.insert(0, ROOT)
+try:
+    import src  # pylint: disable=unused-import
+except ImportError:
+    # Checked out on its own, the repository itself is the src package
+    PACKAGE = types.ModuleType('src')
+    PACKAGE.__path__ = [ROOT]
+    sys.modules['src'] = PACKAGE
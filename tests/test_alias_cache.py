@@ -0,0 +1,67 @@
+""" Cached alias positions are only used while the keyword is first found there """
+
+import pandas as pd
+import pytest
+from src.alias_cache import AliasCache
+from src.helper import add_metadata, get_col_index, get_row_index
+
+ROW_ALIAS = {'Alias': 'r_total', 'Keyword': r'\|Total\|', 'start row/col': '', 'offset': 0}
+COLUMN_ALIAS = {'Alias': 'c_mar', 'Keyword': r'\|Mar\|', 'start row/col': '', 'offset': 0}
+
+
+def make_sheet(labels, headers=('Name', 'Jan', 'Feb', 'Mar')):
+    """
+    Build a sheet with metadata from its row labels and header row
+    Parameters:
+        labels {List} - Labels of the first column below the header
+        headers {Tuple} - Header row
+    Returns:
+        {DataFrame} - Sheet with metadata row (ar) and column (ac)
+    """
+    rows = [list(headers)] + [[label] + [1] * (len(headers) - 1) for label in labels]
+    return add_metadata(pd.DataFrame(rows))
+
+
+@pytest.fixture(name='cache')
+def fixture_cache(tmp_path):
+    """
+    Alias cache holding the positions found in a first sheet
+    """
+    cache = AliasCache(str(tmp_path / 'alias_positions.json'))
+    layout = cache.get_layout('alias.csv', make_sheet(['A', 'Total', 'B']))
+    cache.store(layout, ROW_ALIAS, 0, 2)
+    cache.store(layout, COLUMN_ALIAS, 0, 3)
+    return cache, layout
+
+
+@pytest.mark.parametrize('labels, headers, found', [
+    (['A', 'Total', 'B'], ('Name', 'Jan', 'Feb', 'Mar'), True),
+    (['Total', 'A', 'Total'], ('Name', 'Mar', 'Feb', 'Mar'), False),
+    (['A', 'B', 'Total'], ('Name', 'Jan', 'Mar', 'Feb'), False),
+    (['A', 'Sub Total', 'B'], ('Name', 'Jan', 'Feb', 'Mar Q1'), False),
+])
+def test_find_matches_search(cache, labels, headers, found):
+    alias_cache, layout = cache
+    sheet = make_sheet(labels, headers)
+    row_index = alias_cache.find(layout, ROW_ALIAS, sheet)
+    col_index = alias_cache.find(layout, COLUMN_ALIAS, sheet)
+    if found:
+        assert row_index == get_row_index(sheet, ROW_ALIAS['Keyword'])
+        assert col_index == get_col_index(sheet, COLUMN_ALIAS['Keyword'])
+    else:
+        assert row_index is None and col_index is None
+
+
+def test_find_other_keyword(cache):
+    alias_cache, layout = cache
+    alias = dict(ROW_ALIAS, Keyword=r'\|B\|')
+    assert alias_cache.find(layout, alias, make_sheet(['A', 'Total', 'B'])) is None
+    assert (alias_cache.hits, alias_cache.misses) == (0, 1)
+
+
+def test_save(cache):
+    alias_cache, _ = cache
+    alias_cache.save()
+    alias_cache.clear()
+    layout = alias_cache.get_layout('alias.csv', make_sheet(['A', 'Total', 'B']))
+    assert layout['r_total'] == [ROW_ALIAS['Keyword'], '', 0, 2]
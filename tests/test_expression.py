@@ -0,0 +1,54 @@
+""" Statements evaluated by the compiled expression engine give the same values as eval """
+
+from datetime import datetime
+from decimal import Decimal
+import pandas as pd
+import pytest
+from src.expression import StatementError, evaluate
+from src.report_generator import run_statement
+import config as cfg
+
+STATEMENTS = [
+    'input_source[c_p1input][r_l1input]',
+    'input_source[c_p1input][r_l1input] - input_source[c_p2input][r_l2input]',
+    'cell_sum([input_source[c_p1input][r_l1input], input_source[c_p2input][r_l1input]])',
+    'cell_diff(input_source[c_p1input][r_l1input], input_source[c_p1input][r_l2input])',
+    'cell_div(input_source[c_p1input][r_l1input], input_source[c_p1input][r_l2input])',
+    'input_source[c_p1input][r_l1input] if cob_date.month > 2 else 0',
+    'cob_date.month',
+    "prev_month.strftime('%b-%y')",
+    'max(input_source[c_p1input][r_l1input], input_source[c_p2input][r_l1input], 0)',
+    'abs(-input_source[c_p2input][r_l2input])',
+    'round(input_source[c_p1input][r_l2input] / 3, 2)',
+    'np.nansum([input_source[c_p1input][r_l1input], np.nan])',
+    'pd.isna(input_source[c_p1input][r_l3input])',
+    'Decimal(2) * 3',
+    "country == 'Korea'",
+]
+
+
+@pytest.fixture(name='context')
+def fixture_context():
+    """
+    Statement context with an input frame and resolved aliases
+    """
+    input_source = pd.DataFrame({1: [10.0, 4.0, None], 2: [2.5, -7.0, 1.0]})
+    return {'input_source': input_source, 'c_p1input': 1, 'c_p2input': 2, 'r_l1input': 0,
+            'r_l2input': 1, 'r_l3input': 2, 'country': 'Korea',
+            'cob_date': datetime(2021, 3, 31), 'prev_month': datetime(2021, 2, 28)}
+
+
+@pytest.mark.parametrize('statement', STATEMENTS)
+def test_engines_agree(statement, context, monkeypatch):
+    monkeypatch.setattr(cfg, 'STATEMENT_ENGINE', 'eval')
+    expected = run_statement(statement, context)
+    monkeypatch.setattr(cfg, 'STATEMENT_ENGINE', 'vm')
+    assert run_statement(statement, context) == expected
+
+
+@pytest.mark.parametrize('statement', [
+    "np.load('data.npy')", "pd.read_csv('rules.csv')", "__import__('os')",
+    'input_source.to_csv', 'cfg.__dict__'])
+def test_unsafe_names_rejected(statement, context):
+    with pytest.raises(StatementError):
+        evaluate(statement, context)
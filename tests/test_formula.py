@@ -0,0 +1,55 @@
+""" Excel SUM and the dependency order of the formulae evaluated in the output """
+
+import pytest
+from src.formula import ExcelError, RangeValues, compile_formula, excel_sum, order_formulae
+
+SHEET_NAMES = {'exp': 'Exp'}
+
+
+def calculate_formula(formula, cells):
+    """
+    Evaluate a formula of the Exp sheet over constant cells
+    Parameters:
+        formula {String} - Formula starting with =
+        cells {Dictionary} - (row, column) to value, 1-based
+    Returns:
+        Value of the formula
+    """
+    function, _ = compile_formula(formula, 'Exp', SHEET_NAMES)
+    return function(lambda sheet, cell: cells.get(cell))
+
+
+@pytest.mark.parametrize('values, expected', [
+    ((1, 2.5), 3.5),
+    (('2', True), 3),
+    ((RangeValues([1, '2', True, None, '']),), 1),
+    ((RangeValues([4]), RangeValues(['n/m'])), 4),
+])
+def test_excel_sum(values, expected):
+    assert excel_sum(*values) == expected
+
+
+def test_excel_sum_error():
+    with pytest.raises(ExcelError):
+        excel_sum(RangeValues([1, '#DIV/0!']))
+
+
+def test_sum_references_skip_text_and_logicals():
+    cells = {(5, 2): 'n/m', (6, 2): True, (7, 2): 1, (8, 2): 2}
+    assert calculate_formula('=SUM(B5)', cells) == 0
+    assert calculate_formula('=SUM(B6,B7)', cells) == 1
+    assert calculate_formula('=SUM(B5:B8)', cells) == 3
+    assert calculate_formula('=SUM(B7:B8,"2",TRUE)', cells) == 6
+
+
+def test_order_formulae():
+    order, blocked = order_formulae({'C1': ['B1', 'A1'], 'B1': ['A1'], 'A1': []})
+    assert order == ['A1', 'B1', 'C1']
+    assert not blocked
+
+
+def test_order_formulae_blocks_cycles_and_unsupported():
+    order, blocked = order_formulae({'A1': ['B1'], 'B1': ['A1'], 'C1': ['A1'], 'D1': None,
+                                     'E1': ['D1'], 'F1': []})
+    assert order == ['F1']
+    assert blocked == {'A1', 'B1', 'C1', 'D1', 'E1'}
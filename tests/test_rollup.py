@@ -0,0 +1,39 @@
+""" Sums of the member tabs of an aggregate and the statements they are used for """
+
+from decimal import Decimal
+import numpy as np
+import pytest
+from src.rollup import is_additive, sum_cells
+
+ALIAS_STATEMENTS = {'s_top': 'input_source[c_p1][r_l1] + input_source[c_p1][r_l2]',
+                    's_ratio': 'cell_div(input_source[c_p1][r_l1], input_source[c_p1][r_l2])',
+                    's_loop': 's_loop + 1'}
+
+
+def test_sum_cells():
+    blocks = np.array([[[1.5, None, '#DIV/0!'], [2, '', None]],
+                       [[2.5, None, 1], ['3', 'n/m', None]]], dtype=object)
+    sums, all_blank = sum_cells(blocks)
+    assert sums[0, 0] == Decimal('4')
+    assert sums[0, 1] is None
+    assert sums[0, 2] == '#DIV/0!'
+    assert sums[1, 0] == Decimal('5')
+    assert sums[1, 2] is None
+    assert all_blank.tolist() == [[False, True, False], [False, False, True]]
+
+
+@pytest.mark.parametrize('statement, expected', [
+    ('input_source[c_p1][r_l1]', True),
+    ('input_source[c_p1][r_l1] - input_source[c_p2][r_l1]', True),
+    ('cell_sum([input_source[c_p1][r_l1], input_source[c_p1][r_l2]])', True),
+    ('-cell_diff(input_source[c_p1][r_l1], exp_source[c_p1][r_l2])', True),
+    ('s_top', True),
+    ('cell_div(input_source[c_p1][r_l1], input_source[c_p1][r_l2])', False),
+    ('input_source[c_p1][r_l1] * 2', False),
+    ('cob_date.month', False),
+    ('s_ratio', False),
+    ('s_loop', False),
+    ('input_source[c_p1', False),
+])
+def test_is_additive(statement, expected):
+    assert is_additive(statement, ALIAS_STATEMENTS) is expected
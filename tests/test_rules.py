@@ -0,0 +1,44 @@
+""" Rule files read with the csv module give the rows pandas.read_csv gave """
+
+import pandas as pd
+import pytest
+from src.rules import KEYWORD_COLUMNS, parse_mapping_file, read_rows
+
+ALIAS_FILES = {
+    'numeric keywords': 'Alias,Keyword,start row/col,offset,statement\n'
+                        'r_a,2021,,1,\n\n   \n,,,,\nr_b,5,3,,\n#r_c,7,,,\n',
+    'integer keywords': 'Alias,Keyword,start row/col,offset,statement\n'
+                        'r_a,2021,1,1,\nr_b, 5,2,-1,\n',
+    'text keywords': 'Alias,Keyword,start row/col,offset,statement\n'
+                     'r_a,\\|Total\\|,,0,\nr_b,12,x,2.0,\n\n'
+                     's_a,,,,"cell_sum([input_source[c_p1][r_a], 1])"\n',
+}
+
+
+@pytest.mark.parametrize('content', ALIAS_FILES.values(), ids=ALIAS_FILES.keys())
+def test_alias_rows_match_read_csv(content, tmp_path):
+    alias_file = tmp_path / 'alias.csv'
+    alias_file.write_text(content)
+    expected = pd.read_csv(alias_file).dropna(how='all', axis=0).fillna('')
+    _, rows = read_rows(str(alias_file), KEYWORD_COLUMNS)
+    assert [idx for idx, _ in rows] == list(expected.index)
+    for (_, row), (_, expected_row) in zip(rows, expected.iterrows()):
+        for column in ['Alias', 'statement'] + KEYWORD_COLUMNS:
+            assert row[column] == expected_row[column]
+            # pylint: disable=unidiomatic-typecheck
+            assert type(row[column]) == type(expected_row[column])
+
+
+def test_mapping_rows(tmp_path):
+    mapping_file = tmp_path / 'mapping.csv'
+    mapping_file.write_text('row_id,col_id,statement,affected_rows,affected_cols\n'
+                            'r_a,c_a,input_source[c_a][r_a],0,1\n\n'
+                            'r_b,c_b,input_source[c_b][r_b],1.0,\n'
+                            '#r_c,c_c,,,\n')
+    warnings = []
+    rows = parse_mapping_file(str(mapping_file), [], warnings)
+    assert [idx for idx, _ in rows] == list(pd.read_csv(mapping_file).index)
+    assert (rows[0][1]['affected_rows'], rows[0][1]['affected_cols']) == (0, 1)
+    assert (rows[1][1]['affected_rows'], rows[1][1]['affected_cols']) == (1, None)
+    # Only the row without affected columns is invalid, numbered as the CSV row
+    assert len(warnings) == 1 and 'row 3 ' in warnings[0]
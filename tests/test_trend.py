@@ -0,0 +1,34 @@
+""" Forms of the cell statements compared between periods in trend mode """
+
+from src.trend import get_period_form
+
+CONTEXT = {'c_p1input': 3, 'c_p2input': 4, 'c_p3input': 5, 'r_l1input': 1, 'r_l2input': 2}
+INPUT_PERIODS = {'input': 3}
+
+
+def test_same_form_for_next_period():
+    form = get_period_form('cell_div(input_source[c_p1input][r_l1input], '
+                           'input_source[c_p1input][r_l2input])', CONTEXT, 0, INPUT_PERIODS)
+    assert form == 'cell_div(input_source[][r_l1input], input_source[][r_l2input])'
+    assert get_period_form('cell_div(input_source[c_p2input][r_l1input], '
+                           'input_source[c_p2input][r_l2input])', CONTEXT, 1,
+                           INPUT_PERIODS) == form
+
+
+def test_other_period_has_no_form():
+    assert get_period_form('input_source[c_p3input][r_l1input]', CONTEXT, 0,
+                           INPUT_PERIODS) is None
+    assert get_period_form('input_source[c_p1input][r_l1input] + '
+                           'input_source[c_p2input][r_l1input]', CONTEXT, 0,
+                           INPUT_PERIODS) is None
+
+
+def test_unresolved_or_whole_frame_has_no_form():
+    assert get_period_form('input_source[c_missing][r_l1input]', CONTEXT, 0,
+                           INPUT_PERIODS) is None
+    assert get_period_form('len(input_source)', CONTEXT, 0, INPUT_PERIODS) is None
+
+
+def test_statement_without_inputs():
+    assert get_period_form('exp_source[c_p1input][r_l1input] * 2', CONTEXT, 0,
+                           INPUT_PERIODS) == 'exp_source[c_p1input][r_l1input] * 2'
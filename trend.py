@@ -0,0 +1,303 @@
+""" Trend mode: roll the periods of the previous month's report and evaluate only what changed """
+
+import os
+import re
+from decimal import Decimal
+from numbers import Number
+import numpy as np
+from loguru import logger
+from src.helper import append_suffix, apply_statement, get_alias_suffix, get_prev_mth, \
+    get_statement_frames, read_sheet
+from src.metrics import REGISTRY
+from src.report_generator import get_country_files, run_statement
+from src.rollup import get_alias_statements
+from src.rules import get_rules
+from src.xlsx_writer import is_blank
+import config as cfg
+
+# Names whose value depends on the report date, a cell reading them is never carried over.
+# The configuration holds the report dates and quarters of the run.
+DATE_NAMES = {'cob_date', 'prev_month', 'calc_month_table', 'get_quarter', 'get_prev_mth', 'cfg'}
+
+
+def get_previous_files(country, cob_date):
+    """
+    Get the input file and the generated report of the month before the COB date
+    Parameters:
+        country {String} - Country name
+        cob_date {Date} - COB date of the run
+    Returns:
+        {Tuple} - Path of the previous input file and of the previous report
+    """
+    return get_country_files(country, get_prev_mth(cob_date))
+
+
+def get_sheet_suffix(sheet_name):
+    """
+    Get the alias suffix of the alias file resolved against a sheet
+    Parameters:
+        sheet_name {String} - Sheet of EXP_ALIAS_SOURCES
+    Returns:
+        {String} - Alias suffix, None if no alias file is resolved against the sheet
+    """
+    for alias_file, alias_sheet in cfg.EXP_ALIAS_SOURCES.items():
+        if alias_sheet == sheet_name:
+            return get_alias_suffix(alias_file)
+    return None
+
+
+def get_values(data_frame):
+    """
+    Get the cell values of a sheet without its metadata row and column
+    Parameters:
+        data_frame {DataFrame} - Sheet, with or without metadata
+    Returns:
+        {Array} - Cell values by position
+    """
+    if 'ac' in data_frame.columns:
+        data_frame = data_frame.drop(index='ar', columns='ac')
+    return data_frame.to_numpy(dtype=object)
+
+
+def get_used_rows(values):
+    """
+    Get the number of rows up to the last row with a value, sheets with metadata end with
+        a blank row
+    Parameters:
+        values {Array} - Cell values by position
+    Returns:
+        {Integer} - Number of used rows
+    """
+    used = [idx for idx, row in enumerate(values) if not all(map(is_blank, row))]
+    return used[-1] + 1 if used else 0
+
+
+def is_same_rows(previous, current):
+    """
+    Check that two sheets have the same size and the same row labels, so that the cells of
+        the previous month are found at the same positions
+    Parameters:
+        previous {Array} - Cell values of the previous month
+        current {Array} - Cell values of the current month
+    Returns:
+        {Boolean} - True if the rows of the sheets match
+    """
+    rows = get_used_rows(previous)
+    if rows != get_used_rows(current) or previous.shape[1] != current.shape[1]:
+        return False
+    return all(is_blank(left) and is_blank(right) or left == right
+               for left, right in zip(previous[:rows, 0], current[:rows, 0]))
+
+
+def is_same_column(previous, current):
+    """
+    Compare a column of the previous month with a column of the current month
+    Parameters:
+        previous {Array} - Values of the previous column
+        current {Array} - Values of the current column
+    Returns:
+        {Boolean} - True if every cell is equal or blank in both
+    """
+    return all(is_blank(left) and is_blank(right) or left == right
+               for left, right in zip(previous, current))
+
+
+def get_restated_periods(context, previous_input, periods, input_periods):
+    """
+    Find the periods whose inputs changed since the previous month. Input sheets hold the
+        same window of periods as the tab, so period k of this month is period k + 1 of the
+        previous month. The header row is not compared, its labels may name the periods
+        relative to the report month.
+    Parameters:
+        context {Dictionary} - Statement context with resolved aliases
+        previous_input {String} - Input file of the previous month
+        periods {Integer} - Number of periods of the tab
+        input_periods {Dictionary} - Input sheet to the alias of its first period column
+    Returns:
+        {Set} - Indexes of the restated periods, None if the inputs can not be compared
+    """
+    sheets = sorted(input_periods)
+    previous = read_sheet(previous_input, sheets, is_read_only=True, trim_sheets=sheets)
+    if len(sheets) == 1:
+        previous = {sheets[0]: previous}
+
+    restated = set()
+    for sheet_name, alias in input_periods.items():
+        suffix = get_sheet_suffix(sheet_name)
+        if suffix is None or suffix + '_source' not in context:
+            return None
+        current = get_values(context[suffix + '_source'])
+        old = get_values(previous[sheet_name])
+        if not is_same_rows(old, current):
+            logger.info("Rows of sheet {} changed since the previous month".format(sheet_name))
+            return None
+        first = run_statement(append_suffix(alias, suffix), context)
+        if first + periods > current.shape[1]:
+            return None
+        for period in range(periods - 1):
+            if not is_same_column(old[1:, first + period + 1], current[1:, first + period]):
+                restated.add(period)
+    return restated
+
+
+def to_carried_value(value):
+    """
+    Convert a number read from the previous report as the evaluated cells are, so that carried
+        and evaluated cells of the tab are of the same type
+    Parameters:
+        value {Object} - Value of the cell of the previous report
+    Returns:
+        {Object} - Decimal for numbers, other values unchanged
+    """
+    if isinstance(value, Number) and not isinstance(value, (bool, np.bool_, Decimal)):
+        return Decimal(str(value))
+    return value
+
+
+def is_carried(statement, suffix, input_suffixes, alias_statements):
+    """
+    Check whether the value of a statement for an old period may be the value of the previous
+        month, as it only reads input sheets whose periods are compared and does not depend on
+        the report date
+    Parameters:
+        statement {String} - Mapping statement
+        suffix {String} - Alias suffix of the tab
+        input_suffixes {Set} - Alias suffixes of the compared input sheets
+        alias_statements {Dictionary} - Alias name to statement of the statement aliases
+    Returns:
+        {Boolean} - True if the cells of the statement can be copied from the previous report
+    """
+    frames = get_statement_frames(statement)
+    names = set(re.findall(r'[A-Za-z_]\w*', statement))
+    return suffix not in frames and frames <= input_suffixes \
+        and not names & set(alias_statements) and not names & DATE_NAMES
+
+
+def get_period_form(statement, context, period, input_periods):
+    """
+    Get the form of a cell statement without its input columns, which must all be the period
+        of the destination column. A cell of the previous month one column later with the same
+        form read the same inputs. Columns which stay in place, e.g. year to date or latest
+        period, are not of the period.
+    Parameters:
+        statement {String} - Cell statement with the aliases suffixed
+        context {Dictionary} - Statement context with resolved aliases
+        period {Integer} - Period of the destination column
+        input_periods {Dictionary} - Alias suffix of the input sheets to their first period
+            column
+    Returns:
+        {String} - Statement with its input columns left out, None if it reads other columns
+    """
+    form = []
+    last = 0
+    for match in re.finditer(r'\b({})(?:{})(\[([^\[\]:]+)\])?'.format(
+            '|'.join(input_periods), '|'.join(cfg.FRAME_SUFFIXES)), statement):
+        if match.group(2) is None:
+            return None
+        try:
+            column = run_statement(match.group(3), context)
+        except Exception:  # pylint: disable=broad-except
+            return None
+        if not isinstance(column, (int, np.integer)) \
+                or column - input_periods[match.group(1)] != period:
+            return None
+        form.append(statement[last:match.start(2)] + '[]')
+        last = match.end(2)
+    return ''.join(form) + statement[last:]
+
+
+# pylint: disable=too-many-locals, too-many-arguments, too-many-branches
+def roll_mapping(mapping_file, dest_source, context, suffix, cob_date, tab, spec):
+    """
+    Copy the cells of the periods carried over from the previous month's report, shifted by
+        one period. The newest period, restated periods, columns outside of the periods, cells
+        reading other periods, other sheets or the tab itself and cells whose statement differs
+        from the one of the next period are left to be evaluated.
+    Parameters:
+        mapping_file {String} - Mapping file of the tab
+        dest_source {DataFrame} - Destination frame with metadata
+        context {Dictionary} - Statement context with resolved aliases
+        suffix {String} - Alias suffix of the tab
+        cob_date {Date} - COB date of the report
+        tab {String} - Sheet of the tab
+        spec {Tuple} - Alias of the first period column, number of periods oldest first and
+            input sheet to the alias of its first period column
+    Returns:
+        {Dictionary} - Index of the mapping rows to the row and column offsets of the cells of
+            their block copied from the previous report
+    """
+    period_alias, periods, input_periods = spec
+    previous_input, previous_report = get_previous_files(context['country'], cob_date)
+    if not os.path.isfile(previous_input) or not os.path.isfile(previous_report):
+        logger.info("No report of the previous month for {}, all periods are evaluated".format(
+            context['country']))
+        return {}
+
+    previous = get_values(read_sheet(previous_report, tab, is_read_only=True))
+    if not is_same_rows(previous, get_values(dest_source)):
+        logger.info("Rows of {} changed since the previous month, all periods are "
+                    "evaluated".format(tab))
+        return {}
+    restated = get_restated_periods(context, previous_input, periods, input_periods)
+    if restated is None:
+        return {}
+    if restated:
+        logger.info("Inputs of {} periods of {} were restated".format(
+            len(restated), context['country']))
+
+    first = run_statement(append_suffix(period_alias, suffix), context)
+    carried = set(range(periods - 1)) - restated
+    input_firsts = {}
+    for sheet_name, alias in input_periods.items():
+        sheet_suffix = get_sheet_suffix(sheet_name)
+        input_firsts[sheet_suffix] = run_statement(append_suffix(alias, sheet_suffix), context)
+    # Statement of the cells of the tab, None for the statements which are not carried
+    cell_statements = {}
+    blocks = []
+    alias_statements = get_alias_statements()
+    for idx, row in get_rules(mapping_file):
+        if row['row_id'][:1] == '#':
+            continue
+        try:
+            row_index = run_statement(append_suffix(row['row_id'], suffix), context)
+            col_index = run_statement(append_suffix(row['col_id'], suffix), context)
+            statements = apply_statement(row['statement'], int(row['affected_rows']),
+                                         int(row['affected_cols']))
+        except Exception:  # pylint: disable=broad-except
+            # Invalid rows are reported when they are evaluated
+            continue
+        if row_index is None or col_index is None:
+            continue
+        if not is_carried(row['statement'], suffix, set(input_firsts), alias_statements):
+            statements = np.full(statements.shape, None)
+        else:
+            blocks.append((idx, row_index, col_index, statements))
+        for row_num, col_num in np.ndindex(statements.shape):
+            cell_statements[row_index + row_num, col_index + col_num] = statements[row_num][col_num]
+
+    # A cell is copied when the previous month's cell one column later had the same statement
+    # for the next period
+    copied = {}
+    for idx, row_index, col_index, statements in blocks:
+        cells = set()
+        for row_num, col_num in np.ndindex(statements.shape):
+            cell = (row_index + row_num, col_index + col_num)
+            period = cell[1] - first
+            next_statement = cell_statements.get((cell[0], cell[1] + 1))
+            if period not in carried or next_statement is None:
+                continue
+            form = get_period_form(str(statements[row_num][col_num]), context, period,
+                                   input_firsts)
+            if form is None or form != get_period_form(str(next_statement), context,
+                                                       period + 1, input_firsts):
+                continue
+            value = previous[cell[0], cell[1] + 1]
+            if not is_blank(value):
+                dest_source.at[cell] = to_carried_value(value)
+            cells.add((row_num, col_num))
+        if cells:
+            copied[idx] = cells
+
+    REGISTRY.inc('mapping_cells_reused_total', sum(map(len, copied.values())),
+                 country=context['country'], tab=suffix)
+    return copied
@@ -0,0 +1,179 @@
+""" Watch the input directory and pre-parse country input files as they arrive """
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import listdir, path
+from time import sleep, monotonic
+from loguru import logger
+from src.input_cache import InputCache, get_file_key
+from src.batch import read_stage, resolve_stage, evaluate_stage, save_stage
+from src.report_generator import get_country_files
+from src.expression import CACHE_STATS
+from src.alias_cache import ALIAS_CACHE
+from src.metrics import REGISTRY, install_log_counter
+import config as cfg
+
+
+def get_required_inputs(country, cob_date):
+    """
+    Get the input files which need to be present before the report of the country is generated
+    Parameters:
+        country {String} - Country name
+        cob_date {Date} - COB date of the run
+    Returns:
+        {Dictionary} - Input type to path of the input file
+    """
+    country_input_file, _ = get_country_files(country, cob_date)
+    return {
+        'country': country_input_file,
+        'capital': cfg.INPUT_DIR + cfg.COUNTRY_CAPITAL_FILE.format(
+            cob_date.strftime(cfg.CAPITAL_FILE_DATE_FORMAT)),
+        'weekly': cfg.INPUT_DIR + cfg.WEEKLY_COUNTRY_FILE.format(
+            cob_date.strftime(cfg.WEEKLY_FILE_DATE_FORMAT)),
+    }
+
+
+def parse_country_file(country, cob_date):
+    """
+    Build the loader which reads the country input file and resolves its aliases
+    Parameters:
+        country {String} - Country name
+        cob_date {Date} - COB date of the run
+    Returns:
+        {Function} - Loader returning the batch job of the country, ready for evaluation
+    """
+    def loader(_):
+        return resolve_stage(read_stage({'country': country, 'cob_date': cob_date,
+                                         'suffix': 'exp'}))
+    return loader
+
+
+def scan_input_dir(required):
+    """
+    Get the required input files present in the input directory
+    Parameters:
+        required {Set} - Paths of the input files being waited for
+    Returns:
+        {Dictionary} - Path to file key of the required files found
+    """
+    found = {}
+    for file_name in listdir(cfg.INPUT_DIR):
+        file_path = cfg.INPUT_DIR + file_name
+        if file_path in required and path.isfile(file_path):
+            found[file_path] = get_file_key(file_path)
+    return found
+
+
+def generate_report(job):
+    """
+    Evaluate and save the report of a pre-parsed country job
+    Parameters:
+        job {Dictionary} - Batch job with the report data and resolved aliases
+    Returns:
+        {Dictionary} - Batch job with the path of the saved report
+    """
+    return save_stage(evaluate_stage(job))
+
+
+# pylint: disable=too-many-locals, too-many-branches
+def watch_inputs(countries, poll_interval=None, timeout=None):
+    """
+    Watch the input directory, parse the country input files in the background as soon as
+        they land and generate the report of each country once all of its inputs are present.
+        The shared capital and weekly files are not read by any stage, they are only waited
+        for.
+    Parameters:
+        countries {List} - Countries to generate reports for
+        poll_interval {Integer} - Seconds between scans of the input directory
+        timeout {Integer} - Seconds after which watching stops, None to wait for all countries
+    Returns:
+        {Dictionary} - Country to error of the failed or missing reports
+    """
+    poll_interval = poll_interval or cfg.WATCH_POLL_INTERVAL
+    cob_date = datetime.strptime(cfg.COUNTRY_DATE, '%d-%b-%Y')
+    required = {country: get_required_inputs(country, cob_date) for country in countries}
+    required_files = {file_path for inputs in required.values() for file_path in inputs.values()}
+
+    cache = InputCache()
+    install_log_counter()
+    REGISTRY.track_cache('input', cache)
+    REGISTRY.track_cache('statement', CACHE_STATS)
+    REGISTRY.track_cache('alias', ALIAS_CACHE)
+    parse_pool = ThreadPoolExecutor(max_workers=cfg.WATCH_PARSE_WORKERS)
+    generate_pool = ThreadPoolExecutor(max_workers=cfg.WATCH_GENERATE_WORKERS)
+    last_seen = {}
+    parsing = {}
+    ready = set()
+    generated = {}
+    failures = {}
+    started = monotonic()
+
+    while len(generated) < len(countries):
+        found = scan_input_dir(required_files)
+        for file_path, key in found.items():
+            # A file is parsed once it is unchanged between two scans, i.e. fully copied
+            if last_seen.get(file_path) != key:
+                last_seen[file_path] = key
+                continue
+            if (file_path in parsing and parsing[file_path][0] == key) \
+                    or cache.is_current(file_path) or file_path in ready:
+                continue
+            logger.info(cfg.EXISTENT_FILE_MESSAGE.format(file_path))
+            country = next((country for country, inputs in required.items()
+                            if inputs['country'] == file_path), None)
+            if country is None:
+                ready.add(file_path)
+                continue
+            parsing[file_path] = (key, parse_pool.submit(
+                cache.get, file_path, parse_country_file(country, cob_date)))
+
+        for country, inputs in required.items():
+            if country in generated:
+                continue
+            future = parsing.get(inputs['country'])
+            if future is None or not future[1].done() or any(
+                    file_path not in ready for input_type, file_path in inputs.items()
+                    if input_type != 'country'):
+                continue
+            if future[1].exception():
+                failures[country] = future[1].exception()
+                generated[country] = None
+                continue
+            job = cache.pop(inputs['country'])
+            generated[country] = generate_pool.submit(generate_report, job)
+            logger.info("All inputs of {} are parsed, generating report".format(country))
+
+        if timeout is not None and monotonic() - started > timeout:
+            for country, inputs in required.items():
+                if country not in generated:
+                    missing = [file_path for file_path in inputs.values()
+                               if file_path not in found]
+                    if missing:
+                        failures[country] = cfg.MISSING_FILE_MESSAGE.format(', '.join(missing))
+                    else:
+                        # Present, but not yet stable between two scans or not yet parsed
+                        failures[country] = cfg.PARSING_FILE_MESSAGE.format(', '.join(
+                            file_path for file_path in inputs.values()
+                            if file_path not in ready and not (
+                                file_path in parsing and parsing[file_path][1].done())))
+            break
+        if len(generated) < len(countries):
+            sleep(poll_interval)
+
+    for country, future in generated.items():
+        if future is None:
+            continue
+        try:
+            future.result()
+            REGISTRY.inc('reports_total', status='generated')
+        except (Exception, SystemExit) as err_message:  # pylint: disable=broad-except
+            failures[country] = err_message
+    parse_pool.shutdown()
+    generate_pool.shutdown()
+    ALIAS_CACHE.save()
+    REGISTRY.inc('reports_total', len(failures), status='failed')
+    REGISTRY.write()
+
+    for country, err_message in failures.items():
+        logger.error("Report for {} was not generated: {}".format(country, err_message))
+    return failures
@@ -0,0 +1,383 @@
+""" Read the values of xlsx sheets straight from the sheet XML into arrays, without cell objects """
+
+import re
+from html import unescape
+from xml.etree import ElementTree
+from zipfile import ZipFile
+import numpy as np
+from loguru import logger
+from src.helper import trim_rows
+from src.xlsx_writer import MAIN_NS, WORKBOOK_PART, get_sheet_parts
+import config as cfg
+
+# openpyxl is imported by the functions using it, as it is slow to import
+# pylint: disable=import-outside-toplevel
+
+SHARED_STRINGS_PART = 'xl/sharedStrings.xml'
+STYLES_PART = 'xl/styles.xml'
+CHUNK_SIZE = 1 << 18
+
+DIMENSION_RE = re.compile(rb'<dimension\b[^>]*?\bref="([^"]*)"')
+ROW_RE = re.compile(rb'<row\b([^>]*)>')
+ROW_NUM_RE = re.compile(rb'\br="(\d+)"')
+# Cells as Excel and openpyxl write them, the reference first: column, row, style, type,
+# value and the inline string
+CELL_RE = re.compile(rb'<c r="([A-Z]+)(\d+)"(?: s="(\d+)")?(?: t="(\w+)")?(?: s="(\d+)")?[^>/]*'
+                     rb'(?:/>|>(?:<f\b[^>]*?(?:/>|>[^<]*</f>))?(?:<v>([^<]*)</v>|<v\s*/>)?'
+                     rb'(.*?)</c>)', re.DOTALL)
+INLINE_TEXT_RE = re.compile(rb'<is><t\b[^>]*>([^<]*)</t></is>')
+# Integers with more digits may not fit in 64 bits
+MAX_INTEGER_DIGITS = 18
+
+
+class UnsupportedSheet(Exception):
+    """
+    Custom exception for sheets the fast reader does not parse, they are read through openpyxl
+    """
+
+
+def read_shared_strings(zip_file):
+    """
+    Read the shared strings table, as openpyxl does without rich text
+    Parameters:
+        zip_file {ZipFile} - Opened xlsx file
+    Returns:
+        {Array} - Strings by index
+    """
+    if SHARED_STRINGS_PART not in zip_file.namelist():
+        return np.array([], dtype=object)
+    strings = []
+    text_tag = '{%s}t' % MAIN_NS
+    run_tag = '{%s}r' % MAIN_NS
+    with zip_file.open(SHARED_STRINGS_PART) as source:
+        for _, node in ElementTree.iterparse(source):
+            if node.tag == '{%s}si' % MAIN_NS:
+                strings.append(get_text(node, text_tag, run_tag).replace('x005F_', ''))
+                node.clear()
+    table = np.empty(len(strings), dtype=object)
+    table[:] = strings
+    return table
+
+
+def get_text(node, text_tag, run_tag):
+    """
+    Get the text of a string item without formatting and phonetic runs
+    Parameters:
+        node {Element} - si or is element
+        text_tag {String} - Tag of the text elements
+        run_tag {String} - Tag of the rich text runs
+    Returns:
+        {String} - Plain text followed by the text of the runs
+    """
+    texts = [node.findtext(text_tag)] + [run.findtext(text_tag) for run in node.iter(run_tag)]
+    return ''.join(text for text in texts if text)
+
+
+def read_date_styles(zip_file):
+    """
+    Find the cell styles whose number format shows dates or durations
+    Parameters:
+        zip_file {ZipFile} - Opened xlsx file
+    Returns:
+        {Tuple} - Indexes of the date styles and of the duration styles
+    """
+    from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format, is_timedelta_format
+
+    date_styles, timedelta_styles = set(), set()
+    if STYLES_PART not in zip_file.namelist():
+        return date_styles, timedelta_styles
+    styles = ElementTree.fromstring(zip_file.read(STYLES_PART))
+    formats = dict(BUILTIN_FORMATS)
+    for num_fmt in styles.iter('{%s}numFmt' % MAIN_NS):
+        formats[int(num_fmt.get('numFmtId'))] = num_fmt.get('formatCode')
+    cell_xfs = styles.find('{%s}cellXfs' % MAIN_NS)
+    for idx, xf_node in enumerate([] if cell_xfs is None else cell_xfs):
+        number_format = formats.get(int(xf_node.get('numFmtId', 0)))
+        if is_date_format(number_format):
+            date_styles.add(idx)
+        if is_timedelta_format(number_format):
+            timedelta_styles.add(idx)
+    return date_styles, timedelta_styles
+
+
+def read_epoch(zip_file):
+    """
+    Get the date system of the workbook
+    Parameters:
+        zip_file {ZipFile} - Opened xlsx file
+    Returns:
+        {Datetime} - Epoch of the serial dates
+    """
+    from openpyxl.utils.datetime import MAC_EPOCH, WINDOWS_EPOCH
+
+    workbook = ElementTree.fromstring(zip_file.read(WORKBOOK_PART))
+    properties = workbook.find('{%s}workbookPr' % MAIN_NS)
+    if properties is not None and properties.get('date1904') in ('1', 'true'):
+        return MAC_EPOCH
+    return WINDOWS_EPOCH
+
+
+def to_numbers(texts, dtype):
+    """
+    Convert the texts of numbers read from the XML
+    Parameters:
+        texts {Array} - Texts as bytes
+        dtype {Type} - NumPy type of the numbers
+    Returns:
+        {Array} - Numbers
+    """
+    return np.array(texts.tolist(), dtype=bytes).astype(dtype)
+
+
+def read_chunks(source):
+    """
+    Read the sheet XML in chunks ending after a row, so that no row is split
+    Parameters:
+        source {File} - Sheet part opened from the zip file
+    Returns:
+        {Generator} - Chunks of the XML
+    """
+    pending = b''
+    while True:
+        data = source.read(CHUNK_SIZE)
+        if not data:
+            break
+        pending += data
+        end = pending.rfind(b'</row>')
+        if end >= 0:
+            yield pending[:end + 6]
+            pending = pending[end + 6:]
+    if pending:
+        yield pending
+
+
+# pylint: disable=too-many-instance-attributes
+class XlsxReader:
+    """
+    Reader of the cell values of xlsx sheets, streaming the sheet XML into arrays. Sheets it
+        does not parse are read through openpyxl.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.zip_file = ZipFile(file_name)
+        self.parts = get_sheet_parts(self.zip_file)
+        self.sheetnames = list(self.parts)
+        self._strings = None
+        self._date_styles = None
+        self._epoch = None
+        self._columns = {}
+        self._fallback = None
+
+    def _read_value(self, data_type, style, value, inline):
+        """
+        Convert the value of a cell other than plain numbers and shared strings, as openpyxl does
+        Parameters:
+            data_type {Bytes} - Type of the cell
+            style {Integer} - Style index of the cell
+            value {Bytes} - Text of the value element
+            inline {Bytes} - Content of the cell after the value element
+        Returns:
+            Value of the cell
+        """
+        if data_type == b'inlineStr':
+            text = INLINE_TEXT_RE.fullmatch(inline)
+            if text is not None:
+                return unescape(text.group(1).decode())
+            inline = ElementTree.fromstring(b'<c>' + inline + b'</c>').find('is')
+            return None if inline is None else get_text(inline, 't', 'r')
+        if data_type in (b'', b'n'):
+            is_float = b'.' in value or b'E' in value or b'e' in value
+            number = float(value) if is_float else int(value)
+            date_styles, timedelta_styles = self._date_styles
+            if style not in date_styles:
+                return number
+            from openpyxl.utils.datetime import from_excel
+            try:
+                return from_excel(number, self._epoch, timedelta=style in timedelta_styles)
+            except (OverflowError, ValueError):
+                return '#VALUE!'
+        if data_type == b'b':
+            return bool(int(value))
+        if data_type == b'd':
+            from openpyxl.utils.datetime import from_ISO8601
+            return from_ISO8601(value.decode())
+        return unescape(value.decode())
+
+    # pylint: disable=too-many-locals
+    def _read_chunk(self, chunk, max_row, max_col):
+        """
+        Parse the cells of a chunk of the sheet XML into arrays
+        Parameters:
+            chunk {Bytes} - Whole rows of the sheet XML
+            max_row {Integer} - Last row of the dimension
+            max_col {Integer} - Last column of the dimension
+        Returns:
+            {Tuple} - Row indexes, column indexes and values of the non-blank cells
+        """
+        matches = CELL_RE.findall(chunk)
+        if len(matches) != chunk.count(b'<c ') + chunk.count(b'<c>'):
+            raise UnsupportedSheet('cells not written reference first')
+        if not matches:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), \
+                np.array([], dtype=object)
+        cells = np.empty((len(matches), len(matches[0])), dtype=object)
+        cells[:] = matches
+
+        rows = to_numbers(cells[:, 1], np.int64) - 1
+        letters = cells[:, 0].tolist()
+        for name in set(letters).difference(self._columns):
+            from openpyxl.utils.cell import column_index_from_string
+            self._columns[name] = column_index_from_string(name.decode()) - 1
+        cols = np.fromiter(map(self._columns.__getitem__, letters), dtype=np.int64,
+                           count=len(letters))
+        keep = (rows < max_row) & (cols < max_col)
+        cells, rows, cols = cells[keep], rows[keep], cols[keep]
+        data_type, text = cells[:, 3], cells[:, 5]
+        styles = cells[:, 2] + cells[:, 4]
+        style_ids = np.zeros(len(cells), dtype=np.int64)
+        style_ids[styles != b''] = to_numbers(styles[styles != b''], np.int64)
+
+        has_value = text != b''
+        numbers = np.flatnonzero(((data_type == b'') | (data_type == b'n')) & has_value
+                                 & ~np.isin(style_ids, list(self._date_styles[0])))
+        texts = np.array(text[numbers].tolist(), dtype=bytes)
+        chars = texts.view(np.uint8).reshape(len(texts), texts.dtype.itemsize)
+        # Numbers with a point or an exponent are floats and the others integers, as openpyxl
+        # casts them. Longer integers may not fit in 64 bits and are read one by one.
+        is_float = ((chars == ord('.')) | (chars == ord('e')) | (chars == ord('E'))).any(axis=1)
+        is_integer = ~is_float & ((chars != 0).sum(axis=1) <= MAX_INTEGER_DIGITS)
+        strings = np.flatnonzero((data_type == b's') & has_value)
+
+        values = np.empty(len(cells), dtype=object)
+        values[numbers[is_float]] = texts[is_float].astype(np.float64)
+        values[numbers[is_integer]] = texts[is_integer].astype(np.int64)
+        values[strings] = self._strings[to_numbers(text[strings], np.int64)]
+        used = np.zeros(len(cells), dtype=bool)
+        used[numbers[is_float | is_integer]] = True
+        used[strings] = True
+        for idx in np.flatnonzero(~used & (has_value | (data_type == b'inlineStr'))):
+            values[idx] = self._read_value(data_type[idx], style_ids[idx], text[idx], cells[idx, 6])
+            used[idx] = True
+        return rows[used], cols[used], values[used]
+
+    def _read_cells(self, sheet_name):
+        """
+        Parse the cells of a sheet within its dimension
+        Parameters:
+            sheet_name {String} - Name of the sheet
+        Returns:
+            {Tuple} - Row indexes, column indexes and values of the non-blank cells, number of
+                rows and number of columns
+        """
+        if self._strings is None:
+            self._strings = read_shared_strings(self.zip_file)
+            self._date_styles = read_date_styles(self.zip_file)
+            self._epoch = read_epoch(self.zip_file)
+        parts = []
+        max_row = max_col = None
+        last_row = 0
+
+        with self.zip_file.open(self.parts[sheet_name]) as source:
+            for chunk in read_chunks(source):
+                if max_row is None:
+                    match = DIMENSION_RE.search(chunk)
+                    if match is None:
+                        raise UnsupportedSheet('dimension missing')
+                    from openpyxl.utils.cell import range_boundaries
+                    _, _, max_col, max_row = range_boundaries(match.group(1).decode())
+                    if max_row is None or max_col is None:
+                        raise UnsupportedSheet('dimension not bounded')
+                row_nums = [ROW_NUM_RE.search(attrs) for attrs in ROW_RE.findall(chunk)]
+                if not all(row_nums):
+                    raise UnsupportedSheet('row without reference')
+                if row_nums:
+                    last_row = max(last_row, int(row_nums[-1].group(1)))
+                parts.append(self._read_chunk(chunk, max_row, max_col))
+
+        if max_row is None:
+            raise UnsupportedSheet('sheet is empty')
+        rows, cols, values = (np.concatenate(arrays) for arrays in zip(*parts))
+        # openpyxl stops at the last row element of the sheet within the dimension
+        return rows, cols, values, min(max_row, last_row), max_col
+
+    def values(self, sheet_name, trim=False):
+        """
+        Get the values of a sheet as openpyxl read-only sheets give them
+        Parameters:
+            sheet_name {String} - Name of the sheet
+            trim {Boolean} - Drop the trailing empty rows and columns
+        Returns:
+            {List} - Rows of cell values
+        """
+        try:
+            rows, cols, values, n_rows, n_cols = self._read_cells(sheet_name)
+        except UnsupportedSheet as err_message:
+            logger.debug("Reading sheet {} of {} through openpyxl: {}".format(
+                sheet_name, self.file_name, err_message))
+            if self._fallback is None:
+                self._fallback = OpenpyxlReader(self.file_name, True, True)
+            return self._fallback.values(sheet_name, trim)
+
+        if trim:
+            used = np.not_equal(values, None) & np.not_equal(values, '')
+            n_rows = rows[used].max() + 1 if used.any() else 0
+            n_cols = cols[used].max() + 1 if used.any() else 0
+        keep = (rows < n_rows) & (cols < n_cols)
+        grid = np.full((n_rows, n_cols), None, dtype=object)
+        grid[rows[keep], cols[keep]] = values[keep]
+        return grid.tolist()
+
+    def close(self):
+        """
+        Close the workbook
+        """
+        self.zip_file.close()
+        if self._fallback is not None:
+            self._fallback.close()
+
+
+class OpenpyxlReader:
+    """
+    Reader of the cell values of xlsx sheets through openpyxl
+    """
+
+    def __init__(self, file_name, is_read_only, is_data_only):
+        from openpyxl import load_workbook
+
+        self.workbook = load_workbook(file_name, read_only=is_read_only, data_only=is_data_only)
+        self.sheetnames = self.workbook.sheetnames
+
+    def values(self, sheet_name, trim=False):
+        """
+        Get the values of a sheet
+        Parameters:
+            sheet_name {String} - Name of the sheet
+            trim {Boolean} - Drop the trailing empty rows and columns
+        Returns:
+            {Iterable} - Rows of cell values
+        """
+        rows = self.workbook[sheet_name].values
+        return trim_rows(rows) if trim else rows
+
+    def close(self):
+        """
+        Close the workbook
+        """
+        self.workbook.close()
+
+
+def open_reader(file_name, is_read_only=False, is_data_only=True):
+    """
+    Open a workbook with the configured reader. Workbooks read with formulas or not read-only
+        are always loaded through openpyxl.
+    Parameters:
+        file_name {String} - Excel file name
+        is_read_only {Boolean} - Open the file in read only mode
+        is_data_only {Boolean} - Read the cached values instead of the formulas
+    Returns:
+        {XlsxReader/OpenpyxlReader} - Reader with sheetnames, values and close
+    """
+    if cfg.READER_BACKEND == 'fast' and is_read_only and is_data_only:
+        return XlsxReader(file_name)
+    return OpenpyxlReader(file_name, is_read_only, is_data_only)
@@ -0,0 +1,324 @@
+""" Write output workbooks by patching the sheet XML parts of the template in place """
+
+import re
+from datetime import date, datetime
+from decimal import Decimal
+from math import isinf, isnan
+from numbers import Number
+from posixpath import dirname, join, normpath
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from zipfile import ZipFile
+from src.zip_writer import ZipPart, read_raw, write_zip
+
+# openpyxl is imported by the functions using it, as it is slow to import
+# pylint: disable=import-outside-toplevel
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+WORKBOOK_PART = 'xl/workbook.xml'
+WORKBOOK_RELS_PART = 'xl/_rels/workbook.xml.rels'
+CONTENT_TYPES_PART = '[Content_Types].xml'
+CALC_CHAIN_PART = 'xl/calcChain.xml'
+
+SHEET_DATA_RE = re.compile(r'<sheetData\s*/>|<sheetData>(.*?)</sheetData>', re.DOTALL)
+ROW_RE = re.compile(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', re.DOTALL)
+CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.DOTALL)
+ATTR_RE = re.compile(r'([\w:]+)="([^"]*)"')
+DIMENSION_RE = re.compile(r'<dimension ref="([^"]*)"\s*/>')
+FORMULA_RE = re.compile(r'<f[\s>/]')
+FORMULA_BYTES_RE = re.compile(rb'<f[\s>/]')
+
+# Errors of Excel, cells holding them are stored as errors instead of text
+ERROR_CODES = ('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A')
+
+
+def get_sheet_parts(zip_file):
+    """
+    Map the sheet names of the workbook to their XML parts
+    Parameters:
+        zip_file {ZipFile} - Opened xlsx file
+    Returns:
+        {Dictionary} - Sheet name to path of the sheet part in the zip file
+    """
+    workbook = ElementTree.fromstring(zip_file.read(WORKBOOK_PART))
+    rels = ElementTree.fromstring(zip_file.read(WORKBOOK_RELS_PART))
+    targets = {}
+    for rel in rels.iter('{%s}Relationship' % PKG_REL_NS):
+        target = rel.get('Target')
+        if target.startswith('/'):
+            targets[rel.get('Id')] = target[1:]
+        else:
+            targets[rel.get('Id')] = normpath(join(dirname(WORKBOOK_PART), target))
+    return {sheet.get('name'): targets[sheet.get('{%s}id' % REL_NS)]
+            for sheet in workbook.iter('{%s}sheet' % MAIN_NS)}
+
+
+def is_blank(value):
+    """
+    Check whether a cell value is empty
+    Parameters:
+        value - Cell value
+    Returns:
+        {Boolean} - True for None, empty strings and NaN
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return True
+    return isinstance(value, float) and value != value  # pylint: disable=comparison-with-itself
+
+
+def get_changed_cells(before, after):
+    """
+    Find the cells whose values differ between two data frames of a sheet
+    Parameters:
+        before {DataFrame} - Values of the sheet as read from the template
+        after {DataFrame} - Values of the sheet to be written
+    Returns:
+        {Dictionary} - (row, column) to new value, both 1-based as in Excel
+    """
+    changed = {}
+    for r_idx, row in enumerate(after.itertuples(index=False)):
+        for c_idx, value in enumerate(row):
+            try:
+                old_value = before.iat[r_idx, c_idx]
+            except IndexError:
+                old_value = None
+            if is_blank(value) and is_blank(old_value):
+                continue
+            if is_blank(value) != is_blank(old_value) or value != old_value \
+                    or isinstance(value, str) != isinstance(old_value, str):
+                changed[(r_idx + 1, c_idx + 1)] = value
+    return changed
+
+
+def get_frame_value(data_frame, row, col):
+    """
+    Get the value of a cell from the data frame of a sheet
+    Parameters:
+        data_frame {DataFrame} - Values of the sheet, None if not known
+        row {Integer} - Row number, 1-based
+        col {Integer} - Column number, 1-based
+    Returns:
+        Value of the cell, None outside of the data frame
+    """
+    if data_frame is None or row > data_frame.shape[0] or col > data_frame.shape[1]:
+        return None
+    return data_frame.iat[row - 1, col - 1]
+
+
+def get_error_code(value):
+    """
+    Get the Excel error a number is written as, Excel has no NaN or infinite numbers
+    Parameters:
+        value {Number} - Cell value
+    Returns:
+        {String} - #NUM! for NaN, #DIV/0! for infinite numbers, None for other numbers
+    """
+    if isinstance(value, Decimal):
+        return '#NUM!' if value.is_nan() else '#DIV/0!' if value.is_infinite() else None
+    if isinstance(value, complex):
+        return '#NUM!'
+    return '#NUM!' if isnan(value) else '#DIV/0!' if isinf(value) else None
+
+
+def format_cell(ref, style, value):
+    """
+    Build the XML of a cell holding the value, formulae are written as empty cells
+    Parameters:
+        ref {String} - Cell reference (e.g. B12)
+        style {String} - Style index of the cell, None for the default style
+        value - Value of the cell
+    Returns:
+        {String} - XML of the cell
+    """
+    attrs = ' r="{}"'.format(ref)
+    if style is not None:
+        attrs += ' s="{}"'.format(style)
+
+    if is_blank(value) or (isinstance(value, str) and value.startswith('=')):
+        return '<c{}/>'.format(attrs)
+    if isinstance(value, bool):
+        return '<c{} t="b"><v>{}</v></c>'.format(attrs, int(value))
+    if isinstance(value, (datetime, date)):
+        from openpyxl.utils.datetime import to_excel
+        return '<c{}><v>{}</v></c>'.format(attrs, to_excel(value))
+    if isinstance(value, (Number, Decimal)):
+        error_code = get_error_code(value)
+        if error_code is None:
+            return '<c{}><v>{}</v></c>'.format(attrs, value)
+        value = error_code
+    text = str(value)
+    if text in ERROR_CODES:
+        # Stored as errors, as openpyxl stores them
+        return '<c{} t="e"><v>{}</v></c>'.format(attrs, text)
+    space = ' xml:space="preserve"' if text != text.strip() else ''
+    return '<c{} t="inlineStr"><is><t{}>{}</t></is></c>'.format(attrs, space, escape(text))
+
+
+def patch_row(row_num, attrs, body, new_cells, values=None):
+    """
+    Rebuild the XML of a row with new cell values and formulae stripped
+    Parameters:
+        row_num {Integer} - Row number
+        attrs {String} - Attributes of the row element
+        body {String} - Cells of the row element
+        new_cells {Dictionary} - Column to new value for this row
+        values {DataFrame} - Values of the sheet, written over its formulae as openpyxl
+            writes the whole tab, None to leave formula cells empty
+    Returns:
+        {Tuple} - XML of the row and whether anything changed
+    """
+    from openpyxl.utils.cell import (get_column_letter, coordinate_from_string,
+                                     column_index_from_string)
+
+    cells = {}
+    changed = False
+    for match in CELL_RE.finditer(body or ''):
+        cell_attrs = dict(ATTR_RE.findall(match.group(1)))
+        col = column_index_from_string(coordinate_from_string(cell_attrs['r'])[0])
+        if col in new_cells:
+            cells[col] = format_cell(cell_attrs['r'], cell_attrs.get('s'), new_cells.pop(col))
+            changed = True
+        elif match.group(2) and FORMULA_RE.search(match.group(2)):
+            cells[col] = format_cell(cell_attrs['r'], cell_attrs.get('s'),
+                                     get_frame_value(values, row_num, col))
+            changed = True
+        else:
+            cells[col] = match.group(0)
+
+    for col, value in new_cells.items():
+        cells[col] = format_cell('{}{}'.format(get_column_letter(col), row_num), None, value)
+        changed = True
+        # Spans are an optional hint and would be wrong once cells are added
+        attrs = re.sub(r'\sspans="[^"]*"', '', attrs)
+
+    if not changed:
+        return None, False
+    return '<row{}>{}</row>'.format(attrs, ''.join(cells[col] for col in sorted(cells))), True
+
+
+# pylint: disable=too-many-locals
+def patch_sheet_xml(xml, cells, values=None):
+    """
+    Write new cell values into the sheet XML and strip the formulae
+    Parameters:
+        xml {String} - XML of the sheet part
+        cells {Dictionary} - (row, column) to new value, both 1-based
+        values {DataFrame} - Values of the sheet written over its formulae, see patch_row
+    Returns:
+        {String} - Patched XML of the sheet part
+    """
+    sheet_data = SHEET_DATA_RE.search(xml)
+    if sheet_data is None:
+        raise ValueError('sheetData element not found')
+
+    rows_cells = {}
+    for (row_num, col), value in cells.items():
+        rows_cells.setdefault(row_num, {})[col] = value
+
+    parts = []
+    position = 0
+    body = sheet_data.group(1) or ''
+    for match in ROW_RE.finditer(body):
+        row_num = int(dict(ATTR_RE.findall(match.group(1)))['r'])
+        # Rows which do not exist yet are inserted in order
+        for new_row in sorted(num for num in rows_cells if num < row_num):
+            parts.append(body[position:match.start()])
+            position = match.start()
+            parts.append(patch_row(new_row, ' r="{}"'.format(new_row), '',
+                                   rows_cells.pop(new_row))[0])
+        new_xml, changed = patch_row(row_num, match.group(1), match.group(2),
+                                     rows_cells.pop(row_num, {}), values)
+        if changed:
+            parts.append(body[position:match.start()])
+            parts.append(new_xml)
+            position = match.end()
+    parts.append(body[position:])
+    for new_row in sorted(rows_cells):
+        parts.append(patch_row(new_row, ' r="{}"'.format(new_row), '', rows_cells[new_row])[0])
+
+    xml = '{}<sheetData>{}</sheetData>{}'.format(
+        xml[:sheet_data.start()], ''.join(parts), xml[sheet_data.end():])
+    return update_dimension(xml, cells)
+
+
+def update_dimension(xml, cells):
+    """
+    Extend the dimension of the sheet to cover the written cells
+    Parameters:
+        xml {String} - XML of the sheet part
+        cells {Dictionary} - (row, column) to new value, both 1-based
+    Returns:
+        {String} - XML of the sheet part with the dimension updated
+    """
+    from openpyxl.utils.cell import (get_column_letter, coordinate_from_string,
+                                     column_index_from_string)
+
+    dimension = DIMENSION_RE.search(xml)
+    if dimension is None or not cells:
+        return xml
+    end = dimension.group(1).split(':')[-1]
+    col_letter, row_num = coordinate_from_string(end)
+    max_row = max([row_num] + [row for row, _ in cells])
+    max_col = max([column_index_from_string(col_letter)] + [col for _, col in cells])
+    start = dimension.group(1).split(':')[0]
+    ref = '{}:{}{}'.format(start, get_column_letter(max_col), max_row)
+    return '{}<dimension ref="{}"/>{}'.format(
+        xml[:dimension.start()], ref, xml[dimension.end():])
+
+
+def drop_calc_chain(part_name, data):
+    """
+    Remove references to the calculation chain, which is invalid once formulae are stripped
+    Parameters:
+        part_name {String} - Path of the part in the zip file
+        data {Bytes} - Content of the part
+    Returns:
+        {Bytes} - Content of the part without calculation chain references
+    """
+    if part_name == CONTENT_TYPES_PART:
+        return re.sub(rb'<Override[^>]*PartName="/xl/calcChain.xml"[^>]*/>', b'', data)
+    if part_name == WORKBOOK_RELS_PART:
+        return re.sub(rb'<Relationship[^>]*Target="[^"]*calcChain.xml"[^>]*/>', b'', data)
+    return data
+
+
+def write_report(template_file, output_file, sheet_cells, compression='final',
+                 sheet_values=None):
+    """
+    Write the output workbook from the template, rewriting only the sheet parts with changed
+        cells or formulae. All other parts, extLst elements included, are copied through
+        without being recompressed.
+    Parameters:
+        template_file {String} - Path of the template workbook
+        output_file {String} - Path of the output workbook
+        sheet_cells {Dictionary} - Sheet name to changed cells, see get_changed_cells
+        compression {String/Integer} - Compression profile or deflate level of rewritten parts
+        sheet_values {Dictionary} - Sheet name to the values of the written tab. Its formula
+            cells keep the cached or evaluated value instead of being emptied.
+    """
+    sheet_values = sheet_values or {}
+    parts = []
+    with ZipFile(template_file) as template, open(template_file, 'rb') as template_raw:
+        sheet_parts = {part: name for name, part in get_sheet_parts(template).items()}
+        has_calc_chain = CALC_CHAIN_PART in template.namelist()
+        for info in template.infolist():
+            if info.filename == CALC_CHAIN_PART:
+                continue
+            data = None
+            if info.filename in sheet_parts:
+                cells = sheet_cells.get(sheet_parts[info.filename], {})
+                sheet_xml = template.read(info)
+                if cells or FORMULA_BYTES_RE.search(sheet_xml):
+                    data = patch_sheet_xml(sheet_xml.decode('utf-8'), cells, sheet_values.get(
+                        sheet_parts[info.filename])).encode('utf-8')
+            elif has_calc_chain and info.filename in (CONTENT_TYPES_PART, WORKBOOK_RELS_PART):
+                data = drop_calc_chain(info.filename, template.read(info))
+
+            if data is None:
+                parts.append(ZipPart(info.filename, info.date_time,
+                                     raw=read_raw(template_raw, info)))
+            else:
+                parts.append(ZipPart(info.filename, info.date_time, data=data))
+    write_zip(output_file, parts, compression)
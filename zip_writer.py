@@ -0,0 +1,146 @@
+""" Zip writer compressing parts in parallel and copying unchanged parts without recompressing """
+
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+import config as cfg
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+END_RECORD_SIGNATURE = 0x06054b50
+ZIP_VERSION = 20
+UTF8_FLAG = 0x800
+ZIP32_LIMIT = 0xFFFFFFFF
+
+
+class ZipPart:
+    """
+    Part of a zip file, either uncompressed data or data copied raw from another zip file
+    """
+
+    def __init__(self, name, date_time, data=None, raw=None):
+        self.name = name
+        self.date_time = date_time
+        self.data = data
+        # Tuple of compression method, crc, compressed data and uncompressed size
+        self.raw = raw
+
+
+def get_compression_level(compression):
+    """
+    Get the deflate level of a compression profile
+    Parameters:
+        compression {String/Integer} - Profile name in OUTPUT_COMPRESSION_LEVEL, or a level
+    Returns:
+        {Integer} - Deflate level from 0 to 9
+    """
+    if isinstance(compression, int):
+        return compression
+    return cfg.OUTPUT_COMPRESSION_LEVEL[compression]
+
+
+def deflate(data, level):
+    """
+    Compress the data as a raw deflate stream, as stored in zip files
+    Parameters:
+        data {Bytes} - Uncompressed data
+        level {Integer} - Deflate level
+    Returns:
+        {Tuple} - Compression method, crc, compressed data and uncompressed size
+    """
+    if level == 0:
+        return ZIP_STORED, zlib.crc32(data), data, len(data)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ZIP_DEFLATED, zlib.crc32(data), \
+        compressor.compress(data) + compressor.flush(), len(data)
+
+
+def read_raw(file_obj, info):
+    """
+    Read the compressed data of a zip member without decompressing it
+    Parameters:
+        file_obj {File} - Zip file opened in binary mode
+        info {ZipInfo} - Member of the zip file
+    Returns:
+        {Tuple} - Compression method, crc, compressed data and uncompressed size
+    """
+    file_obj.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(file_obj.read(LOCAL_HEADER.size))
+    file_obj.seek(header[9] + header[10], 1)
+    return info.compress_type, info.CRC, file_obj.read(info.compress_size), info.file_size
+
+
+def dos_date_time(date_time):
+    """
+    Convert a zip member date time tuple to the DOS date and time fields
+    Parameters:
+        date_time {Tuple} - Year, month, day, hour, minute, second
+    Returns:
+        {Tuple} - DOS time and DOS date
+    """
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), \
+        ((max(year, 1980) - 1980) << 9) | (month << 5) | day
+
+
+# pylint: disable=too-many-locals
+def write_zip(output_file, parts, compression='final', threads=None):
+    """
+    Write the parts to a zip file, compressing the uncompressed parts in parallel
+    Parameters:
+        output_file {String} - Path of the zip file
+        parts {List} - ZipPart objects, written in order
+        compression {String/Integer} - Compression profile or deflate level
+        threads {Integer} - Number of compression threads
+    """
+    level = get_compression_level(compression)
+    threads = threads or cfg.OUTPUT_COMPRESSION_THREADS
+    # zlib releases the GIL while compressing, so threads compress in parallel
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        compressed = [pool.submit(deflate, part.data, level) if part.raw is None else None
+                      for part in parts]
+
+        central_dir = []
+        with open(output_file, 'wb') as output:
+            for part, future in zip(parts, compressed):
+                method, crc, data, size = part.raw if future is None else future.result()
+                name = part.name.encode('utf-8')
+                flags = 0 if part.name.isascii() else UTF8_FLAG
+                dos_time, dos_date = dos_date_time(part.date_time)
+                offset = output.tell()
+                if max(offset, len(data), size) > ZIP32_LIMIT:
+                    raise ValueError('{} is too large for a zip file without ZIP64'
+                                     .format(part.name))
+                output.write(LOCAL_HEADER.pack(
+                    LOCAL_HEADER_SIGNATURE, ZIP_VERSION, flags, method, dos_time, dos_date,
+                    crc, len(data), size, len(name), 0))
+                output.write(name)
+                output.write(data)
+                central_dir.append(CENTRAL_HEADER.pack(
+                    CENTRAL_HEADER_SIGNATURE, ZIP_VERSION, ZIP_VERSION, flags, method, dos_time,
+                    dos_date, crc, len(data), size, len(name), 0, 0, 0, 0, 0, offset) + name)
+
+            central_dir_offset = output.tell()
+            for header in central_dir:
+                output.write(header)
+            output.write(END_RECORD.pack(
+                END_RECORD_SIGNATURE, 0, 0, len(central_dir), len(central_dir),
+                output.tell() - central_dir_offset, central_dir_offset, 0))
+
+
+def recompress(file_name, compression='final', threads=None):
+    """
+    Rewrite a zip file with every part compressed in parallel at the given level
+    Parameters:
+        file_name {String} - Path of the zip file
+        compression {String/Integer} - Compression profile or deflate level
+        threads {Integer} - Number of compression threads
+    """
+    with ZipFile(file_name) as zip_file:
+        parts = [ZipPart(info.filename, info.date_time, data=zip_file.read(info))
+                 for info in zip_file.infolist()]
+    write_zip(file_name, parts, compression, threads)